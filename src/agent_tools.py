@@ -1,7 +1,79 @@
 import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import vertexai
 from vertexai.generative_models import FunctionDeclaration, Tool, Part
 
+TOOL_CACHE_SIZE = 1024
+TOOL_CACHE_TTL = 600  # Seconds
+
+
+class ToolResultCache:
+    """Bounded LRU cache of tool results with a time-to-live"""
+    def __init__(self, maxsize=TOOL_CACHE_SIZE, ttl=TOOL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Part of every key, so results of lookups started before an invalidate are never served after it
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        """Drop every entry, e.g. after the collection is rebuilt or loaded into"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+# Shared across agent turns
+tool_cache = ToolResultCache()
+
+
+def collection_version(collection):
+    """Identify the collection's contents without a request, a rebuilt collection gets a new id and loads bump the cache generation"""
+    return f"{getattr(collection, 'id', '')}:{tool_cache.generation}"
+
+
+def tool_cache_key(name, search_content, where, collection, version=None):
+    """Key a tool result by function, normalized arguments and collection version"""
+    normalized_search = " ".join(search_content.lower().split())
+    if version is None:
+        version = collection_version(collection)
+    return (name, normalized_search, json.dumps(where, sort_keys=True), collection.name, version)
+
 # Specify a function declaration and parameters for an API request
 get_book_by_author_func = FunctionDeclaration(
     name="get_book_by_author",
@@ -16,18 +88,6 @@ get_book_by_author_func = FunctionDeclaration(
         "required": ["author","search_content"],
     },
 )
-def get_book_by_author(author, search_content, collection, embed_func):
-
-    query_embedding = embed_func(search_content)
-
-    # Query based on embedding value 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=10,
-        where={"author":author}
-    )
-    return "\n".join(results["documents"][0])
-
 
 get_book_by_search_content_func = FunctionDeclaration(
     name="get_book_by_search_content",
@@ -41,51 +101,111 @@ get_book_by_search_content_func = FunctionDeclaration(
         "required": ["search_content"],
     },
 )
-def get_book_by_search_content(search_content, collection, embed_func):
-
-    query_embedding = embed_func(search_content)
-
-    # Query based on embedding value 
-    results = collection.query(
-        query_embeddings=[query_embedding],
-        n_results=10
-    )
-    return "\n".join(results["documents"][0])
 
 # Define all functions available to the cheese expert
 cheese_expert_tool = Tool(function_declarations=[get_book_by_author_func,get_book_by_search_content_func])
 
 
-def execute_function_calls(function_calls,collection, embed_func):
-    parts = []
+def search_arguments(function_call):
+    """Return the search text and metadata filter a tool call queries with"""
+    if function_call.name == "get_book_by_author":
+        return function_call.args["search_content"], {"author": function_call.args["author"]}
+    if function_call.name == "get_book_by_search_content":
+        return function_call.args["search_content"], None
+    return None
+
+
+def execute_function_calls(function_calls, collection, embed_func, batch_embed_func=None):
+    """
+    Execute the tool calls from one model turn with one embedding call and one query per filter.
+
+    All search strings are embedded together, calls sharing a metadata filter are sent to
+    the collection as a single multi-embedding query, and different filters are queried
+    concurrently. Responses are returned in the original call order, a call whose query
+    fails gets an error response instead of failing the others.
+
+    Args:
+        function_calls: Function calls from the model response
+        collection: The vector db collection
+        embed_func: Embeds a single query, used if batch_embed_func is not given
+        batch_embed_func: Embeds a list of queries in one request
+    """
+    calls = []
     for function_call in function_calls:
         print("Function:",function_call.name)
-        if function_call.name == "get_book_by_author":
-            print("Calling function with args:", function_call.args["author"], function_call.args["search_content"])
-            response = get_book_by_author(function_call.args["author"], function_call.args["search_content"],collection, embed_func)
-            print("Response:", response)
-            #function_responses.append({"function_name":function_call.name, "response": response})
-            parts.append(
-					Part.from_function_response(
-						name=function_call.name,
-						response={
-							"content": response,
-						},
-					),
-			)
-        if function_call.name == "get_book_by_search_content":
-            print("Calling function with args:", function_call.args["search_content"])
-            response = get_book_by_search_content(function_call.args["search_content"],collection, embed_func)
-            print("Response:", response)
-            #function_responses.append({"function_name":function_call.name, "response": response})
-            parts.append(
-					Part.from_function_response(
-						name=function_call.name,
-						response={
-							"content": response,
-						},
-					),
-			)
-
-    
+        arguments = search_arguments(function_call)
+        if arguments is None:
+            continue
+        print("Calling function with args:", dict(function_call.args))
+        calls.append((function_call.name, *arguments))
+    if not calls:
+        return []
+
+    # Serve repeated calls from the cache, retrieve only the misses
+    version = collection_version(collection)
+    keys = [tool_cache_key(name, search_content, where, collection, version) for name, search_content, where in calls]
+    responses = [tool_cache.get(key) for key in keys]
+    # Identical calls within the turn are retrieved once
+    misses = {}
+    for i, key in enumerate(keys):
+        if responses[i] is None:
+            misses.setdefault(key, []).append(i)
+    uncached = [indexes[0] for indexes in misses.values()]
+    # Calls whose query failed, by index
+    errors = {}
+
+    if uncached:
+        # Step 1: Embed every search string in one request
+        search_contents = [calls[i][1] for i in uncached]
+        if batch_embed_func is not None:
+            query_embeddings = dict(zip(uncached, batch_embed_func(search_contents)))
+        else:
+            query_embeddings = {i: embed_func(search_content) for i, search_content in zip(uncached, search_contents)}
+
+        # Step 2: One multi-embedding query per distinct filter
+        groups = {}
+        for i in uncached:
+            where = calls[i][2]
+            groups.setdefault(json.dumps(where, sort_keys=True), (where, []))[1].append(i)
+
+        def query_group(where, indexes):
+            query_kwargs = {"where": where} if where else {}
+            try:
+                results = collection.query(
+                    query_embeddings=[query_embeddings[i] for i in indexes],
+                    n_results=10,
+                    **query_kwargs
+                )
+            except Exception as e:
+                # Only the calls of this group fail, the model still gets the other results
+                print(f"Error querying with filter {where}: {e}")
+                for i in indexes:
+                    for j in misses[keys[i]]:
+                        errors[j] = str(e)
+                return
+            for i, documents in zip(indexes, results["documents"]):
+                response = "\n".join(documents)
+                tool_cache.set(keys[i], response)
+                for j in misses[keys[i]]:
+                    responses[j] = response
+
+        if len(groups) == 1:
+            query_group(*next(iter(groups.values())))
+        else:
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                for future in [executor.submit(query_group, where, indexes) for where, indexes in groups.values()]:
+                    future.result()
+
+    # Step 3: Build the function responses in call order
+    parts = []
+    for i, ((name, _, _), response) in enumerate(zip(calls, responses)):
+        print("Response:", response)
+        parts.append(
+            Part.from_function_response(
+                name=name,
+                response={"error": errors[i]} if i in errors else {
+                    "content": response,
+                },
+            ),
+        )
     return parts
@@ -0,0 +1,343 @@
+"""
+Offline benchmarks for the cli.py ingest and query pipeline.
+
+Runs chunk, embed, load and query over synthetic corpora with a deterministic
+fake embedding model and an in-process vector store, so no Vertex AI
+credentials or Chroma container are needed.
+
+    python benchmark.py run --sizes 1MB,100MB --output outputs/benchmarks/base.json
+    python benchmark.py compare outputs/benchmarks/base.json outputs/benchmarks/new.json
+    python benchmark.py startup --budget_ms 500
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+from unittest.mock import patch
+
+import numpy as np
+
+from stand_ins import FakeEmbeddingModel, FakeGenerativeModel, InMemoryChromaClient
+from utils.embedding_providers import VertexEmbeddingProvider
+from utils.vector_store import VectorStore
+
+BENCHMARK_FOLDER = os.path.join("outputs", "benchmarks")
+DEFAULT_SIZES = "1MB"
+DEFAULT_STAGES = "chunk,embed,load,query"
+BOOK_BYTES = 8 * 1024 * 1024  # Split synthetic corpora into books of at most this size
+QUERY_REPEATS = 20
+# Metrics compared between runs, with the absolute change below which differences are noise
+COMPARED_METRICS = {
+    "wall_s": 0.05,
+    "cpu_s": 0.05,
+    "peak_rss_mb": 10,
+    "embedding_calls": 0,
+    "embedding_bytes": 0,
+    "vector_store_calls": 0,
+    "vector_store_bytes": 0,
+}
+SIZE_UNITS = {"KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+# Commands timed by the startup benchmark, run from an empty working directory
+STARTUP_COMMANDS = {
+    "help": [CLI_PATH, "--help"],
+    "import": ["-c", "import cli"],
+    "chunk_empty": [CLI_PATH, "--chunk", "--chunk_type", "char-split"],
+}
+STARTUP_REPEATS = 5
+
+
+def parse_size(size: str) -> int:
+    """Parse sizes like 1MB or 1GB into bytes"""
+    size = size.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+
+def generate_corpus(books_folder: str, total_bytes: int, seed: int = 0) -> int:
+    """
+    Write a synthetic clinical-style corpus split into numbered book files.
+
+    Text is drawn from a fixed random vocabulary with Zipf-distributed word
+    frequencies, plus a repeated boilerplate paragraph like the real books have.
+
+    Returns:
+        int: Number of books written
+    """
+    os.makedirs(books_folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocabulary = np.array(["".join(rng.choice(letters, size=rng.integers(3, 12))) for _ in range(20000)])
+    weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+    boilerplate = "Patient was discharged in stable condition with instructions to follow up with the primary care physician. "
+
+    written = 0
+    book = 0
+    while written < total_bytes:
+        book_bytes = min(BOOK_BYTES, total_bytes - written)
+        # Words average about 7 bytes with separators
+        words = vocabulary[rng.choice(len(vocabulary), size=max(book_bytes // 7, 1), p=weights)]
+        sentences = [" ".join(words[i:i + 15]).capitalize() + "." for i in range(0, len(words), 15)]
+        paragraphs = [" ".join(sentences[i:i + 8]) for i in range(0, len(sentences), 8)]
+        text = "\n\n".join(paragraph + (" " + boilerplate if i % 5 == 0 else "") for i, paragraph in enumerate(paragraphs))
+        text = text[:book_bytes]
+        with open(os.path.join(books_folder, f"{book}.txt"), "w") as f:
+            f.write(text)
+        written += len(text.encode("utf-8"))
+        book += 1
+    return book
+
+
+def reset_peak_rss() -> bool:
+    """Reset the kernel's peak RSS (VmHWM) for this process, where supported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux and bytes on macOS, and cannot be reset
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def import_cli(embedding_model, generative_model):
+    """Import cli.py with the model clients swapped for stand-ins"""
+    import cli
+    # Clients are created lazily, so setting them first means the real ones never are.
+    # Keep the real provider batching and concurrency, with the stand-in model underneath
+    cli.embedding_provider = VertexEmbeddingProvider(dimension=embedding_model.dimension, model=embedding_model)
+    cli.generative_model = generative_model
+    return cli
+
+
+def measure_stage(stage_fn, embedding_model, vector_store) -> dict:
+    """Run one stage and record wall time, CPU time, peak RSS, calls and bytes"""
+    embedding_before = embedding_model.counters.snapshot()
+    store_before = vector_store.counters()
+    reset_peak_rss()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        stage_fn()
+
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    embedding_after = embedding_model.counters.snapshot()
+    store_after = vector_store.counters()
+    return {
+        "wall_s": round(wall, 4),
+        "cpu_s": round(cpu, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "embedding_calls": embedding_after["calls"] - embedding_before["calls"],
+        "embedding_bytes": embedding_after["bytes"] - embedding_before["bytes"],
+        "vector_store_calls": store_after["calls"] - store_before["calls"],
+        "vector_store_bytes": store_after["bytes"] - store_before["bytes"],
+    }
+
+
+def run_benchmark(sizes, stages, method="char-split", embedding_latency="none", vector_store_latency="none", dimension=256, query_repeats=QUERY_REPEATS, workdir=None) -> dict:
+    """
+    Run the pipeline stages over synthetic corpora of each size.
+
+    Returns:
+        dict: Results keyed by corpus size, then stage
+    """
+    embedding_model = FakeEmbeddingModel(dimension=dimension, latency=embedding_latency)
+    generative_model = FakeGenerativeModel()
+    cli = import_cli(embedding_model, generative_model)
+
+    results = {}
+    for size in sizes:
+        vector_store = InMemoryChromaClient(latency=vector_store_latency)
+        with tempfile.TemporaryDirectory(dir=workdir) as tmp_dir, \
+                patch.object(cli, "INPUT_FOLDER", os.path.join(tmp_dir, "input-datasets")), \
+                patch.object(cli, "OUTPUT_FOLDER", os.path.join(tmp_dir, "outputs")), \
+                patch.object(cli, "vector_store", VectorStore(client=vector_store)):
+            books = generate_corpus(os.path.join(cli.INPUT_FOLDER, "books"), parse_size(size))
+            print(f"Corpus {size}: {books} books")
+
+            stage_functions = {
+                "chunk": lambda: cli.chunk(method=method),
+                "dedup": lambda: cli.dedup(method=method),
+                "embed": lambda: cli.embed(method=method),
+                "load": lambda: cli.load(method=method, output_folder=cli.OUTPUT_FOLDER),
+                "query": lambda: [cli.query(method=method) for _ in range(query_repeats)],
+            }
+            results[size] = {}
+            for stage in stages:
+                metrics = measure_stage(stage_functions[stage], embedding_model, vector_store)
+                results[size][stage] = metrics
+                print(f"  {stage:<6} {metrics['wall_s']:>9.3f}s  {metrics['peak_rss_mb']:>8.1f} MB  "
+                      f"{metrics['embedding_calls']} embedding calls  {metrics['vector_store_calls']} vector store calls")
+    return results
+
+
+def measure_startup(repeats: int = STARTUP_REPEATS) -> dict:
+    """
+    Time fresh interpreters running cli.py with nothing to process.
+
+    Returns:
+        dict: Median and best wall time per command, in the same shape as run results
+    """
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(CLI_PATH)}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, command in STARTUP_COMMANDS.items():
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, *command], cwd=tmp_dir, env=env, check=True, capture_output=True)
+                timings.append(time.perf_counter() - start)
+            results[name] = {"wall_s": round(float(np.median(timings)), 4), "best_s": round(min(timings), 4)}
+    return results
+
+
+def import_breakdown(module: str = "cli", top: int = 10) -> list:
+    """
+    The slowest imports pulled in by importing module, from python -X importtime.
+
+    Returns:
+        list: (module, cumulative ms) pairs, slowest first
+    """
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(CLI_PATH)}
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True, check=True)
+    imports = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(cumulative) / 1000))
+    return sorted(imports, key=lambda item: -item[1])[:top]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare_results(base: dict, new: dict, threshold: float = 0.1) -> list:
+    """
+    Find metrics that got worse by more than threshold (relative) between two runs.
+
+    Returns:
+        list: (size, stage, metric, base value, new value) for each regression
+    """
+    regressions = []
+    for size, stages in new["results"].items():
+        for stage, metrics in stages.items():
+            base_metrics = base["results"].get(size, {}).get(stage)
+            if not base_metrics:
+                continue
+            for metric, noise in COMPARED_METRICS.items():
+                if metric not in metrics or metric not in base_metrics:
+                    continue
+                before, after = base_metrics[metric], metrics[metric]
+                if after - before > noise and after > before * (1 + threshold):
+                    regressions.append((size, stage, metric, before, after))
+    return regressions
+
+
+def main(args=None):
+    if args.command == "run":
+        results = run_benchmark(
+            sizes=args.sizes.split(","),
+            stages=args.stages.split(","),
+            method=args.chunk_type,
+            embedding_latency=args.embedding_latency,
+            vector_store_latency=args.vector_store_latency,
+            query_repeats=args.query_repeats,
+        )
+        output = args.output or os.path.join(BENCHMARK_FOLDER, f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({
+                "created": datetime.now().isoformat(),
+                "commit": git_commit(),
+                "config": {
+                    "chunk_type": args.chunk_type,
+                    "embedding_latency": args.embedding_latency,
+                    "vector_store_latency": args.vector_store_latency,
+                    "query_repeats": args.query_repeats,
+                },
+                "results": results,
+            }, f, indent=2)
+        print(f"Saved results to {output}")
+
+    elif args.command == "startup":
+        results = measure_startup(repeats=args.repeats)
+        for name, metrics in results.items():
+            print(f"  {name:<12} {metrics['wall_s'] * 1000:>8.0f} ms median  {metrics['best_s'] * 1000:>8.0f} ms best")
+        print("Slowest imports of cli:")
+        for name, ms in import_breakdown():
+            print(f"  {name:<40} {ms:>8.1f} ms")
+        output = args.output or os.path.join(BENCHMARK_FOLDER, f"startup-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({"created": datetime.now().isoformat(), "commit": git_commit(), "results": {"startup": results}}, f, indent=2)
+        print(f"Saved results to {output}")
+        over_budget = [name for name, metrics in results.items() if metrics["wall_s"] * 1000 > args.budget_ms]
+        if args.budget_ms and over_budget:
+            print(f"Startup over {args.budget_ms} ms budget: {', '.join(over_budget)}")
+            sys.exit(1)
+
+    elif args.command == "compare":
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare_results(base, new, threshold=args.threshold)
+        for size, stage, metric, before, after in regressions:
+            print(f"REGRESSION {size} {stage} {metric}: {before} -> {after} ({(after - before) / max(before, 1e-9):+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark suite")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated corpus sizes, e.g. 1MB,100MB,1GB")
+    run_parser.add_argument("--stages", default=DEFAULT_STAGES, help="Comma separated stages: chunk,dedup,embed,load,query")
+    run_parser.add_argument("--chunk_type", default="char-split", help="char-split | recursive-split")
+    run_parser.add_argument("--embedding_latency", default="none", help="Fake embedding latency, e.g. fixed:50 or lognormal:80,0.3 (ms)")
+    run_parser.add_argument("--vector_store_latency", default="none", help="In-process vector store latency (ms)")
+    run_parser.add_argument("--query_repeats", type=int, default=QUERY_REPEATS, help="Number of query() runs in the query stage")
+    run_parser.add_argument("--output", help="Results file, defaults to outputs/benchmarks/benchmark-<time>.json")
+
+    startup_parser = subparsers.add_parser("startup", help="Time cli.py startup in fresh interpreters")
+    startup_parser.add_argument("--repeats", type=int, default=STARTUP_REPEATS, help="Runs per command")
+    startup_parser.add_argument("--budget_ms", type=float, default=0, help="Exit non-zero if any command is slower than this (ms)")
+    startup_parser.add_argument("--output", help="Results file, defaults to outputs/benchmarks/startup-<time>.json")
+
+    compare_parser = subparsers.add_parser("compare", help="Flag regressions between two runs")
+    compare_parser.add_argument("base", help="Baseline results file")
+    compare_parser.add_argument("new", help="New results file")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative increase treated as a regression")
+
+    main(parser.parse_args())
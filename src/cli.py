@@ -1,37 +1,45 @@
 import os
+import sys
 import argparse
-import pandas as pd
 import json
 import time
 import glob
 import hashlib
-import chromadb
-
-# Vertex AI
-import vertexai
-from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Content, Part, ToolConfig
-
-# Langchain
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-#from langchain_experimental.text_splitter import SemanticChunker
-from semantic_splitter import SemanticChunker
-import agent_tools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# pandas, chromadb, Vertex AI and LangChain take seconds to import, so they are
+# imported inside the stages that use them and clients are created on first use
+from dedup import deduplicate
+from utils.lexical_index import BM25Index, filtered_query, hybrid_query
+from utils.embedding_providers import get_embedding_provider, EMBEDDING_DIMENSION, EMBEDDING_PROVIDER
+from utils.vector_store import VectorStore
+from utils.context_builder import build_context
+from profiling import StageProfiler
 
 # Setup
 GCP_PROJECT = "apcomp215-434717" #"gemini707"
 GCP_LOCATION = "us-central1"
-EMBEDDING_MODEL = "text-embedding-004"
-EMBEDDING_DIMENSION = 256
 GENERATIVE_MODEL = "gemini-1.5-flash-002"
 INPUT_FOLDER = "input-datasets"
 OUTPUT_FOLDER = "outputs"
 CHROMADB_HOST = "llm-rag-chromadb"
 CHROMADB_PORT = 8000
-vertexai.init(project=GCP_PROJECT, location=GCP_LOCATION)
-# https://cloud.google.com/vertex-ai/generative-ai/docs/model-reference/text-embeddings-api#python
-embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
+# Bulk insert settings for load()
+LOAD_MAX_WORKERS = 4  # Concurrent add/upsert requests
+LOAD_MIN_BATCH_SIZE = 50
+LOAD_MAX_BATCH_SIZE = 5000
+LOAD_TARGET_BATCH_SECONDS = 1.0  # Aim for batches that take about this long to insert
+LOAD_MAX_BATCH_BYTES = 8 * 1024 * 1024  # Stay well under the Chroma server request size limit
+DEDUP_THRESHOLD = 0.9  # Jaccard similarity above which chunks count as near-duplicates
+CHAT_CONTEXT_TOKENS = 800  # Prompt context budget for chat, out of the 10 retrieved chunks
+# Clients, created on first use by the getters below
+vertexai_initialized = False
+embedding_provider = None
+generative_model = None
+vector_store = None
+# Loaded BM25 indexes by path, with the file's mtime so an index rebuilt by load() is read again
+lexical_indexes = {}
 # Configuration settings for the content generation
 generation_config = {
     "max_output_tokens": 8192,  # Maximum number of tokens for output
@@ -58,10 +66,57 @@ Remember:
 
 Your goal is to provide accurate, helpful information about clinical work based solely on the content of the text chunks you receive with each query.
 """
-generative_model = GenerativeModel(
-	GENERATIVE_MODEL, # change to finetuned model endpoint 
-	system_instruction=[SYSTEM_INSTRUCTION]
-)
+
+
+def init_vertexai():
+	global vertexai_initialized
+	if not vertexai_initialized:
+		import vertexai
+		vertexai.init(project=GCP_PROJECT, location=GCP_LOCATION)
+		vertexai_initialized = True
+
+
+def get_generative_model():
+	"""Create the generative model on first use"""
+	global generative_model
+	if generative_model is None:
+		init_vertexai()
+		from vertexai.generative_models import GenerativeModel
+		generative_model = GenerativeModel(
+			GENERATIVE_MODEL, # change to finetuned model endpoint 
+			system_instruction=[SYSTEM_INSTRUCTION]
+		)
+	return generative_model
+
+
+def get_embedding():
+	"""Embedding backend, set EMBEDDING_PROVIDER=hashing to run without network access"""
+	global embedding_provider
+	if embedding_provider is None:
+		if EMBEDDING_PROVIDER == "vertex":
+			init_vertexai()
+		embedding_provider = get_embedding_provider()
+	return embedding_provider
+
+
+def get_vector_store():
+	"""Shared chroma DB connection, reused by every stage and reconnected if the server restarts"""
+	global vector_store
+	if vector_store is None:
+		vector_store = VectorStore(host=CHROMADB_HOST, port=CHROMADB_PORT)
+	return vector_store
+
+
+def get_lexical_index(index_path):
+	"""The BM25 index saved at index_path, loaded once per process, or None if there is none"""
+	if not os.path.exists(index_path):
+		return None
+	mtime = os.path.getmtime(index_path)
+	cached = lexical_indexes.get(index_path)
+	if cached is None or cached[0] != mtime:
+		cached = lexical_indexes[index_path] = (mtime, BM25Index.load(index_path))
+	return cached[1]
+
 
 # book_mappings = {
 # 	"Cheese and its economical uses in the diet": {"author":"C. F. Langworthy and Caroline Louisa Hunt", "year": 2023},
@@ -122,31 +177,62 @@ book_mappings = {
 
 
 def generate_query_embedding(query):
-	query_embedding_inputs = [TextEmbeddingInput(task_type='RETRIEVAL_DOCUMENT', text=query)]
-	kwargs = dict(output_dimensionality=EMBEDDING_DIMENSION) if EMBEDDING_DIMENSION else {}
-	embeddings = embedding_model.get_embeddings(query_embedding_inputs, **kwargs)
-	return embeddings[0].values
+	return get_embedding().embed_query(query)
+
+
+def generate_query_embeddings(queries):
+	return get_embedding().embed_queries(queries)
+
 
+def generate_text_embeddings(chunks, dimensionality: int = EMBEDDING_DIMENSION, batch_size=None):
+	provider = get_embedding()
+	if dimensionality and dimensionality != provider.dimension:
+		raise ValueError(f"Embedding provider produces {provider.dimension} dimensions, not {dimensionality}")
+	# The provider packs requests up to its item and token limits (250 texts, 20k tokens for Vertex AI)
+	return provider.embed_documents(chunks, batch_size=batch_size)
 
-def generate_text_embeddings(chunks, dimensionality: int = 256, batch_size=250):
-	# Max batch size is 250 for Vertex AI
-	all_embeddings = []
-	for i in range(0, len(chunks), batch_size):
-		batch = chunks[i:i+batch_size]
-		inputs = [TextEmbeddingInput(text, "RETRIEVAL_DOCUMENT") for text in batch]
-		kwargs = dict(output_dimensionality=dimensionality) if dimensionality else {}
-		embeddings = embedding_model.get_embeddings(inputs, **kwargs)
-		all_embeddings.extend([embedding.values for embedding in embeddings])
 
-	return all_embeddings
+def next_batch_size(batch_size, rows, payload_bytes, elapsed):
+	# Scale towards the target latency, by at most 2x per step to avoid oscillation
+	if elapsed > 0:
+		scale = min(max(LOAD_TARGET_BATCH_SECONDS / elapsed, 0.5), 2.0)
+		batch_size = int(batch_size * scale)
+	# Never exceed the request size limit
+	bytes_per_row = payload_bytes / max(rows, 1)
+	if bytes_per_row > 0:
+		batch_size = min(batch_size, int(LOAD_MAX_BATCH_BYTES / bytes_per_row))
+	return min(max(batch_size, LOAD_MIN_BATCH_SIZE), LOAD_MAX_BATCH_SIZE)
 
 
-def load_text_embeddings(df, collection, batch_size=500):
+def insert_batch(write, ids, documents, metadatas, embeddings, payload_bytes):
+	"""Insert one batch, retrying a failed request in halves. Returns rows, bytes, seconds and the largest batch inserted"""
+	start_time = time.perf_counter()
+	try:
+		write(
+			ids=ids,
+			documents=documents,
+			metadatas=metadatas,
+			embeddings=embeddings
+		)
+		return len(ids), payload_bytes, time.perf_counter() - start_time, len(ids)
+	except Exception as e:
+		if len(ids) <= LOAD_MIN_BATCH_SIZE:
+			raise
+		# Too large or timed out, rows already added are skipped by add and overwritten by upsert
+		print(f"Inserting {len(ids)} items failed ({e}), retrying in halves")
+	half = len(ids) // 2
+	half_bytes = payload_bytes * half // len(ids)
+	_, _, _, first = insert_batch(write, ids[:half], documents[:half], metadatas[:half], embeddings[:half], half_bytes)
+	_, _, _, second = insert_batch(write, ids[half:], documents[half:], metadatas[half:], embeddings[half:], payload_bytes - half_bytes)
+	return len(ids), payload_bytes, time.perf_counter() - start_time, min(first, second)
+
+
+def load_text_embeddings(df, collection, batch_size=500, max_workers=LOAD_MAX_WORKERS, upsert=False):
 	# Convert the 'book' column to string
 	df["book"] = df["book"].astype(str)
 
-	# Generate ids
-	df["id"] = df.index.astype(str)
+	# Generate ids, numbered by position in the book when known
+	df["id"] = (df["chunk_index"] if "chunk_index" in df.columns else df.index).astype(str)
 	
 	hashed_books = df["book"].apply(lambda x: hashlib.sha256(x.encode()).hexdigest()[:16])
 	df["id"] = hashed_books + "-" + df["id"]
@@ -158,32 +244,70 @@ def load_text_embeddings(df, collection, batch_size=500):
 		book_mapping = book_mappings[metadata["book"]]
 		metadata["author"] = book_mapping["author"]
 		metadata["year"] = book_mapping["year"]
+
+	# Pull the columns out once and slice plain lists per batch, no per-batch DataFrame copies
+	ids = df["id"].tolist()
+	documents = df["chunk"].tolist()
+	if "books" in df.columns:
+		# Deduplicated chunks record every book they appear in
+		metadatas = [{**metadata, "books": ",".join(books)} for books in df["books"]]
+	else:
+		metadatas = [metadata] * len(ids)
+	if "chunk_index" in df.columns:
+		metadatas = [{**row_metadata, "chunk_index": int(index)} for row_metadata, index in zip(metadatas, df["chunk_index"])]
+	embeddings = df["embedding"].tolist()
+	# Approximate request size per row: document text plus JSON-encoded floats
+	dimension = len(embeddings[0]) if embeddings else 0
+	row_bytes = [len(document.encode("utf-8")) + len(row_id) + dimension * 12 for row_id, document in zip(ids, documents)]
+
+	write = collection.upsert if upsert else collection.add
    
-	# Process data in batches
+	# Build the next batch while up to max_workers inserts are in flight
 	total_inserted = 0
-	for i in range(0, df.shape[0], batch_size):
-		# Create a copy of the batch and reset the index
-		batch = df.iloc[i:i+batch_size].copy().reset_index(drop=True)
-
-		ids = batch["id"].tolist()
-		documents = batch["chunk"].tolist() 
-		metadatas = [metadata for item in batch["book"].tolist()]
-		embeddings = batch["embedding"].tolist()
-
-		collection.add(
-			ids=ids,
-			documents=documents,
-			metadatas=metadatas,
-			embeddings=embeddings
-		)
-		total_inserted += len(batch)
-		print(f"Inserted {total_inserted} items...")
+	pending = set()
+
+	def collect(done):
+		nonlocal batch_size, total_inserted
+		for future in done:
+			rows, payload_bytes, elapsed, largest = future.result()
+			batch_size = next_batch_size(batch_size, rows, payload_bytes, elapsed)
+			if largest < rows:
+				# Part of the batch had to be retried, stay at the size that went through
+				batch_size = max(min(batch_size, largest), LOAD_MIN_BATCH_SIZE)
+			total_inserted += rows
+			print(f"Inserted {total_inserted} items...")
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		i = 0
+		while i < len(ids):
+			if len(pending) >= max_workers:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				collect(done)
+
+			end = min(i + batch_size, len(ids))
+			pending.add(executor.submit(
+				insert_batch,
+				write,
+				ids[i:end],
+				documents[i:end],
+				metadatas[i:end],
+				embeddings[i:end],
+				sum(row_bytes[i:end])
+			))
+			i = end
+
+		done, pending = wait(pending)
+		collect(done)
 
 	print(f"Finished inserting {total_inserted} items into collection '{collection.name}'")
+	# Cached agent tool results were retrieved before these rows, if the agent ran in this process
+	if "agent_tools" in sys.modules:
+		sys.modules["agent_tools"].tool_cache.invalidate()
 
 
 def chunk(method="char-split"):
 	print("chunk()")
+	import pandas as pd
 
 	# Make dataset folders
 	os.makedirs(OUTPUT_FOLDER, exist_ok=True)
@@ -206,6 +330,7 @@ def chunk(method="char-split"):
 			chunk_size = 350
 			chunk_overlap = 20
 			# Init the splitter
+			from langchain.text_splitter import CharacterTextSplitter
 			text_splitter = CharacterTextSplitter(chunk_size = chunk_size, chunk_overlap=chunk_overlap, separator='', strip_whitespace=False)
 
 			# Perform the splitting
@@ -216,6 +341,7 @@ def chunk(method="char-split"):
 		elif method == "recursive-split":
 			chunk_size = 350
 			# Init the splitter
+			from langchain.text_splitter import RecursiveCharacterTextSplitter
 			text_splitter = RecursiveCharacterTextSplitter(chunk_size = chunk_size)
 
 			# Perform the splitting
@@ -225,7 +351,9 @@ def chunk(method="char-split"):
 		
 		elif method == "semantic-split":
 			# Init the splitter
-			text_splitter = SemanticChunker(embedding_function=generate_text_embeddings)
+			#from langchain_experimental.text_splitter import SemanticChunker
+			from semantic_splitter import SemanticChunker
+			text_splitter = SemanticChunker(embedding_function=get_embedding().embed_documents)
 			# Perform the splitting
 			text_chunks = text_splitter.create_documents([input_text])
 			
@@ -236,6 +364,8 @@ def chunk(method="char-split"):
 			# Save the chunks
 			data_df = pd.DataFrame(text_chunks,columns=["chunk"])
 			data_df["book"] = book_name
+			# Position in the book, so neighbouring chunks can be merged back together at query time
+			data_df["chunk_index"] = range(len(data_df))
 			print("Shape:", data_df.shape)
 			print(data_df.head())
 
@@ -244,8 +374,50 @@ def chunk(method="char-split"):
 				json_file.write(data_df.to_json(orient='records', lines=True))
 
 
+def dedup(method="char-split", threshold=DEDUP_THRESHOLD):
+	print("dedup()")
+	import pandas as pd
+
+	# Get the list of chunk files
+	jsonl_files = sorted(glob.glob(os.path.join(OUTPUT_FOLDER, f"chunks-{method}-*.jsonl")))
+	print("Number of files to process:", len(jsonl_files))
+
+	# Deduplicate across all books, so shared boilerplate is embedded once
+	records = []
+	columns = ["chunk", "book"]
+	for jsonl_file in jsonl_files:
+		data_df = pd.read_json(jsonl_file, lines=True, dtype={"book": str})
+		if data_df.empty:
+			continue
+		columns = [column for column in ("chunk", "book", "chunk_index") if column in data_df.columns]
+		# Files deduplicated by an earlier run carry their "books", which are merged rather than reset
+		records.extend(data_df[[*columns, "books"] if "books" in data_df.columns else columns].to_dict(orient="records"))
+
+	kept, stats = deduplicate(records, threshold=threshold)
+	stats["threshold"] = threshold
+	print(f"Removed {stats['removed']} of {stats['input']} chunks "
+		f"({stats['exact_duplicates']} exact, {stats['near_duplicates']} near-duplicate)")
+
+	# Rewrite each book's chunk file with the chunks it kept
+	kept_df = pd.DataFrame(kept, columns=[*columns, "books"])
+	stats["empty_books"] = []
+	for jsonl_file in jsonl_files:
+		book_name = os.path.basename(jsonl_file)[len(f"chunks-{method}-"):-len(".jsonl")]
+		data_df = kept_df[kept_df["book"] == book_name].reset_index(drop=True)
+		if data_df.empty:
+			# Every chunk of this book is also in an earlier one, keep the file so a rerun still sees the book
+			stats["empty_books"].append(book_name)
+		with open(jsonl_file, "w") as json_file:
+			json_file.write(data_df.to_json(orient='records', lines=True) if not data_df.empty else "")
+
+	# Save the report
+	with open(os.path.join(OUTPUT_FOLDER, f"dedup-{method}.json"), "w") as json_file:
+		json.dump(stats, json_file, indent=2)
+
+
 def embed(method="char-split"):
 	print("embed()")
+	import pandas as pd
 
 	# Get the list of chunk files
 	jsonl_files = glob.glob(os.path.join(OUTPUT_FOLDER, f"chunks-{method}-*.jsonl"))
@@ -258,12 +430,12 @@ def embed(method="char-split"):
 		data_df = pd.read_json(jsonl_file, lines=True)
 		print("Shape:", data_df.shape)
 		print(data_df.head())
+		if data_df.empty:
+			# All of this book's chunks were removed by dedup
+			continue
 
 		chunks = data_df["chunk"].values
-		if method == "semantic-split":
-			embeddings = generate_text_embeddings(chunks,EMBEDDING_DIMENSION, batch_size=15)
-		else:
-			embeddings = generate_text_embeddings(chunks,EMBEDDING_DIMENSION, batch_size=100)
+		embeddings = generate_text_embeddings(chunks,EMBEDDING_DIMENSION)
 		data_df["embedding"] = embeddings
 
 		# Save 
@@ -275,11 +447,12 @@ def embed(method="char-split"):
 			json_file.write(data_df.to_json(orient='records', lines=True))
 
 
-def load(method="char-split"):
+def load(method="char-split", output_folder=OUTPUT_FOLDER):
 	print("load()")
+	import pandas as pd
 
 	# Connect to chroma DB
-	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+	store = get_vector_store()
 
 	# Get a collection object from an existing collection, by name. If it doesn't exist, create it.
 	collection_name = f"{method}-collection"
@@ -287,20 +460,26 @@ def load(method="char-split"):
 
 	try:
 		# Clear out any existing items in the collection
-		client.delete_collection(name=collection_name)
+		store.delete_collection(name=collection_name)
 		print(f"Deleted existing collection '{collection_name}'")
 	except Exception:
 		print(f"Collection '{collection_name}' did not exist. Creating new.")
 
 	# collection = client.create_collection(name=collection_name, metadata={"hnsw:space": "cosine"})
-	collection = client.create_collection(name=collection_name)
+	collection = store.create_collection(name=collection_name)
 	print(f"Created new empty collection '{collection_name}'")
+	# Cached agent tool results refer to the old collection, if the agent ran in this process
+	if "agent_tools" in sys.modules:
+		sys.modules["agent_tools"].tool_cache.invalidate()
 	print("Collection:", collection)
 
 	# Get the list of embedding files
-	jsonl_files = glob.glob(os.path.join(OUTPUT_FOLDER, f"embeddings-{method}-*.jsonl"))
+	jsonl_files = glob.glob(os.path.join(output_folder, f"embeddings-{method}-*.jsonl"))
 	print("Number of files to process:", len(jsonl_files))
 
+	# Lexical index over the same chunk IDs
+	lexical_index = BM25Index()
+
 	# Process
 	for jsonl_file in jsonl_files:
 		print("Processing file:", jsonl_file)
@@ -311,14 +490,17 @@ def load(method="char-split"):
 
 		# Load data
 		load_text_embeddings(data_df, collection)
+		lexical_index.add(data_df["id"].tolist(), data_df["chunk"].tolist())
+
+	# Save the lexical index next to the embeddings
+	index_path = os.path.join(output_folder, f"bm25-{method}.json.gz")
+	lexical_index.save(index_path)
+	print(f"Saved lexical index with {len(lexical_index)} chunks to {index_path}")
 
 
 def query(method="char-split"):
 	print("load()")
 
-	# Connect to chroma DB
-	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-
 	# Get a collection object from an existing collection, by name. If it doesn't exist, create it.
 	collection_name = f"{method}-collection"
 
@@ -327,7 +509,7 @@ def query(method="char-split"):
 	print("Embedding values:", query_embedding)
 
 	# Get the collection
-	collection = client.get_collection(name=collection_name)
+	collection = get_vector_store().collection(collection_name)
 
 	# 1: Query based on embedding value 
 	results = collection.query(
@@ -346,22 +528,33 @@ def query(method="char-split"):
 	print("Query:", query)
 	print("\n\nResults:", results)
 
-	# 3: Query based on embedding value + lexical search filter
+	# 3: Query based on embedding value + lexical search filter (posting lists instead of a document scan)
+	# Collections loaded before the lexical index existed have no index file, filter in chroma DB instead
+	index_path = os.path.join(OUTPUT_FOLDER, f"bm25-{method}.json.gz")
+	lexical_index = get_lexical_index(index_path)
 	search_string = "Italian"
-	results = collection.query(
-		query_embeddings=[query_embedding],
-		n_results=10,
-		where_document={"$contains": search_string}
-	)
+	if lexical_index is not None:
+		results = filtered_query(collection, lexical_index, search_string, query_embedding, n_results=10)
+	else:
+		print(f"No lexical index at {index_path}, run --load to build it")
+		results = collection.query(
+			query_embeddings=[query_embedding],
+			n_results=10,
+			where_document={"$contains": search_string}
+		)
 	print("Query:", query)
 	print("\n\nResults:", results)
 
+	# 4: Hybrid query, dense and BM25 results fused with reciprocal rank fusion
+	if lexical_index is not None:
+		results = hybrid_query(collection, lexical_index, query, query_embedding, n_results=10)
+		print("Query:", query)
+		print("\n\nResults:", results)
+
 
 def chat(method="char-split"):
 	print("chat()")
 
-	# Connect to chroma DB
-	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 	# Get a collection object from an existing collection, by name. If it doesn't exist, create it.
 	collection_name = f"{method}-collection"
 
@@ -370,7 +563,7 @@ def chat(method="char-split"):
 	print("Query:", query)
 	print("Embedding values:", query_embedding)
 	# Get the collection
-	collection = client.get_collection(name=collection_name)
+	collection = get_vector_store().collection(collection_name)
 
 	# Query based on embedding value 
 	results = collection.query(
@@ -379,15 +572,18 @@ def chat(method="char-split"):
 	)
 	print("\n\nResults:", results)
 
-	print(len(results["documents"][0]))
+	# Close matches only, neighbouring chunks merged, within the token budget
+	context = build_context(results, token_budget=CHAT_CONTEXT_TOKENS)
+	print(f"Context: {len(context['ids'])} of {len(results['documents'][0])} chunks in {len(context['passages'])} passages, "
+		f"~{context['tokens']} tokens ({context['dropped']} too distant, {context['over_budget']} over budget)")
 
 	INPUT_PROMPT = f"""
 	{query}
-	{"\n".join(results["documents"][0])}
+	{context["text"]}
 	"""
 
 	print("INPUT_PROMPT: ",INPUT_PROMPT)
-	response = generative_model.generate_content(
+	response = get_generative_model().generate_content(
 		[INPUT_PROMPT],  # Input prompt
 		generation_config=generation_config,  # Configuration settings
 		stream=False,  # Enable streaming for responses
@@ -399,13 +595,11 @@ def chat(method="char-split"):
 def get(method="char-split"):
 	print("get()")
 
-	# Connect to chroma DB
-	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 	# Get a collection object from an existing collection, by name. If it doesn't exist, create it.
 	collection_name = f"{method}-collection"
 
 	# Get the collection
-	collection = client.get_collection(name=collection_name)
+	collection = get_vector_store().collection(collection_name)
 
 	# Get documents with filters
 	results = collection.get(
@@ -417,13 +611,14 @@ def get(method="char-split"):
 
 def agent(method="char-split"):
 	print("agent()")
+	import agent_tools
+	from vertexai.generative_models import GenerationConfig, Content, Part, ToolConfig
+	generative_model = get_generative_model()
 
-	# Connect to chroma DB
-	client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
 	# Get a collection object from an existing collection, by name. If it doesn't exist, create it.
 	collection_name = f"{method}-collection"
 	# Get the collection
-	collection = client.get_collection(name=collection_name)
+	collection = get_vector_store().collection(collection_name)
 
 	# User prompt
 	user_prompt_content = Content(
@@ -450,7 +645,8 @@ def agent(method="char-split"):
 	# Step 2: Execute the function and send chunks back to LLM to answer get the final response
 	function_calls = response.candidates[0].function_calls
 	print("Function calls:")
-	function_responses = agent_tools.execute_function_calls(function_calls,collection,embed_func=generate_query_embedding)
+	function_responses = agent_tools.execute_function_calls(function_calls,collection,embed_func=generate_query_embedding,batch_embed_func=generate_query_embeddings)
+	print("Tool cache:", agent_tools.tool_cache.stats())
 	if len(function_responses) == 0:
 		print("Function calls did not result in any responses...")
 	else:
@@ -471,26 +667,46 @@ def agent(method="char-split"):
 def main(args=None):
 	print("CLI Arguments:", args)
 
+	# Optional per-stage profiling, written to outputs/profiles
+	profiler = None
+	if args.profile or args.profile_memory:
+		profiler = StageProfiler(cpu=args.profile, memory=args.profile_memory)
+	stage = profiler.stage if profiler else lambda name: contextlib.nullcontext()
+
 	if args.chunk:
-		chunk(method=args.chunk_type)
+		with stage("chunk"):
+			chunk(method=args.chunk_type)
+
+	if args.dedup:
+		with stage("dedup"):
+			dedup(method=args.chunk_type, threshold=args.dedup_threshold)
 
 	if args.embed:
-		embed(method=args.chunk_type)
+		with stage("embed"):
+			embed(method=args.chunk_type)
 
 	if args.load:
-		load(method=args.chunk_type)
+		with stage("load"):
+			load(method=args.chunk_type)
 
 	if args.query:
-		query(method=args.chunk_type)
+		with stage("query"):
+			query(method=args.chunk_type)
 	
 	if args.chat:
-		chat(method=args.chunk_type)
+		with stage("chat"):
+			chat(method=args.chunk_type)
 	
 	if args.get:
-		get(method=args.chunk_type)
+		with stage("get"):
+			get(method=args.chunk_type)
 	
 	if args.agent:
-		agent(method=args.chunk_type)
+		with stage("agent"):
+			agent(method=args.chunk_type)
+
+	if profiler:
+		profiler.report()
 
 
 if __name__ == "__main__":
@@ -503,6 +719,12 @@ if __name__ == "__main__":
 		action="store_true",
 		help="Chunk text",
 	)
+	parser.add_argument(
+		"--dedup",
+		action="store_true",
+		help="Remove exact and near-duplicate chunks",
+	)
+	parser.add_argument("--dedup_threshold", type=float, default=DEDUP_THRESHOLD, help="Jaccard similarity for near-duplicates")
 	parser.add_argument(
 		"--embed",
 		action="store_true",
@@ -534,6 +756,16 @@ if __name__ == "__main__":
 		help="Chat with LLM Agent",
 	)
 	parser.add_argument("--chunk_type", default="char-split", help="char-split | recursive-split | semantic-split")
+	parser.add_argument(
+		"--profile",
+		action="store_true",
+		help="Record CPU profiles and network/CPU time per stage",
+	)
+	parser.add_argument(
+		"--profile-memory",
+		action="store_true",
+		help="Record tracemalloc peak and top allocators per stage",
+	)
 
 	args = parser.parse_args()
 
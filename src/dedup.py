@@ -0,0 +1,161 @@
+"""Exact and near-duplicate chunk elimination with MinHash/LSH"""
+
+import re
+import hashlib
+import zlib
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+
+# Mersenne prime used for the MinHash permutations
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase and collapse whitespace so trivially different copies hash the same"""
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def shingles(text: str, size: int = 3) -> Set[int]:
+    """
+    Hash the word n-grams of a normalized text.
+
+    Args:
+        text: Normalized text
+        size: Number of words per shingle
+
+    Returns:
+        Set of 32-bit shingle hashes
+    """
+    words = text.split(" ")
+    if len(words) < size:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {
+        zlib.crc32(" ".join(words[i:i + size]).encode("utf-8"))
+        for i in range(len(words) - size + 1)
+    }
+
+
+def jaccard(a: Set[int], b: Set[int]) -> float:
+    """Jaccard similarity of two shingle sets"""
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Pick the number of bands and rows per band for a Jaccard threshold.
+
+    Returns:
+        Tuple of (bands, rows)
+    """
+    # The LSH S-curve crosses 0.5 near (1/bands)^(1/rows), use the split closest to the threshold
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    """Compute MinHash signatures with a fixed set of random permutations"""
+
+    def __init__(self, num_perm: int = 128, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        # a*h + b stays below 2**63 for 32-bit h, so uint64 arithmetic cannot overflow
+        self.a = rng.randint(1, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, shingle_set: Set[int]) -> np.ndarray:
+        hashes = np.fromiter(shingle_set, dtype=np.uint64, count=len(shingle_set))
+        permuted = (np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+def deduplicate(
+    records: List[Dict],
+    threshold: float = 0.9,
+    num_perm: int = 128,
+    shingle_size: int = 3,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Remove exact and near-duplicate chunks, keeping the first occurrence of each.
+
+    Args:
+        records: Dicts with "chunk" and "book" keys, and "books" if already deduplicated
+        threshold: Jaccard similarity at or above which two chunks are duplicates
+        num_perm: Number of MinHash permutations
+        shingle_size: Number of words per shingle
+
+    Returns:
+        Tuple of the kept records, each with the "books" of all its copies, and a stats dict
+    """
+    bands, rows = lsh_params(threshold, num_perm)
+    hasher = MinHasher(num_perm=num_perm)
+
+    kept: List[Dict] = []
+    kept_shingles: List[Set[int]] = []
+    exact_index: Dict[str, int] = {}
+    buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+    stats = {"input": len(records), "exact_duplicates": 0, "near_duplicates": 0}
+
+    for record in records:
+        text = normalize_text(record["chunk"])
+        # A record from an earlier run already names the books its duplicates came from
+        books = _record_books(record)
+
+        # Exact duplicates
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if digest in exact_index:
+            _add_books(kept[exact_index[digest]], books)
+            stats["exact_duplicates"] += 1
+            continue
+
+        # Near duplicates: candidates share at least one LSH band
+        shingle_set = shingles(text, shingle_size)
+        signature = hasher.signature(shingle_set)
+        band_keys = [signature[i * rows:(i + 1) * rows].tobytes() for i in range(bands)]
+        candidates = set()
+        for band, key in zip(buckets, band_keys):
+            candidates.update(band.get(key, ()))
+        match = next(
+            (index for index in sorted(candidates) if jaccard(shingle_set, kept_shingles[index]) >= threshold),
+            None,
+        )
+        if match is not None:
+            _add_books(kept[match], books)
+            exact_index[digest] = match
+            stats["near_duplicates"] += 1
+            continue
+
+        index = len(kept)
+        kept.append({**record, "books": books})
+        kept_shingles.append(shingle_set)
+        exact_index[digest] = index
+        for band, key in zip(buckets, band_keys):
+            band.setdefault(key, []).append(index)
+
+    stats["kept"] = len(kept)
+    stats["removed"] = stats["input"] - stats["kept"]
+    return kept, stats
+
+
+def _record_books(record: Dict) -> List[str]:
+    books = [str(record["book"])]
+    previous = record.get("books")
+    if isinstance(previous, (list, tuple, np.ndarray)):
+        books += [str(book) for book in previous if str(book) not in books]
+    return books
+
+
+def _add_books(record: Dict, books: List[str]) -> None:
+    for book in books:
+        if book not in record["books"]:
+            record["books"].append(book)
@@ -0,0 +1,337 @@
+"""
+Load tests for the FastAPI chat service.
+
+Simulated clinicians start chats, continue them and list their history against
+the app from service.py, served in-process with stand-in LLM, embedding and
+vector store backends. Every backend latency is a distribution, so saturation
+of the event loop, the chat session dict and chat history file I/O shows up
+without any cloud calls.
+
+    python load_test.py --concurrency 1,8,32 --duration 30 --llm_latency lognormal:800,0.4
+    python load_test.py --url http://localhost:9000 --concurrency 8
+"""
+import os
+import sys
+import json
+import time
+import types
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from stand_ins import FakeEmbeddingModel, FakeGenerativeModel, InMemoryChromaClient, Latency, deterministic_vector
+
+SRC_FOLDER = os.path.dirname(os.path.abspath(__file__))
+LOAD_TEST_FOLDER = os.path.join("outputs", "load-tests")
+ENDPOINTS = ("start_chat", "continue_chat", "list_chats")
+COLLECTION_NAME = "recursive-split-collection"
+CORPUS_CHUNKS = 2000
+EMBEDDING_DIMENSION = 256
+# Latency histogram bucket upper bounds in ms, log spaced
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+LOOP_LAG_INTERVAL = 0.01  # Seconds between event loop lag probes
+QUESTIONS = [
+    "What is the first-line chemotherapy for metastatic pancreatic cancer?",
+    "How should malignant ascites be managed?",
+    "What are the signs of bowel obstruction?",
+    "When is capecitabine contraindicated?",
+    "How is cancer pain assessed in palliative care?",
+]
+
+
+def sample_image(edge: int = 1024, seed: int = 0) -> str:
+    """A noisy PNG data URL, roughly the size of a phone photo after the client resizes it"""
+    from PIL import Image
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(edge, edge, 3), dtype=np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def seed_collection(client: InMemoryChromaClient, chunks: int = CORPUS_CHUNKS, dimension: int = EMBEDDING_DIMENSION) -> None:
+    """Fill the stand-in vector store with synthetic chunks"""
+    collection = client.get_or_create_collection(COLLECTION_NAME)
+    documents = [f"Synthetic chunk {i} about {QUESTIONS[i % len(QUESTIONS)].lower()}" for i in range(chunks)]
+    collection.add(
+        ids=[f"chunk-{i}" for i in range(chunks)],
+        documents=documents,
+        metadatas=[{"book": str(i % 10)} for i in range(chunks)],
+        embeddings=[deterministic_vector(document, dimension) for document in documents],
+    )
+
+
+def import_service(llm_latency="none", embedding_latency="none", vector_store_latency="none", chunks=CORPUS_CHUNKS):
+    """
+    Import service.py with stand-in backends.
+
+    The service imports itself as the "api" package like in the container, so
+    that package is aliased to this folder. Run from a scratch working directory,
+    chat history and the image cache are written relative to it.
+
+    Returns:
+        The FastAPI app and a dict of the stand-ins, for their counters
+    """
+    if "api" not in sys.modules:
+        api = types.ModuleType("api")
+        api.__path__ = [SRC_FOLDER]
+        sys.modules["api"] = api
+    os.environ.setdefault("GCP_PROJECT", "load-test")
+    os.environ.setdefault("CHROMADB_HOST", "localhost")
+    os.environ.setdefault("CHROMADB_PORT", "8000")
+
+    generative_model = FakeGenerativeModel(latency=llm_latency)
+    embedding_model = FakeEmbeddingModel(dimension=EMBEDDING_DIMENSION, latency=embedding_latency)
+    vector_store = InMemoryChromaClient(latency=vector_store_latency)
+    seed_collection(vector_store, chunks=chunks)
+
+    # Clients are created lazily, so setting them before the first request is enough
+    from api import service
+    from api.utils import llm_rag_utils
+    from api.utils.embedding_providers import VertexEmbeddingProvider
+    from api.utils.vector_store import VectorStore
+    llm_rag_utils.generative_model = generative_model
+    llm_rag_utils.embedding_provider = VertexEmbeddingProvider(dimension=EMBEDDING_DIMENSION, model=embedding_model)
+    llm_rag_utils.vector_store = VectorStore(client=vector_store)
+    backends = {
+        "llm": generative_model,
+        "embedding": embedding_model,
+        "vector_store": vector_store,
+        "chat_sessions": llm_rag_utils.chat_sessions,
+    }
+    return service.app, backends
+
+
+class Recorder:
+    """Latencies and status codes per endpoint"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {endpoint: [] for endpoint in ENDPOINTS}
+        self.statuses: Dict[str, Dict[int, int]] = {endpoint: {} for endpoint in ENDPOINTS}
+        self.loop_lag: List[float] = []
+
+    def record(self, endpoint: str, seconds: float, status: int) -> None:
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] = self.statuses[endpoint].get(status, 0) + 1
+
+
+def histogram(latencies: List[float], buckets=HISTOGRAM_BUCKETS) -> Dict[str, int]:
+    """Count latencies (seconds) into ms buckets keyed by their upper bound"""
+    counts = {f"<={bound}ms": 0 for bound in buckets}
+    counts[f">{buckets[-1]}ms"] = 0
+    for latency in latencies:
+        ms = latency * 1000
+        bound = next((bound for bound in buckets if ms <= bound), None)
+        counts[f"<={bound}ms" if bound is not None else f">{buckets[-1]}ms"] += 1
+    return counts
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    """Throughput and latency percentiles, in ms"""
+    if not latencies:
+        return {"requests": 0, "throughput_rps": 0.0}
+    values = np.asarray(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+
+async def monitor_loop_lag(recorder: Recorder, stop: asyncio.Event) -> None:
+    """Measure how late the event loop wakes up, blocking handlers show up as lag"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        recorder.loop_lag.append(max(time.perf_counter() - start - LOOP_LAG_INTERVAL, 0.0))
+
+
+async def timed_request(client: httpx.AsyncClient, recorder: Recorder, endpoint: str, method: str, url: str, **kwargs) -> Optional[Dict]:
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        status = response.status_code
+    except httpx.HTTPError:
+        response, status = None, 0
+    recorder.record(endpoint, time.perf_counter() - start, status)
+    if response is None or status != 200:
+        return None
+    return response.json()
+
+
+async def clinician(user: int, client: httpx.AsyncClient, recorder: Recorder, deadline: float, think_time: Latency,
+                    image_ratio: float, new_chat_ratio: float, list_ratio: float, image: str, seed: int = 0) -> None:
+    """One simulated user: start a chat, then keep asking follow-ups, listing chats now and then"""
+    rng = random.Random(seed + user)
+    headers = {"X-Session-ID": f"load-test-{user}"}
+    chat_id = None
+    while time.perf_counter() < deadline:
+        message = {"content": rng.choice(QUESTIONS)}
+        if rng.random() < image_ratio:
+            message["image"] = image
+        if chat_id is None or rng.random() < new_chat_ratio:
+            chat = await timed_request(client, recorder, "start_chat", "POST", "/llm-rag/chats", json=message, headers=headers)
+            chat_id = chat["chat_id"] if chat else None
+        else:
+            await timed_request(client, recorder, "continue_chat", "POST", f"/llm-rag/chats/{chat_id}", json=message, headers=headers)
+        if rng.random() < list_ratio:
+            await timed_request(client, recorder, "list_chats", "GET", "/llm-rag/chats", params={"limit": 20}, headers=headers)
+        delay = think_time.sample()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+async def run_load(client: httpx.AsyncClient, concurrency: int, duration: float, think_time: str = "none",
+                   image_ratio: float = 0.1, new_chat_ratio: float = 0.2, list_ratio: float = 0.3, image: Optional[str] = None) -> Dict:
+    """
+    Drive the chat endpoints with concurrency simulated users for duration seconds.
+
+    Returns:
+        dict: Throughput, latency percentiles and histograms per endpoint, plus event loop lag
+    """
+    recorder = Recorder()
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(recorder, stop))
+    image = image or (sample_image() if image_ratio > 0 else "")
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*[
+        clinician(user, client, recorder, deadline, Latency(think_time, seed=user), image_ratio, new_chat_ratio, list_ratio, image)
+        for user in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await lag_task
+
+    all_latencies = [latency for latencies in recorder.latencies.values() for latency in latencies]
+    endpoints = {
+        endpoint: {
+            **summarize(latencies, elapsed),
+            "statuses": {str(status): count for status, count in recorder.statuses[endpoint].items()},
+            "histogram": histogram(latencies),
+        }
+        for endpoint, latencies in recorder.latencies.items()
+    }
+    errors = sum(count for statuses in recorder.statuses.values() for status, count in statuses.items() if status != 200)
+    return {
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "total": {**summarize(all_latencies, elapsed), "errors": errors, "histogram": histogram(all_latencies)},
+        "endpoints": endpoints,
+        "loop_lag": summarize(recorder.loop_lag, elapsed),
+    }
+
+
+def print_report(result: Dict) -> None:
+    total = result["total"]
+    print(f"Concurrency {result['concurrency']}: {total['requests']} requests in {result['elapsed_s']}s, "
+          f"{total['throughput_rps']} req/s, {total['errors']} errors")
+    print(f"  {'endpoint':<14} {'requests':>8} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for endpoint, stats in [*result["endpoints"].items(), ("all", total)]:
+        if stats["requests"]:
+            print(f"  {endpoint:<14} {stats['requests']:>8} {stats['throughput_rps']:>8} "
+                  f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    lag = result["loop_lag"]
+    if lag["requests"]:
+        print(f"  event loop lag  p50 {lag['p50_ms']} ms  p99 {lag['p99_ms']} ms  max {lag['max_ms']} ms")
+    peak = max(total["histogram"].values()) or 1
+    for bucket, count in total["histogram"].items():
+        if count:
+            print(f"  {bucket:>10} {count:>7} {'#' * max(1, round(40 * count / peak))}")
+    if "backends" in result:
+        print(f"  backends: {result['backends']}")
+
+
+async def load_test(args, app=None, backends: Optional[Dict] = None) -> List[Dict]:
+    """Run one load test per concurrency level, against args.url or the in-process app"""
+    results = []
+    if app is not None:
+        # The in-process app has no lifespan, size its threadpool like the service does
+        from api import service
+        service.configure_threadpool()
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        if app is None:
+            client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        else:
+            client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load-test", timeout=args.timeout)
+        if backends:
+            sessions_before = len(backends["chat_sessions"])
+            llm_before = backends["llm"].counters.snapshot()["calls"]
+            embedding_before = backends["embedding"].counters.snapshot()
+            vector_store_before = backends["vector_store"].get_collection(COLLECTION_NAME).counters.snapshot()["calls"]
+        async with client:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = await run_load(
+                    client,
+                    concurrency=concurrency,
+                    duration=args.duration,
+                    think_time=args.think_time,
+                    image_ratio=args.image_ratio,
+                    new_chat_ratio=args.new_chat_ratio,
+                    list_ratio=args.list_ratio,
+                )
+        if backends:
+            result["backends"] = {
+                "llm_calls": backends["llm"].counters.snapshot()["calls"] - llm_before,
+                "embedding_calls": backends["embedding"].counters.snapshot()["calls"] - embedding_before["calls"],
+                "embedded_texts": backends["embedding"].counters.snapshot()["items"] - embedding_before["items"],
+                "vector_store_calls": backends["vector_store"].get_collection(COLLECTION_NAME).counters.snapshot()["calls"] - vector_store_before,
+                "new_chat_sessions": len(backends["chat_sessions"]) - sessions_before,
+                "chat_sessions": len(backends["chat_sessions"]),
+            }
+        print_report(result)
+        results.append(result)
+    return results
+
+
+def main(args=None):
+    app, backends, workdir = None, None, None
+    output_folder = os.path.abspath(LOAD_TEST_FOLDER)
+    if not args.url:
+        # Chat history and the image cache go to a scratch folder unless one is given
+        workdir = args.workdir or tempfile.mkdtemp(prefix="load-test-")
+        os.makedirs(workdir, exist_ok=True)
+        os.chdir(workdir)
+        app, backends = import_service(args.llm_latency, args.embedding_latency, args.vector_store_latency)
+        # The in-process app has no lifespan, warm up like a deployment does before it is marked ready
+        from api import service
+        service.run_warm_up()
+
+    results = asyncio.run(load_test(args, app=app, backends=backends))
+
+    output = args.output or os.path.join(output_folder, f"load-test-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"config": vars(args), "workdir": workdir, "results": results}, f, indent=2)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the chat API")
+    parser.add_argument("--url", help="Load test a running server instead of the in-process app with stand-ins")
+    parser.add_argument("--concurrency", default="8", help="Comma separated numbers of simulated users, one run each")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per run")
+    parser.add_argument("--think_time", default="lognormal:1000,0.5", help="Pause between a user's requests, e.g. fixed:500 (ms)")
+    parser.add_argument("--image_ratio", type=float, default=0.1, help="Fraction of messages carrying an image")
+    parser.add_argument("--new_chat_ratio", type=float, default=0.2, help="Fraction of messages that start a new chat")
+    parser.add_argument("--list_ratio", type=float, default=0.3, help="Chance of listing chats after each message")
+    parser.add_argument("--llm_latency", default="lognormal:800,0.4", help="Stand-in LLM latency (ms)")
+    parser.add_argument("--embedding_latency", default="lognormal:60,0.3", help="Stand-in embedding latency (ms)")
+    parser.add_argument("--vector_store_latency", default="lognormal:15,0.3", help="Stand-in vector store latency (ms)")
+    parser.add_argument("--timeout", type=float, default=120, help="Per request timeout in seconds")
+    parser.add_argument("--workdir", help="Working directory for chat history, defaults to a temporary folder")
+    parser.add_argument("--output", help="Results file, defaults to outputs/load-tests/load-test-<time>.json")
+
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+"""
+Per-stage profiling for cli.py.
+
+Each stage gets a cProfile dump (main thread, or every thread on Python 3.12+),
+a sampled collapsed-stack profile of every thread (for flamegraph.pl or
+speedscope), a wall versus CPU split with samples classified as network wait,
+CPU or idle, and optionally the tracemalloc peak and top allocators.
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+PROFILE_FOLDER = os.path.join("outputs", "profiles")
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+TOP_FUNCTIONS = 15
+TOP_ALLOCATORS = 10
+# Samples with any of these modules on the stack are waiting on the network
+NETWORK_MODULES = ("socket", "ssl", "selectors", "http", "urllib3", "requests", "httpx", "httpcore", "grpc", "google", "chromadb")
+# Leaf frames that mean a thread is parked, e.g. idle pool workers
+IDLE_FRAMES = {("threading", "wait"), ("threading", "_wait_for_tstate_lock"), ("queue", "get"), ("thread", "_worker"), ("stand_ins", "wait")}
+# Blocking primitives left out of the top functions, since cProfile also sees waiting threads on 3.12+
+WAIT_FILES = {"threading.py", "queue.py", "profiling.py"}
+WAIT_FUNCTIONS = {"<method 'acquire' of '_thread.lock' objects>", "<method 'acquire' of '_thread.RLock' objects>", "<built-in method time.sleep>"}
+
+
+def _module_name(frame) -> str:
+    return frame.f_globals.get("__name__", "") or ""
+
+
+def classify_stack(frames: List) -> str:
+    """Classify a stack (outermost frame first) as "network", "idle" or "cpu" """
+    leaf = frames[-1]
+    if (_module_name(leaf).rsplit(".", 1)[-1], leaf.f_code.co_name) in IDLE_FRAMES:
+        return "idle"
+    for frame in frames:
+        if _module_name(frame).split(".", 1)[0] in NETWORK_MODULES:
+            return "network"
+    return "cpu"
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Sample every thread's Python stack on an interval, from a background thread"""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.states: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                if not frames:
+                    continue
+                frames.reverse()
+                state = classify_stack(frames)
+                self.states[state] += 1
+                if state != "idle":
+                    thread_name = names.get(thread_id, str(thread_id))
+                    self.stacks[";".join([thread_name] + [frame_label(frame) for frame in frames])] += 1
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def write_collapsed(self, path: str) -> None:
+        """Write stacks in the collapsed format read by flamegraph.pl and speedscope"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class StageProfiler:
+    """
+    Profile named stages and write the results to output_folder.
+
+    Args:
+        cpu: Record cProfile and sampled stack profiles
+        memory: Record tracemalloc peak and top allocators
+    """
+
+    def __init__(self, cpu: bool = True, memory: bool = False, output_folder: str = PROFILE_FOLDER, sample_interval: float = SAMPLE_INTERVAL):
+        self.cpu = cpu
+        self.memory = memory
+        self.output_folder = output_folder
+        self.sample_interval = sample_interval
+        self.run_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.stages: Dict[str, Dict] = {}
+        os.makedirs(output_folder, exist_ok=True)
+
+    def _path(self, stage: str, suffix: str) -> str:
+        return os.path.join(self.output_folder, f"{self.run_id}-{stage}{suffix}")
+
+    @contextmanager
+    def stage(self, name: str):
+        profiler = cProfile.Profile() if self.cpu else None
+        sampler = StackSampler(self.sample_interval)
+        if self.memory:
+            # One frame per allocation is enough to rank by line, more slows every allocation down
+            tracemalloc.start(1)
+            tracemalloc.reset_peak()
+        sampler.start()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            sampler.stop()
+            result = {
+                "wall_s": round(wall, 3),
+                "cpu_s": round(cpu, 3),
+                # Process CPU time counts every thread, so this is a lower bound on waiting
+                "wait_s": round(max(wall - cpu, 0.0), 3),
+                "samples": dict(sampler.states),
+                "files": {},
+            }
+            sampled = sum(sampler.states.values())
+            if sampled:
+                result["network_share"] = round(sampler.states["network"] / sampled, 3)
+                result["cpu_share"] = round(sampler.states["cpu"] / sampled, 3)
+
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                top = snapshot.statistics("lineno")[:TOP_ALLOCATORS]
+                result["memory_peak_mb"] = round(peak / 1024 ** 2, 2)
+                result["memory_current_mb"] = round(current / 1024 ** 2, 2)
+                result["top_allocators"] = [
+                    {"location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "size_mb": round(stat.size / 1024 ** 2, 3), "count": stat.count}
+                    for stat in top
+                ]
+                path = self._path(name, "-memory.txt")
+                with open(path, "w") as f:
+                    f.write(f"Peak {result['memory_peak_mb']} MB, still allocated {result['memory_current_mb']} MB\n")
+                    for stat in top:
+                        f.write(f"{stat}\n")
+                result["files"]["memory"] = path
+
+            if profiler:
+                path = self._path(name, ".prof")
+                profiler.dump_stats(path)
+                result["files"]["pstats"] = path
+                stats = pstats.Stats(profiler)
+                functions = [
+                    (func, calls, cumulative) for func, (_, calls, _, cumulative, _) in stats.stats.items()
+                    if os.path.basename(func[0]) not in WAIT_FILES and func[2] not in WAIT_FUNCTIONS
+                ]
+                result["top_functions"] = [
+                    {"function": f"{func[2]} ({os.path.basename(func[0])}:{func[1]})", "cumulative_s": round(cumulative, 3), "calls": calls}
+                    for func, calls, cumulative in sorted(functions, key=lambda item: -item[2])[:TOP_FUNCTIONS]
+                ]
+                path = self._path(name, ".collapsed")
+                sampler.write_collapsed(path)
+                result["files"]["collapsed"] = path
+
+            self.stages[name] = result
+
+    def report(self) -> str:
+        """Print a summary of every stage and save it as JSON"""
+        lines = [f"Profile {self.run_id} ({self.output_folder})"]
+        lines.append(f"  {'stage':<10} {'wall s':>9} {'cpu s':>9} {'wait s':>9} {'network':>8} {'cpu':>6} {'peak MB':>9}")
+        for name, result in self.stages.items():
+            network = f"{result['network_share']:.0%}" if "network_share" in result else "-"
+            cpu = f"{result['cpu_share']:.0%}" if "cpu_share" in result else "-"
+            peak = f"{result['memory_peak_mb']:.1f}" if "memory_peak_mb" in result else "-"
+            lines.append(f"  {name:<10} {result['wall_s']:>9.3f} {result['cpu_s']:>9.3f} {result['wait_s']:>9.3f} {network:>8} {cpu:>6} {peak:>9}")
+        for name, result in self.stages.items():
+            if result.get("top_functions"):
+                lines.append(f"  {name}: slowest functions (cumulative)")
+                for function in result["top_functions"][:5]:
+                    lines.append(f"    {function['cumulative_s']:>9.3f}s  {function['calls']:>8}  {function['function']}")
+            if result.get("top_allocators"):
+                lines.append(f"  {name}: top allocators")
+                for allocator in result["top_allocators"][:5]:
+                    lines.append(f"    {allocator['size_mb']:>9.3f} MB  {allocator['count']:>8}  {allocator['location']}")
+        summary = "\n".join(lines)
+        path = os.path.join(self.output_folder, f"{self.run_id}-summary.json")
+        with open(path, "w") as f:
+            json.dump(self.stages, f, indent=2)
+        print(summary)
+        print(f"Saved profiles to {self.output_folder}")
+        return summary
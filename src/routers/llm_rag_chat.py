@@ -1,32 +1,42 @@
 import os
-from fastapi import APIRouter, Header, Query, Body, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Header, Query, Body, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from typing import Dict, Any, List, Optional
 import uuid
 import time
 from datetime import datetime
 import mimetypes
 from pathlib import Path
-from api.utils.llm_rag_utils import chat_sessions, create_chat_session, generate_chat_response, rebuild_chat_session
-from api.utils.chat_utils import ChatHistoryManager
+from api.utils.llm_rag_utils import create_chat_session, generate_chat_response, load_chat_session, save_chat_session
+from api.utils.session_store import get_session_store, LockTimeout
+from api.utils.image_utils import file_etag, etag_matches, parse_range, thumbnail_path
+from api.utils.metrics import CACHE_REQUESTS
 
 # Define Router
 router = APIRouter()
 
-# Initialize chat history manager and sessions
-chat_manager = ChatHistoryManager(model="llm-rag")
+# Chat history and session state, shared by every worker (SESSION_STORE)
+chat_manager = get_session_store(model="llm-rag")
+
+# Stored images are never rewritten once saved, so clients may cache them forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Chat sessions current in this worker's memory vs restored or rebuilt from the session store
+SESSION_CACHE_HIT = CACHE_REQUESTS.labels("chat_session", "hit")
+SESSION_CACHE_MISS = CACHE_REQUESTS.labels("chat_session", "miss")
 
 @router.get("/chats")
 async def get_chats(x_session_id: str = Header(None, alias="X-Session-ID"), limit: Optional[int] = None):
     """Get all chats, optionally limited to a specific number"""
     print("x_session_id:", x_session_id)
-    return chat_manager.get_recent_chats(x_session_id, limit)
+    return await run_in_threadpool(chat_manager.get_recent_chats, x_session_id, limit)
 
 @router.get("/chats/{chat_id}")
 async def get_chat(chat_id: str, x_session_id: str = Header(None, alias="X-Session-ID")):
     """Get a specific chat by ID"""
     print("x_session_id:", x_session_id)
-    chat = chat_manager.get_chat(chat_id, x_session_id)
+    chat = await run_in_threadpool(chat_manager.get_chat, chat_id, x_session_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     return chat
@@ -36,12 +46,16 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
     """Start a new chat with an initial message"""
+    # Blocking model and storage calls run in the threadpool, so concurrent chats overlap
+    return await run_in_threadpool(start_chat, message, x_session_id)
+
+def start_chat(message: Dict, x_session_id: str) -> Dict:
+    """Create a chat, answer its first message and save it"""
     chat_id = str(uuid.uuid4())
     current_time = int(time.time())
 
     # Create a new chat session
     chat_session = create_chat_session()
-    chat_sessions[chat_id] = chat_session
     
     # Add ID and role to the user message
     message["message_id"] = str(uuid.uuid4())
@@ -69,8 +83,9 @@ async def start_chat_with_llm(message: Dict, x_session_id: str = Header(None, al
         ]
     }
     
-    # Save chat
+    # Save chat and session state
     chat_manager.save_chat(chat_response, x_session_id)
+    save_chat_session(chat_id, chat_session, chat_manager)
     return chat_response
 
 @router.post("/chats/{chat_id}")
@@ -78,15 +93,28 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
     print("content:", message["content"])
     print("x_session_id:", x_session_id)
     """Add a message to an existing chat"""
+    try:
+        return await run_in_threadpool(continue_chat_locked, chat_id, message, x_session_id)
+    except LockTimeout:
+        raise HTTPException(status_code=409, detail="Chat is busy with another message")
+
+def continue_chat_locked(chat_id: str, message: Dict, x_session_id: str) -> Dict:
+    """One turn at a time per chat, whichever worker each message lands on"""
+    with chat_manager.lock(chat_id):
+        return continue_chat(chat_id, message, x_session_id)
+
+def continue_chat(chat_id: str, message: Dict, x_session_id: str) -> Dict:
+    """Generate the next turn of a chat and save it, while holding the chat's lock"""
     chat = chat_manager.get_chat(chat_id, x_session_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    # Get or rebuild chat session
-    chat_session = chat_sessions.get(chat_id)
-    if not chat_session:
-        chat_session = rebuild_chat_session(chat["messages"])
-        chat_sessions[chat_id] = chat_session
+    # Get this worker's session, or restore it from the session store
+    chat_session, source = load_chat_session(chat_id, chat, chat_manager)
+    if source == "memory":
+        SESSION_CACHE_HIT.inc()
+    else:
+        SESSION_CACHE_MISS.inc()
     
     # Update timestamp
     current_time = int(time.time())
@@ -107,21 +135,30 @@ async def continue_chat_with_llm(chat_id: str, message: Dict, x_session_id: str
         "content": assistant_response
     })
     
-    # Save updated chat
+    # Save updated chat and session state
     chat_manager.save_chat(chat, x_session_id)
+    save_chat_session(chat_id, chat_session, chat_manager)
     return chat
 
+def read_byte_range(path: Path, start: int, end: int) -> bytes:
+    """Read the inclusive byte range start-end of a file"""
+    with path.open("rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
 @router.get("/images/{chat_id}/{message_id}.png")
-async def get_chat_image(chat_id: str, message_id: str):
+async def get_chat_image(chat_id: str, message_id: str, request: Request, thumbnail: bool = False):
     """
     Serve an image from the chat history.
     
     Args:
         chat_id: The chat ID
         message_id: The message ID
+        thumbnail: Serve a small JPEG preview instead of the original
     
     Returns:
-        FileResponse: The image file with appropriate content type
+        Response: The image (or a byte range of it) with validators and caching headers,
+            or 304 Not Modified if the client's copy is current
     """
     try:
         # Construct the image path
@@ -148,14 +185,58 @@ async def get_chat_image(chat_id: str, message_id: str):
                 detail="Image not found"
             )
         
-        # Determine content type
-        content_type, _ = mimetypes.guess_type(str(image_path))
-        if not content_type:
-            content_type = "application/octet-stream"
-        
+        # Hashing and resizing read the whole file, so they run in the threadpool
+        etag = await run_in_threadpool(file_etag, str(image_path))
+        if thumbnail:
+            image_path = Path(await run_in_threadpool(thumbnail_path, str(image_path), etag))
+            etag = await run_in_threadpool(file_etag, str(image_path))
+            content_type = "image/jpeg"
+        else:
+            # Determine content type
+            content_type, _ = mimetypes.guess_type(str(image_path))
+            if not content_type:
+                content_type = "application/octet-stream"
+
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMAGE_CACHE_CONTROL,
+            "Accept-Ranges": "bytes",
+        }
+
+        # Conditional request: the client already has this exact content
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+
+        # Range request, honoured only if If-Range (when sent) still matches
+        range_header = request.headers.get("range")
+        if_range = request.headers.get("if-range")
+        if range_header and (if_range is None or if_range == etag):
+            file_size = image_path.stat().st_size
+            try:
+                byte_range = parse_range(range_header, file_size)
+            except ValueError:
+                # Malformed or multiple ranges: ignore the header and send the whole file. Not as a
+                # FileResponse, which would parse the header again and reject it
+                content = await run_in_threadpool(image_path.read_bytes)
+                return Response(content=content, media_type=content_type, headers=headers)
+            if byte_range is None:
+                return Response(
+                    status_code=416,
+                    headers={**headers, "Content-Range": f"bytes */{file_size}"}
+                )
+            start, end = byte_range
+            content = await run_in_threadpool(read_byte_range, image_path, start, end)
+            return Response(
+                content=content,
+                status_code=206,
+                media_type=content_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{file_size}"}
+            )
+
         return FileResponse(
             path=image_path,
-            media_type=content_type
+            media_type=content_type,
+            headers=headers
         )
         
     except HTTPException:
@@ -1,9 +1,64 @@
-from fastapi import FastAPI
+import os
+import time
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from api.routers import llm_rag_chat
+from api.utils import llm_rag_utils
+from api.utils.llm_rag_utils import warm_up
+from api.utils.retry import with_retries
+from api.utils.metrics import REGISTRY, HTTP_REQUEST_SECONDS, ERRORS
+from api.utils.tracing import tracer, parse_trace_header, TRACE_HEADER
+
+# Warm the backends up at startup, so the first chat is as fast as later ones
+WARM_UP = os.environ.get("WARM_UP", "true").lower() == "true"
+# Chat turns run in threadpool threads that mostly wait on Vertex AI, anyio's default of 40 would cap concurrent chats
+API_THREADS = int(os.environ.get("API_THREADS", 100))
+
+# Reported by /readyz, ready once warm-up has finished
+readiness = {"ready": False, "attempts": 0, "error": None, "warm_up_s": None, "steps": {}}
+
+
+def run_warm_up():
+    """Warm up the backends, retrying with backoff until they are all reachable"""
+    start = time.perf_counter()
+
+    def attempt():
+        readiness["attempts"] += 1
+        try:
+            return warm_up()
+        except Exception as e:
+            readiness["error"] = str(e)
+            raise
+
+    readiness["steps"] = with_retries(attempt, "Warm-up", attempts=None)
+    readiness.update(ready=True, error=None, warm_up_s=round(time.perf_counter() - start, 3))
+    print(f"Warm-up finished in {readiness['warm_up_s']}s: {readiness['steps']}")
+
+
+def configure_threadpool(threads: int = API_THREADS) -> None:
+    """Size the threadpool used by run_in_threadpool, call from the event loop"""
+    import anyio.to_thread
+    anyio.to_thread.current_default_thread_limiter().total_tokens = threads
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_threadpool()
+    if WARM_UP:
+        # In a thread so the server starts answering /healthz straight away
+        threading.Thread(target=run_warm_up, name="warm-up", daemon=True).start()
+    else:
+        readiness["ready"] = True
+    yield
+
 
 # Setup FastAPI app
-app = FastAPI(title="API Server", description="API Server", version="v1")
+app = FastAPI(title="API Server", description="API Server", version="v1", lifespan=lifespan)
 
 # Enable CORSMiddleware
 app.add_middleware(
@@ -15,11 +70,78 @@ app.add_middleware(
 )
 
 
+# Prefix of each included route by id(route). Newer FastAPI versions put the router's own route,
+# whose path lacks the prefix, in the request scope; older ones a copy with the full path.
+ROUTE_PREFIXES: Dict[int, str] = {}
+
+
+def include_router(router: APIRouter, prefix: str) -> None:
+    """Include a router and remember its prefix for route_template"""
+    app.include_router(router, prefix=prefix)
+    ROUTE_PREFIXES.update((id(route), prefix) for route in router.routes)
+
+
+def route_template(request: Request) -> str:
+    """The matched route's path template, e.g. /llm-rag/chats/{chat_id}, so chat IDs do not explode label counts"""
+    route = request.scope.get("route")
+    if route is None:
+        return "unmatched"
+    return ROUTE_PREFIXES.get(id(route), "") + route.path
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """Observe request latency by route and status"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        HTTP_REQUEST_SECONDS.labels(request.method, route_template(request), str(status)).observe(time.perf_counter() - start)
+        if status >= 500:
+            ERRORS.labels("http").inc()
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Trace each request under the caller's trace ID (or a new one), returned in X-Trace-ID"""
+    with tracer.trace("http.request", trace_id=parse_trace_header(request.headers), method=request.method) as root:
+        response = await call_next(request)
+        route = route_template(request)
+        root.name = f"{request.method} {route}"
+        root.set_attributes(route=route, status_code=response.status_code)
+        response.headers[TRACE_HEADER] = root.trace_id
+        return response
+
+
 # Routes
 @app.get("/")
 async def get_index():
     return {"message": "Welcome to AC215"}
 
+@app.get("/healthz")
+async def get_health():
+    """Liveness probe, the process is up and serving"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def get_readiness():
+    """Readiness probe, 503 until the backends have been warmed up or while chroma DB is unreachable"""
+    if not readiness["ready"]:
+        raise HTTPException(status_code=503, detail=readiness)
+    # Runs in the threadpool, a heartbeat to an unreachable server blocks until it times out
+    vector_store = await run_in_threadpool(llm_rag_utils.vector_store.health_check)
+    if not vector_store["ok"]:
+        raise HTTPException(status_code=503, detail={**readiness, "vector_store": vector_store})
+    return {**readiness, "vector_store": vector_store}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    return Response(content=REGISTRY.render(), media_type=REGISTRY.content_type)
+
 # Additional routers here
-app.include_router(llm_rag_chat.router, prefix="/llm-rag")
+include_router(llm_rag_chat.router, prefix="/llm-rag")
 
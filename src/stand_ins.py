@@ -0,0 +1,297 @@
+"""Local stand-ins for Vertex AI and Chroma, for offline benchmarks and load tests."""
+
+import time
+import uuid
+import zlib
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class Latency:
+    """A latency distribution to sleep for, in seconds.
+
+    Specs look like "fixed:20" (ms), "uniform:10,50" or "lognormal:30,0.5"
+    (median ms, sigma). "none" or an empty spec means no delay.
+    """
+
+    def __init__(self, spec: str = "none", seed: int = 0):
+        self.spec = spec or "none"
+        kind, _, params = self.spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",")] if params else []
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        if kind not in ("none", "fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "none":
+            return 0.0
+        if self.kind == "fixed":
+            return self.params[0] / 1000
+        with self._lock:
+            if self.kind == "uniform":
+                return self._rng.uniform(self.params[0], self.params[1]) / 1000
+            return self._rng.lognormal(np.log(self.params[0]), self.params[1]) / 1000
+
+    def wait(self) -> None:
+        delay = self.sample()
+        if delay:
+            time.sleep(delay)
+
+
+class Counters:
+    """Thread-safe call and byte counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+
+    def record(self, items: int, num_bytes: int) -> None:
+        with self._lock:
+            self.calls += 1
+            self.items += items
+            self.bytes += num_bytes
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"calls": self.calls, "items": self.items, "bytes": self.bytes}
+
+
+def deterministic_vector(text: str, dimension: int) -> List[float]:
+    """A unit vector derived only from the text."""
+    rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+    vector = rng.standard_normal(dimension).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbedding:
+    def __init__(self, values: List[float]):
+        self.values = values
+
+
+class FakeEmbeddingModel:
+    """Deterministic stand-in for vertexai TextEmbeddingModel."""
+
+    def __init__(self, dimension: int = 256, latency: str = "none", max_request_tokens: Optional[int] = None):
+        self.dimension = dimension
+        self.latency = Latency(latency)
+        self.counters = Counters()
+        self.max_request_tokens = max_request_tokens
+
+    def get_embeddings(self, inputs, output_dimensionality: Optional[int] = None, **kwargs) -> List[FakeEmbedding]:
+        dimension = output_dimensionality or self.dimension
+        texts = [getattr(item, "text", item) for item in inputs]
+        self.latency.wait()
+        tokens = sum(len(text) for text in texts) // 4
+        if self.max_request_tokens is not None and tokens > self.max_request_tokens:
+            # Worded like the Vertex AI error
+            raise ValueError(f"400 Unable to submit request because the input token count is {tokens} but the model supports up to {self.max_request_tokens}")
+        self.counters.record(len(texts), sum(len(text.encode("utf-8")) for text in texts) + len(texts) * dimension * 4)
+        return [FakeEmbedding(deterministic_vector(text, dimension)) for text in texts]
+
+
+class InMemoryCollection:
+    """In-process stand-in for a Chroma collection using squared L2 distance."""
+
+    def __init__(self, name: str, metadata: Optional[Dict] = None, latency: str = "none"):
+        self.name = name
+        self.id = uuid.uuid4()
+        self.metadata = metadata
+        self.latency = Latency(latency)
+        self.counters = Counters()
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Dict] = {}
+        self._matrix = None
+        self._matrix_ids: List[str] = []
+
+    def count(self) -> int:
+        return len(self._rows)
+
+    def _write(self, ids, documents=None, metadatas=None, embeddings=None, overwrite=False):
+        self.latency.wait()
+        num_bytes = sum(len(document.encode("utf-8")) for document in documents or []) + sum(len(e) * 4 for e in embeddings or [])
+        self.counters.record(len(ids), num_bytes)
+        with self._lock:
+            for i, row_id in enumerate(ids):
+                if row_id in self._rows and not overwrite:
+                    continue
+                self._rows[row_id] = {
+                    "document": documents[i] if documents is not None else None,
+                    "metadata": metadatas[i] if metadatas is not None else None,
+                    "embedding": embeddings[i] if embeddings is not None else None,
+                }
+            self._matrix = None
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write(ids, documents, metadatas, embeddings)
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self._write(ids, documents, metadatas, embeddings, overwrite=True)
+
+    @staticmethod
+    def _matches(row: Dict, where: Optional[Dict], where_document: Optional[Dict]) -> bool:
+        if where:
+            metadata = row["metadata"] or {}
+            if any(metadata.get(key) != value for key, value in where.items()):
+                return False
+        if where_document and where_document.get("$contains") not in (row["document"] or ""):
+            return False
+        return True
+
+    def query(self, query_embeddings, n_results: int = 10, where=None, where_document=None, ids=None, include=("documents", "metadatas", "distances")) -> Dict:
+        self.latency.wait()
+        with self._lock:
+            if self._matrix is None:
+                self._matrix_ids = list(self._rows)
+                self._matrix = np.asarray([self._rows[row_id]["embedding"] for row_id in self._matrix_ids], dtype=np.float32)
+            matrix, matrix_ids = self._matrix, self._matrix_ids
+            if where or where_document or ids is not None:
+                allowed = set(ids) if ids is not None else None
+                mask = np.asarray([(allowed is None or row_id in allowed) and self._matches(self._rows[row_id], where, where_document)
+                                   for row_id in matrix_ids], dtype=bool)
+            else:
+                mask = None
+
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        num_bytes = 0
+        for query_embedding in query_embeddings:
+            if len(matrix_ids) == 0:
+                distances = np.zeros(0, dtype=np.float32)
+            else:
+                distances = ((matrix - np.asarray(query_embedding, dtype=np.float32)) ** 2).sum(axis=1)
+            if mask is not None:
+                distances = np.where(mask, distances, np.inf)
+            order = [i for i in np.argsort(distances)[:n_results] if np.isfinite(distances[i])]
+            rows = [self._rows[matrix_ids[i]] for i in order]
+            results["ids"].append([matrix_ids[i] for i in order])
+            results["documents"].append([row["document"] for row in rows])
+            results["metadatas"].append([row["metadata"] for row in rows])
+            results["distances"].append([float(distances[i]) for i in order])
+            num_bytes += len(query_embedding) * 4 + sum(len((row["document"] or "").encode("utf-8")) for row in rows)
+        self.counters.record(len(query_embeddings), num_bytes)
+        return results
+
+    def get(self, ids=None, where=None, where_document=None, limit=None, include=("documents", "metadatas")) -> Dict:
+        self.latency.wait()
+        with self._lock:
+            row_ids = [row_id for row_id in (ids if ids is not None else list(self._rows)) if row_id in self._rows]
+            row_ids = [row_id for row_id in row_ids if self._matches(self._rows[row_id], where, where_document)]
+            if limit is not None:
+                row_ids = row_ids[:limit]
+            rows = [self._rows[row_id] for row_id in row_ids]
+        self.counters.record(len(rows), sum(len((row["document"] or "").encode("utf-8")) for row in rows))
+        results = {"ids": row_ids, "documents": [row["document"] for row in rows], "metadatas": [row["metadata"] for row in rows]}
+        if "embeddings" in include:
+            results["embeddings"] = [row["embedding"] for row in rows]
+        return results
+
+
+class InMemoryChromaClient:
+    """In-process stand-in for chromadb.HttpClient."""
+
+    def __init__(self, latency: str = "none", **kwargs):
+        self.latency = latency
+        self.collections: Dict[str, InMemoryCollection] = {}
+
+    def heartbeat(self) -> int:
+        return time.time_ns()
+
+    def create_collection(self, name: str, metadata: Optional[Dict] = None, **kwargs) -> InMemoryCollection:
+        if name in self.collections:
+            raise ValueError(f"Collection {name} already exists")
+        self.collections[name] = InMemoryCollection(name, metadata=metadata, latency=self.latency)
+        return self.collections[name]
+
+    def get_collection(self, name: str, **kwargs) -> InMemoryCollection:
+        if name not in self.collections:
+            raise ValueError(f"Collection {name} does not exist")
+        return self.collections[name]
+
+    def get_or_create_collection(self, name: str, metadata: Optional[Dict] = None, **kwargs) -> InMemoryCollection:
+        if name not in self.collections:
+            return self.create_collection(name, metadata=metadata)
+        return self.collections[name]
+
+    def delete_collection(self, name: str) -> None:
+        if name not in self.collections:
+            raise ValueError(f"Collection {name} does not exist")
+        del self.collections[name]
+
+    def counters(self) -> Dict:
+        totals = {"calls": 0, "items": 0, "bytes": 0}
+        for collection in self.collections.values():
+            for key, value in collection.counters.snapshot().items():
+                totals[key] += value
+        return totals
+
+
+class FakeUsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = FakeUsageMetadata(prompt_tokens, len(text) // 4)
+
+
+def _estimate_tokens(contents) -> int:
+    if isinstance(contents, (list, tuple)):
+        return sum(_estimate_tokens(item) for item in contents)
+    if isinstance(contents, str):
+        return len(contents) // 4
+    # Content objects hold parts, Part.text raises for image parts
+    parts = getattr(contents, "parts", None)
+    if parts is not None:
+        return _estimate_tokens(list(parts))
+    try:
+        text = contents.text
+    except (AttributeError, ValueError):
+        text = None
+    if isinstance(text, str):
+        return len(text) // 4
+    return 258  # Gemini's flat token cost for an image
+
+
+class FakeChatSession:
+    """Stand-in for vertexai ChatSession that keeps history and answers after a delay."""
+
+    def __init__(self, model: "FakeGenerativeModel", history=None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content, generation_config=None, **kwargs) -> FakeResponse:
+        response = self.model.generate_content(self.history + [content], generation_config=generation_config)
+        self.history.extend([content, response.text])
+        return response
+
+
+class FakeGenerativeModel:
+    """Stand-in for vertexai GenerativeModel."""
+
+    def __init__(self, model_name: str = "fake", latency: str = "none", response_text: str = "This is a stand-in answer.", **kwargs):
+        self.model_name = model_name
+        self.latency = Latency(latency)
+        self.response_text = response_text
+        self.counters = Counters()
+
+    def generate_content(self, contents, generation_config=None, **kwargs) -> FakeResponse:
+        self.latency.wait()
+        prompt_tokens = _estimate_tokens(contents)
+        self.counters.record(1, prompt_tokens * 4)
+        return FakeResponse(self.response_text, prompt_tokens)
+
+    def start_chat(self, history=None, **kwargs) -> FakeChatSession:
+        return FakeChatSession(self, history=history)
+
+    def count_tokens(self, contents, **kwargs) -> FakeUsageMetadata:
+        self.latency.wait()
+        return FakeUsageMetadata(_estimate_tokens(contents), 0)
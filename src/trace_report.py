@@ -0,0 +1,170 @@
+"""
+Summarize exported request traces.
+
+Lists the slowest traces with their span tree and critical path, and which
+spans account for most critical-path time across them.
+
+    python trace_report.py chat-history/traces/traces.jsonl --top 10
+    python trace_report.py traces.jsonl --route "/llm-rag/chats/{chat_id}" --min_ms 1000
+"""
+import json
+import argparse
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from utils.tracing import TRACE_FILE
+
+
+def _otlp_attribute(value: Dict):
+    for key in ("stringValue", "boolValue", "doubleValue"):
+        if key in value:
+            return value[key]
+    if "intValue" in value:
+        return int(value["intValue"])
+    return None
+
+
+def _from_otlp(record: Dict) -> Iterator[Tuple[str, List[Dict]]]:
+    traces: Dict[str, List[Dict]] = {}
+    for resource_spans in record.get("resourceSpans", []):
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for otlp_span in scope_spans.get("spans", []):
+                traces.setdefault(otlp_span["traceId"], []).append({
+                    "span_id": otlp_span["spanId"],
+                    "parent_id": otlp_span.get("parentSpanId") or None,
+                    "name": otlp_span["name"],
+                    "start_ns": int(otlp_span["startTimeUnixNano"]),
+                    "end_ns": int(otlp_span["endTimeUnixNano"]),
+                    "status": "error" if otlp_span.get("status", {}).get("code") == 2 else "ok",
+                    "attributes": {item["key"]: _otlp_attribute(item["value"]) for item in otlp_span.get("attributes", [])},
+                })
+    yield from traces.items()
+
+
+def read_traces(path: str) -> List[Dict]:
+    """
+    Load traces written by utils.tracing in either the jsonl or otlp format.
+
+    Returns:
+        List[Dict]: Traces with "trace_id", "spans" and the "root" span
+    """
+    traces = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            items = _from_otlp(record) if "resourceSpans" in record else [(record["trace_id"], record["spans"])]
+            for trace_id, spans in items:
+                roots = [span for span in spans if not span.get("parent_id")]
+                if not roots:
+                    continue
+                traces.append({"trace_id": trace_id, "spans": spans, "root": roots[0]})
+    return traces
+
+
+def duration_ms(span: Dict) -> float:
+    return (span["end_ns"] - span["start_ns"]) / 1e6
+
+
+def children_by_parent(spans: List[Dict]) -> Dict[Optional[str], List[Dict]]:
+    children: Dict[Optional[str], List[Dict]] = {}
+    for span in spans:
+        children.setdefault(span.get("parent_id"), []).append(span)
+    for siblings in children.values():
+        siblings.sort(key=lambda span: span["start_ns"])
+    return children
+
+
+def critical_path(span: Dict, children: Dict[Optional[str], List[Dict]]) -> List[Tuple[str, float]]:
+    """
+    The chain of work that determined a span's end time.
+
+    Walks back from the span's end: the child that finished last before the
+    cursor is on the path, then the cursor moves to that child's start. Time not
+    covered by any child is the span's own (self) time.
+
+    Returns:
+        List[Tuple[str, float]]: (span name, ms on the critical path) in time order
+    """
+    path: List[Tuple[str, float]] = []
+    cursor = span["end_ns"]
+    self_ns = 0
+    candidates = list(children.get(span["span_id"], []))
+    while True:
+        finished = [child for child in candidates if child["end_ns"] <= cursor]
+        if not finished:
+            self_ns += cursor - span["start_ns"]
+            break
+        child = max(finished, key=lambda child: child["end_ns"])
+        self_ns += cursor - child["end_ns"]
+        path = critical_path(child, children) + path
+        cursor = child["start_ns"]
+        candidates = [other for other in candidates if other is not child and other["start_ns"] < cursor]
+    if self_ns > 0:
+        path.append((f"{span['name']} (self)", self_ns / 1e6))
+    return path
+
+
+def format_tree(span: Dict, children: Dict[Optional[str], List[Dict]], trace_start: int, depth: int = 0) -> List[str]:
+    attributes = " ".join(f"{key}={value}" for key, value in span.get("attributes", {}).items())
+    offset = (span["start_ns"] - trace_start) / 1e6
+    status = " ERROR" if span.get("status") == "error" else ""
+    lines = [f"    {'  ' * depth}{span['name']:<{40 - 2 * depth}} {duration_ms(span):>9.1f} ms  +{offset:.1f}{status}  {attributes}".rstrip()]
+    for child in children.get(span["span_id"], []):
+        lines.extend(format_tree(child, children, trace_start, depth + 1))
+    return lines
+
+
+def summarize(traces: List[Dict], top: int = 10, route: Optional[str] = None, min_ms: float = 0) -> Dict:
+    """
+    Pick the slowest traces and total their critical-path time per span name.
+
+    Returns:
+        Dict: "slowest" traces (with children and critical path) and "critical_path_ms" totals
+    """
+    selected = [
+        trace for trace in traces
+        if duration_ms(trace["root"]) >= min_ms and (route is None or trace["root"].get("attributes", {}).get("route") == route)
+    ]
+    selected.sort(key=lambda trace: -duration_ms(trace["root"]))
+    slowest = []
+    totals: Dict[str, float] = {}
+    for trace in selected[:top]:
+        children = children_by_parent(trace["spans"])
+        path = critical_path(trace["root"], children)
+        for name, ms in path:
+            totals[name] = totals.get(name, 0.0) + ms
+        slowest.append({**trace, "children": children, "critical_path": path})
+    return {"matched": len(selected), "slowest": slowest, "critical_path_ms": dict(sorted(totals.items(), key=lambda item: -item[1]))}
+
+
+def main(args=None):
+    traces = read_traces(args.trace_file)
+    summary = summarize(traces, top=args.top, route=args.route, min_ms=args.min_ms)
+    print(f"{len(traces)} traces, {summary['matched']} matched, showing the {len(summary['slowest'])} slowest")
+
+    for trace in summary["slowest"]:
+        root = trace["root"]
+        print(f"\nTrace {trace['trace_id']}  {root['name']}  {duration_ms(root):.1f} ms")
+        for line in format_tree(root, trace["children"], root["start_ns"]):
+            print(line)
+        print("  Critical path:")
+        for name, ms in trace["critical_path"]:
+            print(f"    {name:<40} {ms:>9.1f} ms  {ms / max(duration_ms(root), 1e-9):>5.0%}")
+
+    total = sum(summary["critical_path_ms"].values())
+    if total:
+        print("\nCritical path time across these traces:")
+        for name, ms in summary["critical_path_ms"].items():
+            print(f"  {name:<40} {ms:>10.1f} ms  {ms / total:>5.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the slowest request traces")
+    parser.add_argument("trace_file", nargs="?", default=TRACE_FILE, help="JSONL file written by the API tracer")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest traces to show")
+    parser.add_argument("--route", help="Only traces for this route template, e.g. /llm-rag/chats/{chat_id}")
+    parser.add_argument("--min_ms", type=float, default=0, help="Only traces at least this slow")
+
+    main(parser.parse_args())
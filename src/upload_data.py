@@ -1,21 +1,137 @@
 # src/upload_data.py
 import os
+import argparse
+import base64
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
+import google_crc32c
 import glob
 from tqdm import tqdm
 from google.api_core import exceptions
 
-def upload_to_gcp():
+DATA_FOLDER = "/app/data"
+CACHE_FOLDER = "outputs"
+# Bucket prefix -> local file pattern
+UPLOAD_PATTERNS = {
+    "embeddings": "embeddings-recursive-split-*.jsonl",
+    "chunks": "chunks-recursive-split-*.jsonl",
+}
+MAX_WORKERS = 8
+# Files above this size use a resumable upload in chunks of this size
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+# Files above this size are uploaded as parallel parts (XML multipart upload)
+COMPOSITE_THRESHOLD = 128 * 1024 * 1024
+COMPOSITE_CHUNK_SIZE = 32 * 1024 * 1024
+# Blob metadata key holding the CRC32C of the local file (survives gzip encoding)
+SOURCE_CHECKSUM_KEY = "source-crc32c"
+
+
+def file_checksums(file_path: str) -> Dict:
+    """Compute size and base64 CRC32C/MD5 of a local file, as GCS reports them"""
+    crc = google_crc32c.Checksum()
+    md5 = hashlib.md5()
+    size = 0
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            crc.update(block)
+            md5.update(block)
+            size += len(block)
+    return {
+        "size": size,
+        "crc32c": base64.b64encode(crc.digest()).decode("utf-8"),
+        "md5": base64.b64encode(md5.digest()).decode("utf-8"),
+    }
+
+
+def blob_is_current(blob, checksums: Dict) -> bool:
+    """Check whether a remote blob already holds the local file's content"""
+    metadata = blob.metadata or {}
+    if metadata.get(SOURCE_CHECKSUM_KEY):
+        return metadata[SOURCE_CHECKSUM_KEY] == checksums["crc32c"]
+    # Stored checksums describe the stored bytes, which differ from the source if gzipped
+    if blob.content_encoding == "gzip":
+        return False
+    if blob.crc32c:
+        return blob.crc32c == checksums["crc32c"]
+    if blob.md5_hash:
+        return blob.md5_hash == checksums["md5"]
+    return False
+
+
+def list_remote_blobs(bucket, prefixes) -> Dict:
+    """List the bucket prefixes once, returning blobs by name"""
+    remote_blobs = {}
+    for prefix in prefixes:
+        for blob in bucket.list_blobs(prefix=f"{prefix}/"):
+            remote_blobs[blob.name] = blob
+    return remote_blobs
+
+
+def upload_file(bucket, file_path: str, blob_name: str, checksums: Dict, gzip_jsonl: bool = False, max_workers: int = MAX_WORKERS) -> None:
+    """
+    Upload a single file, choosing the transfer method by size.
+
+    Args:
+        bucket: The destination bucket
+        file_path: Local file to upload
+        blob_name: Destination blob name
+        checksums: Output of file_checksums for the file
+        gzip_jsonl: Store .jsonl files with gzip content encoding
+        max_workers: Parallel parts for large uploads
+    """
+    blob = bucket.blob(blob_name)
+    blob.metadata = {SOURCE_CHECKSUM_KEY: checksums["crc32c"]}
+
+    if gzip_jsonl and file_path.endswith(".jsonl"):
+        blob.content_encoding = "gzip"
+        blob.content_type = "application/jsonl"
+        with tempfile.NamedTemporaryFile(suffix=".jsonl.gz", delete=False) as tmp:
+            with open(file_path, "rb") as src, gzip.GzipFile(fileobj=tmp, mode="wb") as dst:
+                shutil.copyfileobj(src, dst)
+        try:
+            if os.path.getsize(tmp.name) > RESUMABLE_CHUNK_SIZE:
+                blob.chunk_size = RESUMABLE_CHUNK_SIZE
+            blob.upload_from_filename(tmp.name, checksum="crc32c")
+        finally:
+            os.remove(tmp.name)
+        return
+
+    if checksums["size"] > COMPOSITE_THRESHOLD:
+        transfer_manager.upload_chunks_concurrently(
+            file_path,
+            blob,
+            chunk_size=COMPOSITE_CHUNK_SIZE,
+            max_workers=max_workers,
+            worker_type=transfer_manager.THREAD,
+        )
+        # Multipart uploads do not carry custom metadata, set it afterwards
+        blob.metadata = {SOURCE_CHECKSUM_KEY: checksums["crc32c"]}
+        blob.patch()
+        return
+
+    if checksums["size"] > RESUMABLE_CHUNK_SIZE:
+        blob.chunk_size = RESUMABLE_CHUNK_SIZE
+    blob.upload_from_filename(file_path, checksum="crc32c")
+
+
+def upload_to_gcp(max_workers: int = MAX_WORKERS, gzip_jsonl: bool = False):
     """Upload chunks and embeddings to GCP bucket"""
     # Get environment variables
     project_id = os.getenv('GCP_PROJECT')
     bucket_name = os.getenv('GCS_BUCKET_NAME')
-    
+
     print(f"Starting upload to GCP Project: {project_id}, Bucket: {bucket_name}")
-    
+
     # Initialize GCP client
     storage_client = storage.Client(project=project_id)
-    
+
     # Get or create bucket
     try:
         bucket = storage_client.get_bucket(bucket_name)
@@ -31,46 +147,156 @@ def upload_to_gcp():
     except Exception as e:
         print(f"Error accessing bucket: {str(e)}")
         return
-    
-    # Upload embeddings
-    embedding_files = glob.glob("/app/data/embeddings-recursive-split-*.jsonl")
-    print(f"Found {len(embedding_files)} embedding files to upload")
-    
-    for file_path in tqdm(embedding_files, desc="Uploading embeddings"):
-        try:
-            blob_name = f"embeddings/{os.path.basename(file_path)}"
-            blob = bucket.blob(blob_name)
-            
-            # Check if file already exists
-            if blob.exists():
-                print(f"⚠️  File {blob_name} already exists, skipping...")
-                continue
-                
-            blob.upload_from_filename(file_path)
-            print(f"✓ Uploaded {os.path.basename(file_path)}")
-        except Exception as e:
-            print(f"❌ Error uploading {file_path}: {str(e)}")
-    
-    # Upload chunks
-    chunk_files = glob.glob("/app/data/chunks-recursive-split-*.jsonl")
-    print(f"Found {len(chunk_files)} chunk files to upload")
-    
-    for file_path in tqdm(chunk_files, desc="Uploading chunks"):
+
+    # Find local files
+    files_to_sync = []
+    for prefix, pattern in UPLOAD_PATTERNS.items():
+        local_files = glob.glob(os.path.join(DATA_FOLDER, pattern))
+        print(f"Found {len(local_files)} {prefix} files to upload")
+        files_to_sync.extend((file_path, f"{prefix}/{os.path.basename(file_path)}") for file_path in local_files)
+    if not files_to_sync:
+        print("\nNothing to upload")
+        return
+
+    # One listing per prefix instead of an exists() call per file
+    try:
+        remote_blobs = list_remote_blobs(bucket, UPLOAD_PATTERNS.keys())
+    except Exception as e:
+        print(f"Error listing bucket: {str(e)}")
+        return
+
+    # Uploads in flight share max_workers for the parts of large files, instead of each using max_workers
+    active = {"uploads": 0}
+    active_lock = threading.Lock()
+
+    def sync_file(file_path, blob_name):
+        checksums = file_checksums(file_path)
+        remote_blob = remote_blobs.get(blob_name)
+        if remote_blob is not None and blob_is_current(remote_blob, checksums):
+            return "skipped"
+        with active_lock:
+            active["uploads"] += 1
+            part_workers = max(1, max_workers // active["uploads"])
         try:
-            blob_name = f"chunks/{os.path.basename(file_path)}"
-            blob = bucket.blob(blob_name)
-            
-            # Check if file already exists
-            if blob.exists():
-                print(f"⚠️  File {blob_name} already exists, skipping...")
-                continue
-                
-            blob.upload_from_filename(file_path)
-            print(f"✓ Uploaded {os.path.basename(file_path)}")
-        except Exception as e:
-            print(f"❌ Error uploading {file_path}: {str(e)}")
-    
-    print("\nUpload completed successfully!")
+            upload_file(bucket, file_path, blob_name, checksums, gzip_jsonl=gzip_jsonl, max_workers=part_workers)
+        finally:
+            with active_lock:
+                active["uploads"] -= 1
+        return "updated" if remote_blob is not None else "uploaded"
+
+    counts = {"uploaded": 0, "updated": 0, "skipped": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(sync_file, file_path, blob_name): (file_path, blob_name)
+            for file_path, blob_name in files_to_sync
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Syncing"):
+            file_path, blob_name = futures[future]
+            try:
+                status = future.result()
+                counts[status] += 1
+                if status == "skipped":
+                    print(f"⚠️  File {blob_name} is unchanged, skipping...")
+                else:
+                    print(f"✓ Uploaded {os.path.basename(file_path)}")
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"❌ Error uploading {file_path}: {str(e)}")
+
+    print(f"\nUpload completed: {counts['uploaded']} new, {counts['updated']} updated, {counts['skipped']} unchanged, {counts['failed']} failed")
+
+def download_blob(blob, cache_dir: str) -> str:
+    """
+    Download a blob into cache_dir unless an identical local copy exists.
+
+    The download goes to a temp file and is only moved into place once its
+    checksum matches the blob, so an interrupted pull never leaves a partial artifact.
+
+    Returns:
+        str: "skipped" or "downloaded"
+    """
+    local_path = os.path.join(cache_dir, os.path.basename(blob.name))
+    if os.path.exists(local_path) and blob_is_current(blob, file_checksums(local_path)):
+        return "skipped"
+
+    tmp_path = f"{local_path}.{os.getpid()}.part"
+    try:
+        # Checksums are verified below against the source checksum, which also covers gzipped blobs
+        blob.download_to_filename(tmp_path, checksum=None)
+        if not blob_is_current(blob, file_checksums(tmp_path)):
+            raise ValueError(f"Checksum mismatch for {blob.name}")
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return "downloaded"
+
+
+def download_from_gcp(cache_dir: str = CACHE_FOLDER, max_workers: int = MAX_WORKERS, load_method: str = None, storage_client=None):
+    """
+    Pull chunks and embeddings from the GCP bucket into a local cache directory.
+
+    Args:
+        cache_dir: Local directory to download into
+        max_workers: Number of concurrent downloads
+        load_method: If set, load the downloaded embeddings into the vector db with this chunk type
+        storage_client: Storage client to use, defaults to a GCS client for GCP_PROJECT
+    """
+    project_id = os.getenv('GCP_PROJECT')
+    bucket_name = os.getenv('GCS_BUCKET_NAME')
+
+    print(f"Starting download from GCP Project: {project_id}, Bucket: {bucket_name}")
+
+    if storage_client is None:
+        storage_client = storage.Client(project=project_id)
+
+    try:
+        bucket = storage_client.get_bucket(bucket_name)
+    except Exception as e:
+        print(f"Error accessing bucket: {str(e)}")
+        return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        remote_blobs = list_remote_blobs(bucket, UPLOAD_PATTERNS.keys())
+    except Exception as e:
+        print(f"Error listing bucket: {str(e)}")
+        return
+    # Skip "folder" placeholder objects
+    blobs = [blob for name, blob in remote_blobs.items() if not name.endswith("/")]
+    print(f"Found {len(blobs)} files to download")
+
+    counts = {"downloaded": 0, "skipped": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_blob, blob, cache_dir): blob for blob in blobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
+            blob = futures[future]
+            try:
+                counts[future.result()] += 1
+            except Exception as e:
+                counts["failed"] += 1
+                print(f"❌ Error downloading {blob.name}: {str(e)}")
+
+    print(f"\nDownload completed: {counts['downloaded']} downloaded, {counts['skipped']} unchanged, {counts['failed']} failed")
+
+    if load_method and counts["failed"] == 0:
+        # Imported here so a plain pull does not need the vector db and model dependencies
+        import cli
+        cli.load(method=load_method, output_folder=cache_dir)
+
+    return counts
 
 if __name__ == "__main__":
-    upload_to_gcp()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sync chunks and embeddings with a GCP bucket")
+    parser.add_argument("--pull", action="store_true", help="Download artifacts from the bucket instead of uploading")
+    parser.add_argument("--cache_dir", default=CACHE_FOLDER, help="Local directory for pulled artifacts")
+    parser.add_argument("--load", action="store_true", help="Load pulled embeddings into the vector db")
+    parser.add_argument("--chunk_type", default="recursive-split", help="char-split | recursive-split | semantic-split")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="Number of concurrent transfers")
+    parser.add_argument("--gzip", action="store_true", help="Upload JSONL files with gzip content encoding")
+    args = parser.parse_args()
+
+    if args.pull:
+        download_from_gcp(cache_dir=args.cache_dir, max_workers=args.workers, load_method=args.chunk_type if args.load else None)
+    else:
+        upload_to_gcp(max_workers=args.workers, gzip_jsonl=args.gzip)
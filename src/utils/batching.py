@@ -0,0 +1,126 @@
+"""
+Dynamic micro-batching for calls made by concurrent requests.
+
+Requests run in the threadpool and each needs one small call, e.g. a query
+embedding. A MicroBatcher holds the first item for up to max_wait seconds (or
+until max_batch_size items are waiting), makes one call for all of them and
+hands each caller its own result. When max_concurrency calls are already in
+flight, items keep collecting until one finishes, so batches grow with load
+and backend latency instead of queueing up as more small calls. A lone request
+pays at most max_wait extra.
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+from .metrics import BATCH_SIZE, BATCH_WAIT_SECONDS
+
+
+class MicroBatcher:
+    """
+    Collect items submitted from many threads into batched calls.
+
+    Args:
+        process: Called with a list of items, returns one result per item in the same order
+        max_batch_size: Most items per call
+        max_wait: Seconds to wait for more items after the first one arrives
+        max_concurrency: Calls in flight at once, items collect into the next batch while they run
+        name: Label for the metrics and worker threads
+    """
+
+    def __init__(self, process: Callable[[List], List], max_batch_size: int = 250, max_wait: float = 0.005,
+                 max_concurrency: int = 4, name: str = "micro-batcher"):
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_concurrency = max_concurrency
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_concurrency)
+        self._batch_size = BATCH_SIZE.labels(name)
+        self._wait_seconds = BATCH_WAIT_SECONDS.labels(name)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=self.name)
+                self._thread = threading.Thread(target=self._collect, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            acquired = False
+            try:
+                deadline = batch[0][2] + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self._queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                self._slots.acquire()
+                acquired = True
+                # Anything that arrived while waiting for a free slot goes in too
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._executor.submit(self._run, batch)
+            except Exception as e:
+                # Fail this batch's callers rather than the collector, which later items still need
+                if acquired:
+                    self._slots.release()
+                self._fail(batch, e)
+
+    def _run(self, batch: List) -> None:
+        try:
+            self._call(batch)
+        finally:
+            self._slots.release()
+
+    def _call(self, batch: List) -> None:
+        try:
+            now = time.perf_counter()
+            for _, _, submitted in batch:
+                self._wait_seconds.observe(now - submitted)
+            self._batch_size.observe(len(batch))
+            with self._lock:
+                self.calls += 1
+                self.items += len(batch)
+            results = self.process([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"{self.name} returned {len(results)} results for {len(batch)} items")
+        except Exception as e:
+            self._fail(batch, e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(batch: List, error: Exception) -> None:
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def submit_async(self, item) -> Future:
+        """Queue an item, the future resolves once its batch has been processed"""
+        if self._thread is None:
+            self._start()
+        future: Future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def submit(self, item, timeout: Optional[float] = None) -> Any:
+        """Queue an item and wait up to timeout seconds for its result, errors of the batch call are raised here"""
+        return self.submit_async(item).result(timeout)
@@ -0,0 +1,228 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from vertexai.generative_models import Content, Part
+from .context_builder import estimate_tokens
+
+# Conversation sent with each message: the last CHAT_HISTORY_TURNS turns verbatim,
+# older turns folded into a summary, and never more than CHAT_MAX_PROMPT_TOKENS in all
+CHAT_HISTORY_TURNS = int(os.environ.get("CHAT_HISTORY_TURNS", 6))
+CHAT_MAX_PROMPT_TOKENS = int(os.environ.get("CHAT_MAX_PROMPT_TOKENS", 6000))
+CHAT_SUMMARY_TOKENS = int(os.environ.get("CHAT_SUMMARY_TOKENS", 600))
+SUMMARY_CHARS = 300  # Of each question and answer in the summary
+IMAGE_TOKENS = 258  # Gemini's flat token cost for an image
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+# Chat sessions a worker keeps in memory, others are restored from the session store when their chat continues
+CHAT_SESSION_CACHE_SIZE = int(os.environ.get("CHAT_SESSION_CACHE_SIZE", 1000))
+# Messages about what was said or cited before, their earlier context is fetched again
+REFERS_BACK = re.compile(
+    r"\b(earlier|previous(ly)?|above|you (said|mentioned|cited|quoted|referenced|wrote)"
+    r"|(that|those|these|the same) (source|passage|excerpt|reference|text|chunk|section|study|studies)s?"
+    r"|quote|cite|citation|sources?)\b",
+    re.IGNORECASE,
+)
+
+
+def refers_back(text: str) -> bool:
+    """Whether a message refers to something from an earlier turn"""
+    return bool(REFERS_BACK.search(text or ""))
+
+
+def part_tokens(part) -> int:
+    if isinstance(part, str):
+        return estimate_tokens(part)
+    try:
+        text = part.text
+    except (AttributeError, ValueError):
+        return IMAGE_TOKENS
+    return estimate_tokens(text) if isinstance(text, str) else IMAGE_TOKENS
+
+
+def shorten(text: str, limit: int = SUMMARY_CHARS) -> str:
+    """Collapse whitespace and cut text at a word boundary"""
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + " ..."
+
+
+def to_part(part) -> Part:
+    return Part.from_text(part) if isinstance(part, str) else part
+
+
+class CompactingChatSession:
+    """
+    Chat history for one conversation that stays the same size as it grows.
+
+    Retrieved context goes with its own turn only: the history keeps the question
+    and the IDs of the chunks it used, so later turns do not resend them.
+
+    The last max_turns turns are sent verbatim. Older turns are folded into a
+    rolling summary of each question and the start of its answer, built as turns
+    leave the window and kept, so compaction never needs a model call. If a
+    prompt would still exceed max_prompt_tokens, the oldest verbatim turns are
+    folded in early.
+
+    Args:
+        model: The GenerativeModel, called with the whole conversation each turn
+        max_turns: Turns kept verbatim
+        max_prompt_tokens: Estimated limit for history plus the new message
+        summary_tokens: Estimated limit for the summary, oldest lines are dropped first
+    """
+
+    def __init__(self, model, max_turns: int = CHAT_HISTORY_TURNS, max_prompt_tokens: int = CHAT_MAX_PROMPT_TOKENS,
+                 summary_tokens: int = CHAT_SUMMARY_TOKENS):
+        self.model = model
+        self.max_turns = max_turns
+        self.max_prompt_tokens = max_prompt_tokens
+        self.summary_tokens = summary_tokens
+        self.turns: List[Dict] = []
+        self.summary_lines: List[str] = []
+        self.compacted_turns = 0
+        # Version of the shared session state this copy matches, set by the session store helpers
+        self.state_version: Optional[int] = None
+
+    @property
+    def summary(self) -> str:
+        return "\n".join(self.summary_lines)
+
+    def _summary_parts(self) -> List[str]:
+        return [f"{SUMMARY_HEADER}\n{self.summary}"] if self.summary_lines else []
+
+    def _compact_oldest(self) -> None:
+        turn = self.turns.pop(0)
+        self.summary_lines.append(f"User: {shorten(turn['summary_text'])}\nAssistant: {shorten(turn['response'])}")
+        while len(self.summary_lines) > 1 and estimate_tokens(self.summary) > self.summary_tokens:
+            self.summary_lines.pop(0)
+        self.compacted_turns += 1
+
+    def add_turn(self, parts: List, response: str, summary_text: Optional[str] = None, context_ids: Optional[List[str]] = None) -> None:
+        """
+        Record a finished turn, compacting the window if it is full.
+
+        Args:
+            parts: The message, text and image parts, without retrieved context
+            response: The model's answer
+            summary_text: What the turn is about for the summary, by default its first text part
+            context_ids: IDs of the chunks retrieved for the turn
+        """
+        if summary_text is None:
+            summary_text = next((part for part in parts if isinstance(part, str)), "")
+        tokens = sum(part_tokens(part) for part in parts) + estimate_tokens(response)
+        self.turns.append({"parts": list(parts), "response": response, "summary_text": summary_text, "tokens": tokens,
+                           "context_ids": list(context_ids or [])})
+        while len(self.turns) > self.max_turns:
+            self._compact_oldest()
+
+    def recent_context_ids(self) -> List[str]:
+        """Chunk IDs used by the latest turn that retrieved any"""
+        for turn in reversed(self.turns):
+            if turn["context_ids"]:
+                return turn["context_ids"]
+        return []
+
+    def to_state(self) -> Dict:
+        """
+        The session as plain data for the session store.
+
+        Image parts are saved as {"image": True}, the image itself is kept with the chat history.
+        """
+        turns = []
+        for turn in self.turns:
+            parts = []
+            for part in turn["parts"]:
+                if not isinstance(part, str):
+                    try:
+                        part = part.text
+                    except (AttributeError, ValueError):
+                        part = None
+                parts.append(part if isinstance(part, str) else {"image": True})
+            turns.append({**turn, "parts": parts})
+        return {"turns": turns, "summary_lines": self.summary_lines, "compacted_turns": self.compacted_turns}
+
+    def load_state(self, state: Dict, load_image: Optional[Callable[[int], Optional[Part]]] = None) -> None:
+        """
+        Restore a session saved with to_state.
+
+        Args:
+            state: The saved session
+            load_image: Returns the image Part of a turn, by its number in the whole conversation,
+                images are left out without it
+        """
+        self.summary_lines = list(state["summary_lines"])
+        self.compacted_turns = state["compacted_turns"]
+        self.turns = []
+        for number, turn in enumerate(state["turns"], start=self.compacted_turns):
+            parts = []
+            for part in turn["parts"]:
+                if isinstance(part, dict):
+                    part = load_image(number) if load_image else None
+                if part is not None:
+                    parts.append(part)
+            self.turns.append({**turn, "parts": parts})
+
+    def prompt_tokens(self, parts: List) -> int:
+        """Estimated tokens of the history plus a new message"""
+        history = sum(turn["tokens"] for turn in self.turns)
+        summary = sum(estimate_tokens(part) for part in self._summary_parts())
+        return history + summary + sum(part_tokens(part) for part in parts)
+
+    def build_contents(self, parts: List) -> List[Content]:
+        """The conversation to send with a new message, compacted to fit the token budget"""
+        while self.turns and self.prompt_tokens(parts) > self.max_prompt_tokens:
+            self._compact_oldest()
+        preamble = self._summary_parts()
+        contents = []
+        for turn in self.turns:
+            contents.append(Content(role="user", parts=[to_part(part) for part in preamble + turn["parts"]]))
+            contents.append(Content(role="model", parts=[Part.from_text(turn["response"])]))
+            preamble = []
+        contents.append(Content(role="user", parts=[to_part(part) for part in preamble + parts]))
+        return contents
+
+    def send_message(self, content, generation_config: Optional[Dict] = None, summary_text: Optional[str] = None,
+                     context: Optional[str] = None, context_ids: Optional[List[str]] = None):
+        """
+        Send a message with the compacted history and record the turn, like ChatSession.send_message.
+
+        Args:
+            content: The message, a part or list of parts
+            context: Retrieved text sent with this message only, not kept in the history
+            context_ids: IDs of the chunks in context, kept so they can be fetched again
+        """
+        parts = list(content) if isinstance(content, (list, tuple)) else [content]
+        outgoing = parts + [context] if context else parts
+        response = self.model.generate_content(self.build_contents(outgoing), generation_config=generation_config)
+        self.add_turn(parts, response.text, summary_text, context_ids)
+        return response
+
+
+class SessionCache:
+    """Bounded LRU cache of a worker's chat sessions by chat ID"""
+    def __init__(self, maxsize: int = CHAT_SESSION_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._sessions: "OrderedDict[str, CompactingChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, chat_id: str) -> Optional[CompactingChatSession]:
+        with self._lock:
+            session = self._sessions.get(chat_id)
+            if session is not None:
+                self._sessions.move_to_end(chat_id)
+            return session
+
+    def __setitem__(self, chat_id: str, session: CompactingChatSession) -> None:
+        with self._lock:
+            self._sessions[chat_id] = session
+            self._sessions.move_to_end(chat_id)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
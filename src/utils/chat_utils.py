@@ -7,6 +7,15 @@ import glob
 import base64
 import traceback
 import io
+from .metrics import CHAT_HISTORY_SECONDS, timed
+from .tracing import traced
+
+# ChatHistoryManager operation latencies
+SAVE_CHAT_SECONDS = CHAT_HISTORY_SECONDS.labels("save_chat")
+GET_CHAT_SECONDS = CHAT_HISTORY_SECONDS.labels("get_chat")
+GET_RECENT_CHATS_SECONDS = CHAT_HISTORY_SECONDS.labels("get_recent_chats")
+SAVE_IMAGE_SECONDS = CHAT_HISTORY_SECONDS.labels("save_image")
+LOAD_IMAGE_SECONDS = CHAT_HISTORY_SECONDS.labels("load_image")
         
 class ChatHistoryManager:
     def __init__(self, model, history_dir: str = "chat-history"):
@@ -25,6 +34,7 @@ class ChatHistoryManager:
         """Get the full file path for a chat JSON file"""
         return os.path.join(self.history_dir, session_id, f"{chat_id}.json")
     
+    @timed(SAVE_IMAGE_SECONDS)
     def _save_image(self, chat_id: str, message_id: str, image_data: str) -> str:
         """
         Save image data to a file and return the relative path.
@@ -66,6 +76,7 @@ class ChatHistoryManager:
             traceback.print_exc()
             return ""
 
+    @timed(LOAD_IMAGE_SECONDS)
     def _load_image(self, relative_path: str) -> Optional[str]:
         """
         Load image data from file and return as base64.
@@ -87,12 +98,28 @@ class ChatHistoryManager:
             traceback.print_exc()
         return None
     
+    @timed(SAVE_CHAT_SECONDS)
+    @traced("chat_history.save_chat")
     def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
         """Save a chat to both memory and file, handling images separately"""
         chat_dir = os.path.join(self.history_dir,session_id)
         os.makedirs(chat_dir, exist_ok=True)
+        self._save_images(chat_to_save)
         
-        # Process messages to save images separately
+        # Save chat data, replaced in one step so other workers never read half a file
+        filepath = self._get_chat_filepath(chat_to_save["chat_id"], session_id)
+        temp_path = f"{filepath}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(chat_to_save, f, indent=2, ensure_ascii=False)    
+            os.replace(temp_path, filepath)
+        except Exception as e:
+            print(f"Error saving chat {chat_to_save['chat_id']}: {str(e)}")
+            traceback.print_exc()
+            raise e
+
+    def _save_images(self, chat_to_save: Dict) -> None:
+        """Move message images out of the chat into files, replacing them with image_path"""
         for message in chat_to_save["messages"]:
             if "image" in message and message["image"] is not None:
                 #print("image:",message["image"])
@@ -105,17 +132,9 @@ class ChatHistoryManager:
                 if image_path:
                     message["image_path"] = image_path
                 del message["image"]
-        
-        # Save chat data
-        filepath = self._get_chat_filepath(chat_to_save["chat_id"], session_id)
-        try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(chat_to_save, f, indent=2, ensure_ascii=False)    
-        except Exception as e:
-            print(f"Error saving chat {chat_to_save['chat_id']}: {str(e)}")
-            traceback.print_exc()
-            raise e
 
+    @timed(GET_CHAT_SECONDS)
+    @traced("chat_history.get_chat")
     def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
         """Get a specific chat by ID"""
         filepath = os.path.join(self.history_dir,session_id,f"{chat_id}.json")
@@ -128,6 +147,8 @@ class ChatHistoryManager:
             traceback.print_exc()
         return chat_data
     
+    @timed(GET_RECENT_CHATS_SECONDS)
+    @traced("chat_history.get_recent_chats")
     def get_recent_chats(self, session_id: str, limit: Optional[int] = None) -> List[Dict]:
         """Get recent chats, optionally limited to a specific number"""        
         chat_dir = os.path.join(self.history_dir,session_id)
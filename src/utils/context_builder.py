@@ -0,0 +1,190 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Prompt context limits, the retriever returns up to CONTEXT_CANDIDATES chunks to choose from
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 400))
+CONTEXT_CANDIDATES = int(os.environ.get("CONTEXT_CANDIDATES", 10))
+# Absolute cutoff, off by default as the scale depends on the collection's distance function
+CONTEXT_MAX_DISTANCE = float(os.environ["CONTEXT_MAX_DISTANCE"]) if os.environ.get("CONTEXT_MAX_DISTANCE") else None
+# Candidates further than best * (1 + gap) are much worse matches than the best one
+CONTEXT_RELATIVE_GAP = float(os.environ.get("CONTEXT_RELATIVE_GAP", 0.3))
+CHARS_PER_TOKEN = 4  # Gemini averages about 4 characters of English per token
+MIN_OVERLAP = 8  # Shorter matches between chunk ends are coincidence, not chunk_overlap
+ID_SUFFIX = re.compile(r"^(.*)-(\d+)$")
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def chunk_position(doc_id: str, metadata: Optional[Dict]) -> Tuple[Optional[str], Optional[int]]:
+    """
+    The book and position of a chunk, from its "<book hash>-<index>" ID and chunk_index metadata.
+
+    Returns:
+        Tuple[Optional[str], Optional[int]]: (book, chunk index), None where unknown
+    """
+    metadata = metadata or {}
+    match = ID_SUFFIX.match(doc_id)
+    # The ID prefix, since lexical-only hybrid hits come without metadata
+    book = match.group(1) if match else metadata.get("book")
+    index = metadata.get("chunk_index")
+    if index is None and match and "books" not in metadata:
+        # IDs of deduplicated chunks are row numbers after removal, not positions
+        index = int(match.group(2))
+    return book, index
+
+
+def overlap_length(first: str, second: str) -> int:
+    """Length of the longest suffix of first that is a prefix of second"""
+    if len(first) < MIN_OVERLAP or len(second) < MIN_OVERLAP:
+        return 0
+    probe = second[:MIN_OVERLAP]
+    start = first.find(probe, max(0, len(first) - len(second)))
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(probe, start + 1)
+    return 0
+
+
+def join_chunks(first: str, second: str) -> str:
+    """Concatenate neighbouring chunks, keeping text they share only once"""
+    overlap = overlap_length(first, second)
+    if overlap:
+        return first + second[overlap:]
+    if first[-1:].isspace() or second[:1].isspace():
+        return first + second
+    return first + " " + second
+
+
+def merge_passages(chunks: List[Dict]) -> List[Dict]:
+    """
+    Merge chunks that are neighbours in the same book into passages.
+
+    Args:
+        chunks: Dicts with "id", "document", "book", "index" and "rank"
+
+    Returns:
+        List[Dict]: Passages with "text" and "ids", best ranked first
+    """
+    groups: Dict[object, List[Dict]] = {}
+    for chunk in chunks:
+        key = chunk["book"] if chunk["index"] is not None else ("unplaced", chunk["id"])
+        groups.setdefault(key, []).append(chunk)
+
+    passages = []
+    for group in groups.values():
+        group.sort(key=lambda chunk: chunk["index"] if chunk["index"] is not None else 0)
+        current = None
+        for chunk in group:
+            if current is not None and chunk["index"] is not None and chunk["index"] <= current["last_index"] + 1:
+                current["text"] = join_chunks(current["text"], chunk["document"])
+                current["ids"].append(chunk["id"])
+                current["last_index"] = chunk["index"]
+                current["rank"] = min(current["rank"], chunk["rank"])
+                continue
+            current = {"text": chunk["document"], "ids": [chunk["id"]], "last_index": chunk["index"], "rank": chunk["rank"]}
+            passages.append(current)
+
+    passages.sort(key=lambda passage: passage["rank"])
+    return [{"text": passage["text"], "ids": passage["ids"]} for passage in passages]
+
+
+def build_context(results: Dict, token_budget: int = CONTEXT_TOKEN_BUDGET, max_distance: Optional[float] = CONTEXT_MAX_DISTANCE,
+                  relative_gap: Optional[float] = CONTEXT_RELATIVE_GAP, min_results: int = 1) -> Dict:
+    """
+    Pick and assemble the retrieved chunks that go into the prompt.
+
+    Candidates are taken in rank order, skipping those past the distance cutoff
+    or relative gap, until the token budget is reached. Neighbouring chunks from
+    the same book are merged so text shared through chunk_overlap is sent once.
+
+    Args:
+        results: Chroma-style query results for a single query
+        token_budget: Maximum estimated tokens of context
+        max_distance: Drop candidates further than this
+        relative_gap: Drop candidates further than the best distance times (1 + relative_gap)
+        min_results: Keep at least this many candidates regardless of distance
+
+    Returns:
+        Dict: "text" for the prompt, "passages", the chunk "ids" used, estimated "tokens",
+            and how many candidates were "dropped" by distance or "over_budget"
+    """
+    ids = results["ids"][0]
+    documents = results["documents"][0]
+    metadatas = (results.get("metadatas") or [None])[0] or [None] * len(ids)
+    distances = (results.get("distances") or [None])[0] or [None] * len(ids)
+
+    known = [distance for distance in distances if distance is not None]
+    best = min(known) if known else None
+    candidates = []
+    dropped = 0
+    for rank, (doc_id, document, metadata, distance) in enumerate(zip(ids, documents, metadatas, distances)):
+        if distance is not None and len(candidates) >= min_results:
+            too_far = max_distance is not None and distance > max_distance
+            gapped = relative_gap is not None and best is not None and distance > best * (1 + relative_gap)
+            if too_far or gapped:
+                dropped += 1
+                continue
+        book, index = chunk_position(doc_id, metadata)
+        candidates.append({"id": doc_id, "document": document, "book": book, "index": index, "rank": rank})
+
+    selected: List[Dict] = []
+    passages: List[Dict] = []
+    for candidate in candidates:
+        trial = merge_passages(selected + [candidate])
+        if sum(estimate_tokens(passage["text"]) for passage in trial) > token_budget:
+            if not selected:
+                # A single chunk larger than the budget is cut rather than sending no context
+                trial[0]["text"] = trial[0]["text"][:token_budget * CHARS_PER_TOKEN]
+                selected, passages = [candidate], trial
+            break
+        selected.append(candidate)
+        passages = trial
+
+    text = "\n\n".join(passage["text"] for passage in passages)
+    return {
+        "text": text,
+        "passages": passages,
+        "ids": [passage_id for passage in passages for passage_id in passage["ids"]],
+        "tokens": estimate_tokens(text),
+        "dropped": dropped,
+        "over_budget": len(candidates) - len(selected),
+    }
+
+
+def add_recalled(results: Dict, recalled: Dict, order: Optional[List[str]] = None) -> Dict:
+    """
+    Put chunks fetched with collection.get ahead of query results, e.g. an earlier turn's context.
+
+    Recalled chunks have no distance, so the cutoffs in build_context keep them.
+
+    Args:
+        results: Chroma-style query results for a single query
+        recalled: collection.get results
+        order: Chunk IDs in the order to use, collection.get does not keep the requested order
+
+    Returns:
+        Dict: Chroma-style results for a single query
+    """
+    rows = {doc_id: (document, metadata) for doc_id, document, metadata in zip(
+        recalled["ids"], recalled["documents"], recalled.get("metadatas") or [None] * len(recalled["ids"]))}
+    ids, documents, metadatas, distances = [], [], [], []
+    for doc_id in order or recalled["ids"]:
+        if doc_id not in rows:
+            continue
+        ids.append(doc_id)
+        documents.append(rows[doc_id][0])
+        metadatas.append(rows[doc_id][1])
+        distances.append(None)
+    result_metadatas = (results.get("metadatas") or [None])[0] or [None] * len(results["ids"][0])
+    result_distances = (results.get("distances") or [None])[0] or [None] * len(results["ids"][0])
+    for doc_id, document, metadata, distance in zip(results["ids"][0], results["documents"][0], result_metadatas, result_distances):
+        if doc_id not in rows:
+            ids.append(doc_id)
+            documents.append(document)
+            metadatas.append(metadata)
+            distances.append(distance)
+    return {"ids": [ids], "documents": [documents], "metadatas": [metadatas], "distances": [distances]}
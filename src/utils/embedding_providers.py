@@ -0,0 +1,246 @@
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "vertex")  # vertex | hashing
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_DIMENSION = 256
+# Existing collections were embedded with this task type for both documents and queries
+TASK_TYPE = "RETRIEVAL_DOCUMENT"
+# Texts over the per-text token limit are cut at the limit ("truncate") or embedded in pieces and averaged ("split")
+EMBEDDING_OVERSIZE_POLICY = os.environ.get("EMBEDDING_OVERSIZE_POLICY", "truncate")
+# Token estimates err high, clinical vocabulary splits into more tokens than everyday English
+EMBEDDING_CHARS_PER_TOKEN = 3
+# Vertex AI rejects requests that are over its limits with messages like
+# "the input token count is 20345 but the model supports up to 20000"
+TOKEN_LIMIT_ERROR = re.compile(r"token count|too many tokens|supports up to \d+", re.IGNORECASE)
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // EMBEDDING_CHARS_PER_TOKEN)
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """Split text into pieces of at most max_chars, at whitespace where possible"""
+    pieces = []
+    while len(text) > max_chars:
+        cut = text.rfind(" ", max_chars // 2, max_chars + 1)
+        cut = cut if cut > 0 else max_chars
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip()
+    if text or not pieces:
+        pieces.append(text)
+    return pieces
+
+
+class EmbeddingProvider(ABC):
+    """
+    Base class for embedding backends.
+
+    Subclasses implement _embed_batch; batching and concurrent requests are handled here.
+
+    Attributes:
+        dimension: Length of the returned vectors
+        max_batch_size: Maximum texts per request
+        max_batch_tokens: Maximum estimated tokens per request, None for no limit
+        max_text_tokens: Maximum estimated tokens per text, None for no limit
+        oversize_policy: "truncate" or "split" texts over max_text_tokens
+        max_concurrency: Maximum requests in flight
+    """
+    dimension: int = EMBEDDING_DIMENSION
+    max_batch_size: int = 250
+    max_batch_tokens: Optional[int] = None
+    max_text_tokens: Optional[int] = None
+    oversize_policy: str = EMBEDDING_OVERSIZE_POLICY
+    max_concurrency: int = 1
+
+    @abstractmethod
+    def _embed_batch(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed one request's worth of texts"""
+
+    def fit_texts(self, texts: List[str]) -> Tuple[List[str], List[int]]:
+        """
+        Apply the oversize policy to texts over max_text_tokens.
+
+        Returns:
+            Tuple[List[str], List[int]]: Texts to embed, and the input text each came from
+        """
+        if self.max_text_tokens is None:
+            return texts, list(range(len(texts)))
+        if self.oversize_policy not in ("truncate", "split"):
+            raise ValueError(f"Unknown oversize policy: {self.oversize_policy}")
+        max_chars = self.max_text_tokens * EMBEDDING_CHARS_PER_TOKEN
+        pieces, owners = [], []
+        for i, text in enumerate(texts):
+            if len(text) <= max_chars:
+                pieces.append(text)
+                owners.append(i)
+                continue
+            text_pieces = split_text(text, max_chars)
+            if self.oversize_policy == "truncate":
+                text_pieces = text_pieces[:1]
+            pieces.extend(text_pieces)
+            owners.extend([i] * len(text_pieces))
+        return pieces, owners
+
+    def pack_batches(self, texts: List[str], batch_size: Optional[int] = None) -> List[List[str]]:
+        """Fill each request in order, up to batch_size texts and max_batch_tokens estimated tokens"""
+        batch_size = min(batch_size or self.max_batch_size, self.max_batch_size)
+        batches: List[List[str]] = []
+        batch: List[str] = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = estimate_tokens(text)
+            full = len(batch) >= batch_size or (self.max_batch_tokens is not None and batch_tokens + tokens > self.max_batch_tokens)
+            if batch and full:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _embed_packed(self, texts: List[str], task_type: str) -> List[List[float]]:
+        """Embed one packed batch, halving it if the service still finds it over the token limit"""
+        try:
+            return self._embed_batch(texts, task_type)
+        except Exception as e:
+            if len(texts) < 2 or not TOKEN_LIMIT_ERROR.search(str(e)):
+                raise
+            print(f"Embedding batch of {len(texts)} texts over the token limit, splitting it: {e}")
+            middle = len(texts) // 2
+            return self._embed_packed(texts[:middle], task_type) + self._embed_packed(texts[middle:], task_type)
+
+    def embed_documents(self, texts: List[str], batch_size: Optional[int] = None, task_type: str = TASK_TYPE) -> List[List[float]]:
+        """
+        Embed texts in token-aware batches of at most batch_size, running batches concurrently.
+
+        Returns:
+            List[List[float]]: One vector per text, in input order
+        """
+        texts = list(texts)
+        pieces, owners = self.fit_texts(texts)
+        batches = self.pack_batches(pieces, batch_size)
+        if len(batches) <= 1 or self.max_concurrency <= 1:
+            results = [self._embed_packed(batch, task_type) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                results = list(executor.map(lambda batch: self._embed_packed(batch, task_type), batches))
+        vectors = [vector for batch in results for vector in batch]
+        if len(pieces) == len(texts):
+            return vectors
+        return self._combine_pieces(pieces, owners, vectors, len(texts))
+
+    @staticmethod
+    def _combine_pieces(pieces: List[str], owners: List[int], vectors: List[List[float]], count: int) -> List[List[float]]:
+        """Average the vectors of split texts weighted by piece length, scaled to the norm of their pieces"""
+        groups: List[List[Tuple[str, List[float]]]] = [[] for _ in range(count)]
+        for piece, owner, vector in zip(pieces, owners, vectors):
+            groups[owner].append((piece, vector))
+        results = []
+        for group in groups:
+            if len(group) == 1:
+                results.append(group[0][1])
+                continue
+            matrix = np.asarray([vector for _, vector in group], dtype=np.float64)
+            weights = np.asarray([max(len(piece), 1) for piece, _ in group], dtype=np.float64)
+            mean = weights @ matrix / weights.sum()
+            norm = np.linalg.norm(mean)
+            target = np.linalg.norm(matrix, axis=1).mean()
+            results.append((mean * (target / norm) if norm else mean).tolist())
+        return results
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several queries, batched into as few requests as possible"""
+        return self.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query"""
+        return self.embed_queries([text])[0]
+
+
+class VertexEmbeddingProvider(EmbeddingProvider):
+    """Vertex AI text embeddings, the model is loaded on first use"""
+    # https://cloud.google.com/vertex-ai/generative-ai/docs/embeddings/get-text-embeddings#api_limits
+    max_batch_size = 250
+    max_batch_tokens = int(os.environ.get("EMBEDDING_MAX_BATCH_TOKENS", 20000))
+    max_text_tokens = 2048
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, dimension: int = EMBEDDING_DIMENSION, max_concurrency: int = 4, model=None):
+        self.model_name = model_name
+        self.dimension = dimension
+        self.max_concurrency = max_concurrency
+        self._model = model
+
+    @property
+    def model(self):
+        if self._model is None:
+            # https://cloud.google.com/vertex-ai/generative-ai/docs/model-reference/text-embeddings-api#python
+            from vertexai.language_models import TextEmbeddingModel
+            self._model = TextEmbeddingModel.from_pretrained(self.model_name)
+        return self._model
+
+    def _embed_batch(self, texts: List[str], task_type: str) -> List[List[float]]:
+        from vertexai.language_models import TextEmbeddingInput
+        inputs = [TextEmbeddingInput(text, task_type) for text in texts]
+        kwargs = dict(output_dimensionality=self.dimension) if self.dimension else {}
+        embeddings = self.model.get_embeddings(inputs, **kwargs)
+        return [embedding.values for embedding in embeddings]
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Offline embeddings from feature hashing plus a fixed random projection.
+
+    Unigrams and bigrams are hashed into n_features signed buckets and projected
+    to dimension with a seeded Gaussian matrix, then L2 normalized. Texts sharing
+    vocabulary get similar vectors, no network or model weights are needed.
+    """
+    max_batch_size = 1000
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION, n_features: int = 2 ** 14, seed: int = 0):
+        self.dimension = dimension
+        self.n_features = n_features
+        rng = np.random.default_rng(seed)
+        self.projection = (rng.standard_normal((n_features, dimension)) / np.sqrt(dimension)).astype(np.float32)
+
+    def _features(self, text: str):
+        tokens = re.findall(r"[a-z0-9]+", text.lower())
+        features = tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+        hashes = np.fromiter((zlib.crc32(feature.encode("utf-8")) for feature in features), dtype=np.uint32, count=len(features))
+        # The top bit chooses the sign, so collisions cancel out on average
+        signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+        return hashes % self.n_features, signs
+
+    def _embed_batch(self, texts: List[str], task_type: str) -> List[List[float]]:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text in enumerate(texts):
+            indexes, signs = self._features(text)
+            if len(indexes):
+                vectors[i] = signs @ self.projection[indexes]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        return vectors.tolist()
+
+
+PROVIDERS = {
+    "vertex": VertexEmbeddingProvider,
+    "hashing": HashingEmbeddingProvider,
+}
+_providers: Dict[str, EmbeddingProvider] = {}
+
+
+def get_embedding_provider(name: Optional[str] = None) -> EmbeddingProvider:
+    """Return the shared provider for name, defaulting to the EMBEDDING_PROVIDER setting"""
+    name = name or EMBEDDING_PROVIDER
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown embedding provider: {name}")
+    if name not in _providers:
+        _providers[name] = PROVIDERS[name]()
+    return _providers[name]
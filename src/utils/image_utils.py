@@ -0,0 +1,220 @@
+import os
+import io
+import hashlib
+import threading
+import traceback
+from functools import lru_cache
+from typing import Optional, Tuple
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .metrics import CACHE_REQUESTS
+
+# Preprocessing settings for images sent to the model
+IMAGE_MAX_EDGE = int(os.environ.get("IMAGE_MAX_EDGE", 1024))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "JPEG").upper()  # JPEG | WEBP
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_CACHE_DIR = os.environ.get("IMAGE_CACHE_DIR", os.path.join("chat-history", "llm-rag", "image-cache"))
+THUMBNAIL_MAX_EDGE = int(os.environ.get("THUMBNAIL_MAX_EDGE", 256))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 70))
+
+IMAGE_CACHE_HIT = CACHE_REQUESTS.labels("image", "hit")
+IMAGE_CACHE_MISS = CACHE_REQUESTS.labels("image", "miss")
+THUMBNAIL_CACHE_HIT = CACHE_REQUESTS.labels("thumbnail", "hit")
+THUMBNAIL_CACHE_MISS = CACHE_REQUESTS.labels("thumbnail", "miss")
+
+FORMAT_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+    "PNG": "image/png",
+}
+FORMAT_EXTENSIONS = {
+    "JPEG": ".jpg",
+    "WEBP": ".webp",
+    "PNG": ".png",
+}
+
+
+def image_hash(image_bytes: bytes) -> str:
+    """Return the content hash used to key processed image variants"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def resize_image(image_bytes: bytes, max_edge: int, image_format: str, quality: int) -> bytes:
+    """
+    Downscale an image so its longest edge is at most max_edge and re-encode it.
+
+    Args:
+        image_bytes: The original encoded image
+        max_edge: Maximum length of the longest edge in pixels
+        image_format: Output format, JPEG or WEBP
+        quality: Encoder quality (1-100)
+
+    Returns:
+        bytes: The re-encoded image
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        # Apply EXIF orientation so phone photos are not sent sideways
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if image_format == "JPEG" and image.mode != "RGB":
+            # JPEG has no alpha channel, flatten onto white
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+
+        output = io.BytesIO()
+        image.save(output, format=image_format, quality=quality, optimize=True)
+        return output.getvalue()
+
+
+def preprocess_image(
+    image_bytes: bytes,
+    mime_type: str = "image/jpeg",
+    max_edge: int = IMAGE_MAX_EDGE,
+    image_format: str = IMAGE_FORMAT,
+    quality: int = IMAGE_QUALITY,
+    cache_dir: str = IMAGE_CACHE_DIR,
+) -> Tuple[bytes, str]:
+    """
+    Prepare an image for the model: downscale, recompress and cache on disk.
+
+    The processed variant is cached under cache_dir keyed by the hash of the
+    original bytes and the processing settings, so rebuilding a chat session
+    does not decode and re-encode the same image again.
+
+    Args:
+        image_bytes: The original encoded image
+        mime_type: MIME type of the original, used if processing fails
+
+    Returns:
+        Tuple[bytes, str]: The processed image bytes and their MIME type
+    """
+    image_format = image_format.upper()
+    if image_format not in FORMAT_MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    processed_mime_type = FORMAT_MIME_TYPES[image_format]
+
+    cache_path = None
+    if cache_dir:
+        key = f"{image_hash(image_bytes)}-{max_edge}-{quality}{FORMAT_EXTENSIONS[image_format]}"
+        cache_path = os.path.join(cache_dir, key[:2], key)
+        if os.path.exists(cache_path):
+            IMAGE_CACHE_HIT.inc()
+            with open(cache_path, "rb") as f:
+                return f.read(), processed_mime_type
+        IMAGE_CACHE_MISS.inc()
+
+    try:
+        processed_bytes = resize_image(image_bytes, max_edge, image_format, quality)
+    except (UnidentifiedImageError, OSError) as e:
+        print(f"Error preprocessing image, sending original: {str(e)}")
+        return image_bytes, mime_type
+
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # Write to a temp file first so concurrent readers never see a partial file
+            tmp_path = f"{cache_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(processed_bytes)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Error caching processed image: {str(e)}")
+            traceback.print_exc()
+
+    return processed_bytes, processed_mime_type
+
+
+@lru_cache(maxsize=4096)
+def _content_etag(path: str, mtime_ns: int, size: int) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return f'"{hasher.hexdigest()}"'
+
+
+def file_etag(path: str) -> str:
+    """
+    Return a strong ETag for a file derived from its content hash.
+
+    The hash is memoized on (path, mtime, size) so repeat requests only cost a stat.
+    """
+    stat = os.stat(path)
+    return _content_etag(path, stat.st_mtime_ns, stat.st_size)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header value against an ETag"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison is used for If-None-Match
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+def parse_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse a single HTTP byte range.
+
+    Args:
+        range_header: The Range header value, e.g. "bytes=0-1023" or "bytes=-500"
+        file_size: Size of the file in bytes
+
+    Returns:
+        Optional[Tuple[int, int]]: Inclusive (start, end) offsets, or None if unsatisfiable
+
+    Raises:
+        ValueError: If the header is malformed or requests multiple ranges
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        raise ValueError(f"Unsupported range: {range_header}")
+    start_str, sep, end_str = ranges.strip().partition("-")
+    if not sep:
+        raise ValueError(f"Malformed range: {range_header}")
+
+    if start_str == "":
+        # Suffix range: the last N bytes
+        length = int(end_str)
+        if length <= 0 or file_size == 0:
+            return None
+        return max(file_size - length, 0), file_size - 1
+
+    start = int(start_str)
+    end = int(end_str) if end_str else file_size - 1
+    if start >= file_size or end < start:
+        return None
+    return start, min(end, file_size - 1)
+
+
+def thumbnail_path(
+    image_path: str,
+    etag: str,
+    max_edge: int = THUMBNAIL_MAX_EDGE,
+    quality: int = THUMBNAIL_QUALITY,
+    cache_dir: str = IMAGE_CACHE_DIR,
+) -> str:
+    """
+    Return the path to a small JPEG preview of an image, creating it if needed.
+
+    Thumbnails are content-addressed by the source image's ETag.
+    """
+    content_hash = etag.strip('"')
+    key = f"{content_hash}-{max_edge}-{quality}.jpg"
+    path = os.path.join(cache_dir, "thumbs", key[:2], key)
+    if os.path.exists(path):
+        THUMBNAIL_CACHE_HIT.inc()
+    else:
+        THUMBNAIL_CACHE_MISS.inc()
+        with open(image_path, "rb") as f:
+            thumbnail = resize_image(f.read(), max_edge, "JPEG", quality)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(thumbnail)
+        os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,242 @@
+import re
+import json
+import math
+import gzip
+from bisect import bisect_left
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase and split text into alphanumeric terms"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over the same chunk IDs stored in the vector db.
+
+    Postings map each term to {document position: term frequency}, so term
+    lookups and filters are posting-list intersections instead of scans.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.doc_lengths: List[int] = []
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self._positions: Dict[str, int] = {}
+        # Sorted terms and sorted reversed terms for prefix and suffix lookups, built on first use
+        self._vocabulary: Optional[Tuple[List[str], List[str]]] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, ids: List[str], documents: List[str]) -> None:
+        """Index documents under their chunk IDs"""
+        for doc_id, document in zip(ids, documents):
+            position = len(self.ids)
+            terms = tokenize(document)
+            self.ids.append(doc_id)
+            self.documents.append(document)
+            self.doc_lengths.append(len(terms))
+            self._positions[doc_id] = position
+            for term, frequency in Counter(terms).items():
+                self.postings.setdefault(term, {})[position] = frequency
+        self._vocabulary = None
+
+    def document(self, doc_id: str) -> Optional[str]:
+        """Return the text of an indexed chunk"""
+        position = self._positions.get(doc_id)
+        return self.documents[position] if position is not None else None
+
+    def _intersect(self, terms: List[str]) -> List[int]:
+        postings = [self.postings.get(term) for term in set(terms)]
+        if not postings or any(posting is None for posting in postings):
+            return []
+        # Intersect starting from the shortest posting list
+        postings.sort(key=len)
+        positions = set(postings[0])
+        for posting in postings[1:]:
+            positions.intersection_update(posting)
+            if not positions:
+                break
+        return sorted(positions)
+
+    def lookup(self, text: str) -> List[str]:
+        """IDs of chunks containing every term of text"""
+        return [self.ids[position] for position in self._intersect(tokenize(text))]
+
+    def _edge_terms(self, fragment: str, at_start: bool, at_end: bool) -> List[str]:
+        """Indexed terms that a fragment cut off by the start and/or end of the search text can be part of"""
+        if self._vocabulary is None:
+            self._vocabulary = (sorted(self.postings), sorted(term[::-1] for term in self.postings))
+        terms, reversed_terms = self._vocabulary
+        if at_start and at_end:
+            return [term for term in terms if fragment in term]
+        if at_start:
+            # Cut off on the left, so the chunk's word ends with the fragment
+            return [term[::-1] for term in _with_prefix(reversed_terms, fragment[::-1])]
+        return _with_prefix(terms, fragment)
+
+    def contains(self, text: str) -> List[str]:
+        """
+        IDs of chunks containing text as a substring, like Chroma's $contains.
+
+        Candidates are the intersection of the posting lists of the whole words in text and,
+        for the words at either end that may continue in the chunk (e.g. "Ital" in "Italian"),
+        the union of the posting lists of the indexed terms they can be part of. Only the
+        candidates are checked for the exact substring.
+        """
+        lowered = text.lower()
+        candidates = None
+        for match in TOKEN_PATTERN.finditer(lowered):
+            at_start, at_end = match.start() == 0, match.end() == len(lowered)
+            if at_start or at_end:
+                positions = set()
+                for term in self._edge_terms(match.group(), at_start, at_end):
+                    positions.update(self.postings[term])
+            else:
+                positions = set(self.postings.get(match.group(), ()))
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                return []
+        if candidates is None:
+            # Nothing to look up, e.g. only punctuation
+            return [doc_id for doc_id, document in zip(self.ids, self.documents) if text in document]
+        return [self.ids[position] for position in sorted(candidates) if text in self.documents[position]]
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Rank chunks against a query with BM25.
+
+        Returns:
+            List[Tuple[str, float]]: Up to k (chunk ID, score) pairs, best first
+        """
+        if not self.ids:
+            return []
+        n_docs = len(self.ids)
+        avg_length = sum(self.doc_lengths) / n_docs
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for position, frequency in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[position] / avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [(self.ids[position], score) for position, score in ranked]
+
+    def save(self, path: str) -> None:
+        """Persist the index as gzipped JSON"""
+        data = {
+            "k1": self.k1,
+            "b": self.b,
+            "ids": self.ids,
+            "documents": self.documents,
+            "doc_lengths": self.doc_lengths,
+            "postings": {term: list(posting.items()) for term, posting in self.postings.items()},
+        }
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """Load an index saved with save()"""
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        index.ids = data["ids"]
+        index.documents = data["documents"]
+        index.doc_lengths = data["doc_lengths"]
+        index.postings = {term: dict(map(tuple, posting)) for term, posting in data["postings"].items()}
+        index._positions = {doc_id: position for position, doc_id in enumerate(index.ids)}
+        return index
+
+
+def _with_prefix(sorted_terms: List[str], prefix: str) -> List[str]:
+    start = bisect_left(sorted_terms, prefix)
+    end = start
+    while end < len(sorted_terms) and sorted_terms[end].startswith(prefix):
+        end += 1
+    return sorted_terms[start:end]
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """
+    Fuse several ranked ID lists with reciprocal rank fusion.
+
+    Args:
+        ranked_lists: Lists of IDs, best first
+        k: Damping constant, larger values flatten the contribution of top ranks
+
+    Returns:
+        List[Tuple[str, float]]: (ID, fused score) pairs, best first
+    """
+    scores: Dict[str, float] = {}
+    for ranked in ranked_lists:
+        for rank, doc_id in enumerate(ranked):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+def hybrid_query(collection, index: BM25Index, query_text: str, query_embedding: List[float], n_results: int = 5, candidates: int = 20, where: Optional[Dict] = None) -> Dict:
+    """
+    Retrieve chunks by fusing dense vector db results with BM25 results.
+
+    Returns:
+        Dict: Chroma-style results with "ids", "documents", "metadatas" and "distances"
+            for a single query. Chunks found only lexically have no metadata or distance.
+    """
+    query_kwargs = {"where": where} if where else {}
+    dense = collection.query(
+        query_embeddings=[query_embedding],
+        n_results=candidates,
+        **query_kwargs
+    )
+    dense_ids = dense["ids"][0]
+    dense_metadatas = (dense.get("metadatas") or [None])[0] or [None] * len(dense_ids)
+    dense_distances = (dense.get("distances") or [None])[0] or [None] * len(dense_ids)
+    dense_rows = {
+        doc_id: row
+        for doc_id, *row in zip(dense_ids, dense["documents"][0], dense_metadatas, dense_distances)
+    }
+    lexical_ids = [doc_id for doc_id, _ in index.search(query_text, k=candidates)]
+    if where:
+        # Metadata filters only apply to the dense side, keep lexical hits that passed it
+        lexical_ids = [doc_id for doc_id in lexical_ids if doc_id in dense_rows]
+
+    ids, documents, metadatas, distances = [], [], [], []
+    for doc_id, _ in reciprocal_rank_fusion([dense_ids, lexical_ids])[:n_results]:
+        document, metadata, distance = dense_rows.get(doc_id, (index.document(doc_id), None, None))
+        ids.append(doc_id)
+        documents.append(document)
+        metadatas.append(metadata)
+        distances.append(distance)
+    return {"ids": [ids], "documents": [documents], "metadatas": [metadatas], "distances": [distances]}
+
+
+def filtered_query(collection, index: BM25Index, search_string: str, query_embedding: List[float], n_results: int = 10) -> Dict:
+    """
+    Dense query restricted to chunks containing search_string.
+
+    Replaces where_document={"$contains": ...}: candidates come from posting-list
+    intersections and the vector db ranks only those, so no embeddings are transferred.
+
+    Returns:
+        Dict: Chroma-style results for a single query
+    """
+    candidate_ids = index.contains(search_string)
+    if not candidate_ids:
+        return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+    return collection.query(
+        query_embeddings=[query_embedding],
+        ids=candidate_ids,
+        n_results=n_results
+    )
@@ -1,20 +1,29 @@
 import os
-from typing import Dict, Any, List, Optional
+import time
+import threading
+from typing import Callable, Dict, Any, List, Optional, Tuple
 from fastapi import HTTPException
 import base64
 import io
 from PIL import Image
 from pathlib import Path
 import traceback
-import chromadb
-from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
-from vertexai.generative_models import GenerativeModel, ChatSession, Part
+from vertexai.generative_models import GenerativeModel, Part
+from .image_utils import preprocess_image
+from .lexical_index import BM25Index, hybrid_query
+from .context_builder import build_context, add_recalled, CONTEXT_CANDIDATES
+from .chat_session import CompactingChatSession, SessionCache, refers_back
+from .session_store import SessionStore, compress_json, decompress_json
+from .embedding_providers import get_embedding_provider
+from .metrics import CHAT_STAGE_SECONDS, LLM_TOKENS, ERRORS, ACTIVE_SESSIONS
+from .tracing import span
+from .retry import with_retries
+from .vector_store import VectorStore, QueryCoalescer, VECTOR_QUERY_BATCH_WAIT_MS
+from .batching import MicroBatcher
 
 # Setup
 GCP_PROJECT = os.environ["GCP_PROJECT"]
 GCP_LOCATION = "us-central1"
-EMBEDDING_MODEL = "text-embedding-004"
-EMBEDDING_DIMENSION = 256
 GENERATIVE_MODEL = "gemini-1.5-flash-002"
 CHROMADB_HOST = os.environ["CHROMADB_HOST"]
 CHROMADB_PORT = os.environ["CHROMADB_PORT"]
@@ -25,6 +34,8 @@ generation_config = {
     "temperature": 0.1,  # Control randomness in output
     "top_p": 0.95,  # Use nucleus sampling
 }
+# Sent with an image that comes without a question
+DEFAULT_IMAGE_PROMPT = "Name the cheese in the image, no descriptions needed"
 
 # Initialize the GenerativeModel with specific system instructions
 SYSTEM_INSTRUCTION = """
@@ -46,41 +57,183 @@ Remember:
 
 Your goal is to provide accurate, helpful information about clinical work based solely on the content of the text chunks you receive with each query.
 """
-generative_model = GenerativeModel(
-	GENERATIVE_MODEL,
-	system_instruction=[SYSTEM_INSTRUCTION]
-)
-# https://cloud.google.com/vertex-ai/generative-ai/docs/model-reference/text-embeddings-api#python
-embedding_model = TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL)
-
-# Initialize chat sessions
-chat_sessions: Dict[str, ChatSession] = {}
-
-# Connect to chroma DB
-client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+# Clients are created on first use (or by warm_up), so importing this module never needs the network
+generative_model: Optional[GenerativeModel] = None
+# Embedding backend, chosen with EMBEDDING_PROVIDER
+embedding_provider = None
+# One pooled chroma DB client for the process, connected on first use
+vector_store = VectorStore(host=CHROMADB_HOST, port=CHROMADB_PORT)
+_init_lock = threading.RLock()
+
+# Query embeddings of concurrent requests are sent together, each waits at most EMBEDDING_BATCH_WAIT_MS for others
+EMBEDDING_BATCH_WAIT_MS = float(os.environ.get("EMBEDDING_BATCH_WAIT_MS", 5))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 250))  # Vertex accepts at most 250 inputs per request
+EMBEDDING_BATCH_CONCURRENCY = int(os.environ.get("EMBEDDING_BATCH_CONCURRENCY", 2))  # Calls in flight, fewer means larger batches
+EMBEDDING_BATCH_TIMEOUT = float(os.environ.get("EMBEDDING_BATCH_TIMEOUT", 60))  # Seconds a request waits for its embedding
+query_embedding_batcher = MicroBatcher(lambda queries: get_embedding().embed_queries(queries), max_batch_size=EMBEDDING_BATCH_SIZE,
+                                       max_wait=EMBEDDING_BATCH_WAIT_MS / 1000, max_concurrency=EMBEDDING_BATCH_CONCURRENCY,
+                                       name="query_embedding")
+# Their vector db queries likewise, as one multi-embedding query per where filter
+query_coalescer = QueryCoalescer(lambda: get_collection())
+
+# This worker's copies of chat sessions, checked against the session store's version before use
+chat_sessions = SessionCache()
+ACTIVE_SESSIONS.set_function(lambda: len(chat_sessions))
+
+# Per-stage latency histograms, resolved once so each observation is a bisect and an add
+IMAGE_STAGE = CHAT_STAGE_SECONDS.labels("image")
+EMBED_STAGE = CHAT_STAGE_SECONDS.labels("embed")
+RETRIEVE_STAGE = CHAT_STAGE_SECONDS.labels("retrieve")
+GENERATE_STAGE = CHAT_STAGE_SECONDS.labels("generate")
+PROMPT_TOKENS = LLM_TOKENS.labels("in")
+COMPLETION_TOKENS = LLM_TOKENS.labels("out")
+GENERATE_ERRORS = ERRORS.labels("generate_chat_response")
+
 method = "recursive-split"
 collection_name = f"{method}-collection"
-# Get the collection
-collection = client.get_collection(name=collection_name)
+
+# Hybrid (dense + BM25) retrieval, using the lexical index saved by cli.py --load
+HYBRID_SEARCH = os.environ.get("HYBRID_SEARCH", "false").lower() == "true"
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH", os.path.join("outputs", f"bm25-{method}.json.gz"))
+lexical_index: Optional[BM25Index] = None
+
+def get_generative_model() -> GenerativeModel:
+    """Create the generative model on first use"""
+    global generative_model
+    if generative_model is None:
+        with _init_lock:
+            if generative_model is None:
+                generative_model = GenerativeModel(
+                    GENERATIVE_MODEL,
+                    system_instruction=[SYSTEM_INSTRUCTION]
+                )
+    return generative_model
+
+def get_embedding():
+    """Create the embedding provider on first use"""
+    global embedding_provider
+    if embedding_provider is None:
+        with _init_lock:
+            if embedding_provider is None:
+                embedding_provider = get_embedding_provider()
+    return embedding_provider
+
+def get_collection():
+    """The collection handle, shared by every request and reconnected if chroma DB restarts"""
+    return vector_store.collection(collection_name)
+
+def get_query_collection():
+    """The collection to query, coalescing the queries of concurrent requests unless VECTOR_QUERY_BATCH_WAIT_MS is 0"""
+    return query_coalescer if VECTOR_QUERY_BATCH_WAIT_MS > 0 else get_collection()
+
+def get_lexical_index() -> BM25Index:
+    """Load the lexical index on first use"""
+    global lexical_index
+    if lexical_index is None:
+        lexical_index = BM25Index.load(LEXICAL_INDEX_PATH)
+    return lexical_index
+
+def warm_up() -> Dict[str, float]:
+    """
+    Create every client and make one cheap call through each, so connection setup,
+    auth and lazy imports happen before the first chat rather than during it.
+
+    Returns:
+        Dict[str, float]: Seconds taken by each step
+    """
+    timings = {}
+
+    def step(name: str, function: Callable):
+        start = time.perf_counter()
+        result = function()
+        timings[name] = round(time.perf_counter() - start, 3)
+        return result
+
+    # Registers the image codecs, otherwise loaded by the first image upload
+    step("image_codecs", Image.init)
+    query_embedding = step("embedding", lambda: with_retries(lambda: get_embedding().embed_query("warm up"), "Embedding warm-up query"))
+    health = step("vector_store", vector_store.health_check)
+    if not health["ok"]:
+        raise ConnectionError(f"Chroma DB is not reachable: {health['error']}")
+    step("collection", lambda: get_collection().query(query_embeddings=[query_embedding], n_results=1))
+    if HYBRID_SEARCH:
+        step("lexical_index", get_lexical_index)
+    # Counting tokens opens the model's connection without paying for a generation
+    step("generative_model", lambda: with_retries(lambda: get_generative_model().count_tokens("warm up"), "Generative model warm-up"))
+    return timings
 
 def generate_query_embedding(query):
-	query_embedding_inputs = [TextEmbeddingInput(task_type='RETRIEVAL_DOCUMENT', text=query)]
-	kwargs = dict(output_dimensionality=EMBEDDING_DIMENSION) if EMBEDDING_DIMENSION else {}
-	embeddings = embedding_model.get_embeddings(query_embedding_inputs, **kwargs)
-	return embeddings[0].values
+	if EMBEDDING_BATCH_WAIT_MS <= 0:
+		return get_embedding().embed_query(query)
+	# Batched with the queries of concurrent requests into one embedding call
+	return query_embedding_batcher.submit(query, timeout=EMBEDDING_BATCH_TIMEOUT)
+
+def record_token_usage(response) -> Tuple[int, int]:
+    """Count prompt and completion tokens reported by the model, and return them"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return 0, 0
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    completion_tokens = getattr(usage, "candidates_token_count", 0) or 0
+    PROMPT_TOKENS.inc(prompt_tokens)
+    COMPLETION_TOKENS.inc(completion_tokens)
+    return prompt_tokens, completion_tokens
 
-def create_chat_session() -> ChatSession:
+def create_chat_session() -> CompactingChatSession:
     """Create a new chat session with the model"""
-    return generative_model.start_chat()
+    return CompactingChatSession(get_generative_model())
+
+def load_history_image(relative_path: str) -> Part:
+    """An image saved with the chat history, as a Part for the model"""
+    with IMAGE_STAGE.time(), span("preprocess_image", source="history"):
+        # Read the image file
+        image_path = os.path.join("chat-history","llm-rag",relative_path)
+        with Path(image_path).open('rb') as f:
+            image_bytes = f.read()
+
+        # Determine MIME type based on file extension
+        mime_type = {
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.png': 'image/png',
+            '.gif': 'image/gif'
+        }.get(Path(image_path).suffix.lower(), 'image/jpeg')
+
+        # Downscale and recompress, served from the on-disk cache on rebuilds
+        image_bytes, mime_type = preprocess_image(image_bytes, mime_type=mime_type)
+
+    # Create an image Part using FileData
+    return Part.from_data(image_bytes, mime_type=mime_type)
+
+def history_message_parts(message: Dict, include_image: bool = True) -> List:
+    """The parts of a user message from the chat history, its image and text"""
+    parts = []
+    if message.get("image_path") and include_image:
+        parts.append(load_history_image(message["image_path"]))
+    # Add text content if present
+    if message.get("content"):
+        parts.append(message["content"])
+    elif message.get("image_path"):
+        parts.append(DEFAULT_IMAGE_PROMPT)
+    return parts
+
+def summary_text(message: Dict) -> str:
+    """What a user message asked, without the retrieved context, for the history summary"""
+    content = message.get("content") or ""
+    if message.get("image") or message.get("image_path"):
+        return f"[image] {content}".strip()
+    return content
 
-def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
+def generate_chat_response(chat_session: CompactingChatSession, message: Dict, hybrid: Optional[bool] = None) -> str:
     """
     Generate a response using the chat session to maintain history.
     Handles both text and image inputs.
     
     Args:
-        chat_session: The Vertex AI chat session
-        message: Dict containing 'content' (text) and optionally 'image' (base64 string)
+        chat_session: The chat session holding the conversation so far
+        message: Dict containing 'content' (text) and optionally 'image' (base64 string),
+            'context_ids' of the retrieved chunks are added to it for the saved history
+        hybrid: Fuse dense and BM25 retrieval, defaults to the HYBRID_SEARCH setting
     
     Returns:
         str: The model's response
@@ -88,6 +241,7 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
     try:
         # Initialize parts list for the message
         message_parts = []
+        context_text, context_ids = None, None
         
         
         # Process image if present
@@ -102,8 +256,14 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
                     base64_data = base64_string
                     mime_type = 'image/jpeg'  # default to JPEG if no header
                 
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(base64_data)
+                with IMAGE_STAGE.time(), span("preprocess_image") as image_span:
+                    # Decode base64 to bytes
+                    image_bytes = base64.b64decode(base64_data)
+                    image_span.set_attribute("bytes_in", len(image_bytes))
+
+                    # Downscale and recompress before sending to the model
+                    image_bytes, mime_type = preprocess_image(image_bytes, mime_type=mime_type)
+                    image_span.set_attribute("bytes_out", len(image_bytes))
                 
                 # Create an image Part using FileData
                 image_part = Part.from_data(image_bytes, mime_type=mime_type)
@@ -113,7 +273,7 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
                 if message.get("content"):
                     message_parts.append(message["content"])
                 else:
-                    message_parts.append("Name the cheese in the image, no descriptions needed")
+                    message_parts.append(DEFAULT_IMAGE_PROMPT)
                 
             except ValueError as e:
                 print(f"Error processing image: {str(e)}")
@@ -122,57 +282,69 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
                     detail=f"Image processing failed: {str(e)}"
                 )
         elif message.get("image_path"):
-            # Read the image file
-            image_path = os.path.join("chat-history","llm-rag",message.get("image_path"))
-            with Path(image_path).open('rb') as f:
-                image_bytes = f.read()
-
-            # Determine MIME type based on file extension
-            mime_type = {
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.png': 'image/png',
-                '.gif': 'image/gif'
-            }.get(Path(image_path).suffix.lower(), 'image/jpeg')
-
-            # Create an image Part using FileData
-            image_part = Part.from_data(image_bytes, mime_type=mime_type)
-            message_parts.append(image_part)
-
-            # Add text content if present
-            if message.get("content"):
-                message_parts.append(message["content"])
-            else:
-                message_parts.append("Name the cheese in the image, no descriptions needed")
+            message_parts.extend(history_message_parts(message))
         else:
             # Add text content if present
             if message.get("content"):
                 # Create embeddings for the message content
-                query_embedding = generate_query_embedding(message["content"])
+                with EMBED_STAGE.time(), span("embed_query", query_chars=len(message["content"])):
+                    query_embedding = generate_query_embedding(message["content"])
                 # Retrieve chunks based on embedding value 
-                results = collection.query(
-                    query_embeddings=[query_embedding],
-                    n_results=5
-                )
-                INPUT_PROMPT = f"""
-                {message["content"]}
-                {"\n".join(results["documents"][0])}
-                """
-                message_parts.append(INPUT_PROMPT)
+                use_hybrid = HYBRID_SEARCH if hybrid is None else hybrid
+                with RETRIEVE_STAGE.time(), span("collection.query", n_results=CONTEXT_CANDIDATES, hybrid=use_hybrid) as retrieve_span:
+                    if use_hybrid:
+                        results = hybrid_query(
+                            get_query_collection(),
+                            get_lexical_index(),
+                            message["content"],
+                            query_embedding,
+                            n_results=CONTEXT_CANDIDATES
+                        )
+                    else:
+                        results = get_query_collection().query(
+                            query_embeddings=[query_embedding],
+                            n_results=CONTEXT_CANDIDATES
+                        )
+                    retrieve_span.set_attribute("results", len(results["documents"][0]))
+                # Asking about an earlier answer brings back the chunks it was based on
+                recalled_ids = chat_session.recent_context_ids() if refers_back(message["content"]) else []
+                if recalled_ids:
+                    with span("recall_context", chunks=len(recalled_ids)):
+                        recalled = get_collection().get(ids=recalled_ids, include=["documents", "metadatas"])
+                    results = add_recalled(results, recalled, order=recalled_ids)
+                # Keep the close matches that fit the token budget, merging neighbouring chunks
+                with span("build_context") as context_span:
+                    context = build_context(results)
+                    context_span.set_attributes(chunks=len(context["ids"]), passages=len(context["passages"]), tokens=context["tokens"],
+                                                dropped=context["dropped"], over_budget=context["over_budget"], recalled=len(recalled_ids))
+                message_parts.append(message["content"])
+                # The chunks go with this message only, the history and saved chat keep their IDs
+                context_text = context["text"]
+                context_ids = context["ids"]
+                message["context_ids"] = context_ids
                     
         
         if not message_parts:
             raise ValueError("Message must contain either text content or image")
 
         # Send message with all parts to the model
-        response = chat_session.send_message(
-            message_parts,
-            generation_config=generation_config
-        )
+        prompt_chars = sum(len(part) for part in message_parts if isinstance(part, str)) + len(context_text or "")
+        with GENERATE_STAGE.time(), span("send_message", parts=len(message_parts), prompt_chars=prompt_chars) as generate_span:
+            response = chat_session.send_message(
+                message_parts,
+                generation_config=generation_config,
+                summary_text=summary_text(message),
+                context=context_text,
+                context_ids=context_ids
+            )
+            prompt_tokens, completion_tokens = record_token_usage(response)
+            generate_span.set_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                         history_turns=len(chat_session.turns), compacted_turns=chat_session.compacted_turns)
         
         return response.text
         
     except Exception as e:
+        GENERATE_ERRORS.inc()
         print(f"Error generating response: {str(e)}")
         traceback.print_exc()
         raise HTTPException(
@@ -180,12 +352,80 @@ def generate_chat_response(chat_session: ChatSession, message: Dict) -> str:
             detail=f"Failed to generate response: {str(e)}"
         )
 
-def rebuild_chat_session(chat_history: List[Dict]) -> ChatSession:
-    """Rebuild a chat session with complete context"""
-    new_session = create_chat_session()
-    
+def history_turns(chat_history: List[Dict]) -> List[Tuple[Dict, str]]:
+    """The answered turns of a saved chat, as (user message, answer) pairs"""
+    turns = []
+    user_message = None
     for message in chat_history:
         if message["role"] == "user":
-            generate_chat_response(new_session, message)
+            user_message = message
+        elif message["role"] == "assistant" and user_message is not None:
+            turns.append((user_message, message.get("content", "")))
+            user_message = None
+    return turns
+
+def rebuild_chat_session(chat_history: List[Dict]) -> CompactingChatSession:
+    """
+    Rebuild a chat session from the saved messages, without calling the model.
+
+    Answers are taken from the history instead of being generated again. Only
+    the turns that stay verbatim load their images, older ones go into the summary.
+    """
+    with span("rebuild_chat_session", messages=len(chat_history)):
+        new_session = create_chat_session()
+        turns = history_turns(chat_history)
+
+        first_verbatim = len(turns) - new_session.max_turns
+        for i, (user_message, response) in enumerate(turns):
+            parts = history_message_parts(user_message, include_image=i >= first_verbatim)
+            new_session.add_turn(parts, response, summary_text=summary_text(user_message), context_ids=user_message.get("context_ids"))
     
-    return new_session
\ No newline at end of file
+    return new_session
+
+def restore_chat_session(state: Dict, chat_history: List[Dict]) -> CompactingChatSession:
+    """Restore a chat session from its saved state, images are loaded from the chat history"""
+    with span("restore_chat_session", turns=len(state["turns"])):
+        turns = history_turns(chat_history)
+
+        def load_image(number: int) -> Optional[Part]:
+            image_path = turns[number][0].get("image_path") if number < len(turns) else None
+            return load_history_image(image_path) if image_path else None
+
+        session = create_chat_session()
+        session.load_state(state, load_image)
+    return session
+
+def load_chat_session(chat_id: str, chat: Dict, store: SessionStore) -> Tuple[CompactingChatSession, str]:
+    """
+    The chat's session, from this worker's memory if still current, else the session store.
+
+    Call while holding the chat's lock, so the version cannot change underneath.
+
+    Returns:
+        Tuple[CompactingChatSession, str]: The session, and where it came from:
+            "memory", "restored" from the saved state or "rebuilt" from the history
+    """
+    version = store.state_version(chat_id)
+    session = chat_sessions.get(chat_id)
+    if session is not None and session.state_version == version:
+        return session, "memory"
+
+    stored = store.get_state(chat_id) if version is not None else None
+    state = decompress_json(stored[1]) if stored is not None else None
+    # A worker that died between saving the chat and its state leaves the state a turn behind
+    if state is not None and state["compacted_turns"] + len(state["turns"]) == len(history_turns(chat["messages"])):
+        version = stored[0]
+        session, source = restore_chat_session(state, chat["messages"]), "restored"
+    else:
+        session, source = rebuild_chat_session(chat["messages"]), "rebuilt"
+    session.state_version = version
+    chat_sessions[chat_id] = session
+    return session, source
+
+def save_chat_session(chat_id: str, session: CompactingChatSession, store: SessionStore) -> None:
+    """Save the session's state for other workers, and remember it as this worker's current copy"""
+    with span("save_session_state") as save_span:
+        state = compress_json(session.to_state())
+        session.state_version = store.save_state(chat_id, state)
+        save_span.set_attribute("state_bytes", len(state))
+    chat_sessions[chat_id] = session
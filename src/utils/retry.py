@@ -0,0 +1,36 @@
+import os
+import time
+import random
+from typing import Callable, Optional
+
+# Backends may not be reachable yet when the pod starts, connections are retried with backoff
+CONNECT_ATTEMPTS = int(os.environ.get("CONNECT_ATTEMPTS", 3))
+CONNECT_BACKOFF = float(os.environ.get("CONNECT_BACKOFF", 0.5))  # Seconds before the first retry, doubled after each
+CONNECT_BACKOFF_MAX = 30.0
+
+
+def with_retries(function: Callable, description: str, attempts: Optional[int] = CONNECT_ATTEMPTS, backoff: float = CONNECT_BACKOFF,
+                 retry_on: Optional[Callable[[Exception], bool]] = None):
+    """
+    Call function, retrying failures with exponential backoff and jitter.
+
+    Args:
+        function: Called with no arguments
+        description: What is being attempted, for the log
+        attempts: Maximum calls, None to retry until it succeeds
+        retry_on: Only retry errors this returns True for, by default every error
+
+    Returns:
+        The function's result, the last error is raised once attempts run out
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return function()
+        except Exception as e:
+            if (attempts is not None and attempt >= attempts) or (retry_on is not None and not retry_on(e)):
+                raise
+            delay = min(backoff * 2 ** (attempt - 1), CONNECT_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+            print(f"{description} failed (attempt {attempt}): {str(e)}, retrying in {delay:.1f}s")
+            time.sleep(delay)
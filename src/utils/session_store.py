@@ -0,0 +1,326 @@
+"""
+Chat history and chat session state shared by every API worker.
+
+With several uvicorn workers or pods, the next message of a chat often lands on
+a worker that did not serve the last one. A SessionStore keeps each chat's
+history together with its compacted session state (zlib compressed JSON) and a
+version, so any worker can restore the session in one read instead of
+rebuilding it, and can tell whether its own in-memory copy is still current.
+Turns of the same chat are serialized with a per-chat lock.
+
+Backends, chosen with SESSION_STORE:
+    file: JSON files under chat-history/ (the default), locked with flock, for one host
+    sqlite: One SQLite database in WAL mode, for workers on one host or a shared volume
+    memory: In-process dicts, a stand-in for a network key-value store in tests
+
+Images are saved as files in every backend, pods need a shared volume for chat-history/.
+"""
+import os
+import json
+import time
+import uuid
+import zlib
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+from .chat_utils import ChatHistoryManager, SAVE_CHAT_SECONDS, GET_CHAT_SECONDS, GET_RECENT_CHATS_SECONDS
+from .metrics import CHAT_HISTORY_SECONDS, timed
+from .tracing import traced
+
+SESSION_STORE = os.environ.get("SESSION_STORE", "file")
+SESSION_DB = os.environ.get("SESSION_DB")  # SQLite path, chat-history/<model>/sessions.db by default
+LOCK_TIMEOUT = float(os.environ.get("SESSION_LOCK_TIMEOUT", 30))  # Seconds to wait for another turn of the same chat
+LOCK_LEASE = float(os.environ.get("SESSION_LOCK_LEASE", 300))  # SQLite locks of crashed workers expire after this
+LOCK_POLL = 0.01
+COMPRESSION = 6  # zlib level, chats and session state are small so higher levels only cost time
+
+GET_STATE_SECONDS = CHAT_HISTORY_SECONDS.labels("get_state")
+SAVE_STATE_SECONDS = CHAT_HISTORY_SECONDS.labels("save_state")
+LOCK_WAIT_SECONDS = CHAT_HISTORY_SECONDS.labels("lock_wait")
+
+
+class LockTimeout(TimeoutError):
+    """Another turn of the same chat held its lock for too long"""
+
+
+def compress_json(value: Dict) -> bytes:
+    return zlib.compress(json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8"), COMPRESSION)
+
+
+def decompress_json(data: bytes) -> Dict:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class SessionStore(ChatHistoryManager, ABC):
+    """
+    Chat history plus a versioned session state per chat.
+
+    Subclasses implement the state methods and _acquire / _release, and may
+    override the chat history methods of ChatHistoryManager.
+    """
+
+    @abstractmethod
+    def state_version(self, chat_id: str) -> Optional[int]:
+        """Version of the saved session state, None if there is none"""
+
+    @abstractmethod
+    def get_state(self, chat_id: str) -> Optional[Tuple[int, bytes]]:
+        """The version and encoded session state, None if there is none"""
+
+    @abstractmethod
+    def save_state(self, chat_id: str, state: bytes) -> int:
+        """Save encoded session state, returning its new version. Call while holding the chat's lock."""
+
+    @abstractmethod
+    def _acquire(self, chat_id: str, timeout: float):
+        """Take the chat's lock, returning a token for _release, or None on timeout"""
+
+    @abstractmethod
+    def _release(self, chat_id: str, token) -> None:
+        """Give back a lock taken with _acquire"""
+
+    @contextmanager
+    def lock(self, chat_id: str, timeout: float = LOCK_TIMEOUT):
+        """Hold the chat's lock, across every worker using this store"""
+        start = time.perf_counter()
+        token = self._acquire(chat_id, timeout)
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+        if token is None:
+            raise LockTimeout(f"Chat {chat_id} is locked by another request")
+        try:
+            yield
+        finally:
+            self._release(chat_id, token)
+
+
+class FileSessionStore(SessionStore):
+    """Chats as JSON files as before, session state in state/<chat_id>.state and locks with flock"""
+
+    def _ensure_directories(self) -> None:
+        super()._ensure_directories()
+        self.state_dir = os.path.join(self.history_dir, "state")
+        self.locks_dir = os.path.join(self.history_dir, "locks")
+        os.makedirs(self.state_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    def _state_path(self, chat_id: str) -> str:
+        return os.path.join(self.state_dir, f"{chat_id}.state")
+
+    def state_version(self, chat_id: str) -> Optional[int]:
+        try:
+            with open(self._state_path(chat_id), "rb") as f:
+                return int(f.readline())
+        except FileNotFoundError:
+            return None
+
+    @timed(GET_STATE_SECONDS)
+    def get_state(self, chat_id: str) -> Optional[Tuple[int, bytes]]:
+        try:
+            with open(self._state_path(chat_id), "rb") as f:
+                version = int(f.readline())
+                return version, f.read()
+        except FileNotFoundError:
+            return None
+
+    @timed(SAVE_STATE_SECONDS)
+    def save_state(self, chat_id: str, state: bytes) -> int:
+        version = (self.state_version(chat_id) or 0) + 1
+        path = self._state_path(chat_id)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(f"{version}\n".encode("ascii") + state)
+        os.replace(temp_path, path)
+        return version
+
+    def _acquire(self, chat_id: str, timeout: float):
+        import fcntl
+        # Lock files are left in place, removing them would let two workers lock different files
+        f = open(os.path.join(self.locks_dir, f"{chat_id}.lock"), "a")
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    f.close()
+                    return None
+                time.sleep(LOCK_POLL)
+
+    def _release(self, chat_id: str, token) -> None:
+        import fcntl
+        fcntl.flock(token, fcntl.LOCK_UN)
+        token.close()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Chats, session state and locks in one SQLite database in WAL mode.
+
+    WAL lets workers read while one writes. Locks are leases in a table, so a
+    crashed worker's lock expires after LOCK_LEASE seconds.
+    """
+
+    def __init__(self, model, history_dir: str = "chat-history", path: Optional[str] = SESSION_DB):
+        super().__init__(model, history_dir)
+        self.path = path or os.path.join(self.history_dir, "sessions.db")
+        self._local = threading.local()
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS chats (chat_id TEXT PRIMARY KEY, session_id TEXT, dts INTEGER, data BLOB);
+            CREATE INDEX IF NOT EXISTS chats_by_session ON chats (session_id, dts DESC);
+            CREATE TABLE IF NOT EXISTS session_state (chat_id TEXT PRIMARY KEY, version INTEGER, state BLOB);
+            CREATE TABLE IF NOT EXISTS chat_locks (chat_id TEXT PRIMARY KEY, owner TEXT, expires REAL);
+        """)
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection, sqlite3 connections are not shared between threads"""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints rather than every commit, WAL keeps the database consistent either way
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @timed(SAVE_CHAT_SECONDS)
+    @traced("chat_history.save_chat")
+    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
+        self._save_images(chat_to_save)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO chats (chat_id, session_id, dts, data) VALUES (?, ?, ?, ?)",
+            (chat_to_save["chat_id"], session_id, chat_to_save.get("dts", 0), compress_json(chat_to_save)),
+        )
+
+    @timed(GET_CHAT_SECONDS)
+    @traced("chat_history.get_chat")
+    def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
+        row = self._connection().execute(
+            "SELECT data FROM chats WHERE chat_id = ? AND session_id IS ?", (chat_id, session_id)
+        ).fetchone()
+        return decompress_json(row[0]) if row else None
+
+    @timed(GET_RECENT_CHATS_SECONDS)
+    @traced("chat_history.get_recent_chats")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT data FROM chats WHERE session_id IS ? ORDER BY dts DESC LIMIT ?", (session_id, limit or -1)
+        ).fetchall()
+        return [decompress_json(row[0]) for row in rows]
+
+    def state_version(self, chat_id: str) -> Optional[int]:
+        row = self._connection().execute("SELECT version FROM session_state WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    @timed(GET_STATE_SECONDS)
+    def get_state(self, chat_id: str) -> Optional[Tuple[int, bytes]]:
+        row = self._connection().execute("SELECT version, state FROM session_state WHERE chat_id = ?", (chat_id,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    @timed(SAVE_STATE_SECONDS)
+    def save_state(self, chat_id: str, state: bytes) -> int:
+        row = self._connection().execute(
+            "INSERT INTO session_state (chat_id, version, state) VALUES (?, 1, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET version = version + 1, state = excluded.state RETURNING version",
+            (chat_id, state),
+        ).fetchone()
+        return row[0]
+
+    def _acquire(self, chat_id: str, timeout: float):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.time()
+            cursor = self._connection().execute(
+                "INSERT INTO chat_locks (chat_id, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE chat_locks.expires < ?",
+                (chat_id, owner, now + LOCK_LEASE, now),
+            )
+            if cursor.rowcount == 1:
+                return owner
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(LOCK_POLL)
+
+    def _release(self, chat_id: str, token) -> None:
+        self._connection().execute("DELETE FROM chat_locks WHERE chat_id = ? AND owner = ?", (chat_id, token))
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Stand-in for a network key-value store, in this process only.
+
+    Values are kept encoded, as they would be on the network, so callers never share dicts.
+    """
+
+    def __init__(self, model, history_dir: str = "chat-history"):
+        super().__init__(model, history_dir)
+        self.chats: Dict[Tuple[Optional[str], str], Tuple[int, bytes]] = {}
+        self.states: Dict[str, Tuple[int, bytes]] = {}
+        self._locks: Dict[str, List] = {}  # chat_id -> [lock, users]
+        self._guard = threading.Lock()
+
+    @timed(SAVE_CHAT_SECONDS)
+    @traced("chat_history.save_chat")
+    def save_chat(self, chat_to_save: Dict, session_id: str) -> None:
+        self._save_images(chat_to_save)
+        self.chats[(session_id, chat_to_save["chat_id"])] = (chat_to_save.get("dts", 0), compress_json(chat_to_save))
+
+    @timed(GET_CHAT_SECONDS)
+    @traced("chat_history.get_chat")
+    def get_chat(self, chat_id: str, session_id: str) -> Optional[Dict]:
+        entry = self.chats.get((session_id, chat_id))
+        return decompress_json(entry[1]) if entry else None
+
+    @timed(GET_RECENT_CHATS_SECONDS)
+    @traced("chat_history.get_recent_chats")
+    def get_recent_chats(self, session_id: str, limit: Optional[int] = None) -> List[Dict]:
+        entries = sorted((entry for key, entry in list(self.chats.items()) if key[0] == session_id), key=lambda entry: -entry[0])
+        return [decompress_json(data) for _, data in entries[:limit or None]]
+
+    def state_version(self, chat_id: str) -> Optional[int]:
+        entry = self.states.get(chat_id)
+        return entry[0] if entry else None
+
+    @timed(GET_STATE_SECONDS)
+    def get_state(self, chat_id: str) -> Optional[Tuple[int, bytes]]:
+        return self.states.get(chat_id)
+
+    @timed(SAVE_STATE_SECONDS)
+    def save_state(self, chat_id: str, state: bytes) -> int:
+        with self._guard:
+            version = (self.state_version(chat_id) or 0) + 1
+            self.states[chat_id] = (version, state)
+        return version
+
+    def _acquire(self, chat_id: str, timeout: float):
+        with self._guard:
+            entry = self._locks.setdefault(chat_id, [threading.Lock(), 0])
+            entry[1] += 1
+        if entry[0].acquire(timeout=timeout):
+            return entry
+        self._release_entry(chat_id, entry)
+        return None
+
+    def _release_entry(self, chat_id: str, entry: List) -> None:
+        with self._guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_id]
+
+    def _release(self, chat_id: str, token) -> None:
+        token[0].release()
+        self._release_entry(chat_id, token)
+
+
+STORES = {"file": FileSessionStore, "sqlite": SQLiteSessionStore, "memory": MemorySessionStore}
+
+
+def get_session_store(model: str, kind: str = SESSION_STORE, history_dir: str = "chat-history") -> SessionStore:
+    """The session store backend named by kind (SESSION_STORE)"""
+    if kind not in STORES:
+        raise ValueError(f"Unknown SESSION_STORE {kind!r}, expected one of {', '.join(STORES)}")
+    return STORES[kind](model, history_dir)
@@ -0,0 +1,230 @@
+import os
+import json
+import random
+import threading
+import time
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# Head sampling rate, plus tail sampling: traces slower than TRACE_SLOW_MS are always kept
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 2000))
+TRACE_FILE = os.environ.get("TRACE_FILE", os.path.join("chat-history", "traces", "traces.jsonl"))
+TRACE_FORMAT = os.environ.get("TRACE_FORMAT", "jsonl")  # jsonl | otlp
+TRACE_HEADER = "X-Trace-ID"
+SERVICE_NAME = "llm-rag-api"
+
+
+def new_trace_id() -> str:
+    return os.urandom(16).hex()
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def parse_trace_header(headers) -> Optional[str]:
+    """Trace ID from X-Trace-ID or a W3C traceparent header, if valid"""
+    trace_id = headers.get(TRACE_HEADER)
+    if not trace_id:
+        parts = (headers.get("traceparent") or "").split("-")
+        trace_id = parts[1] if len(parts) == 4 else None
+    if trace_id and len(trace_id) <= 64 and all(c in "0123456789abcdefABCDEF-" for c in trace_id):
+        return trace_id.replace("-", "").lower()
+    return None
+
+
+class Span:
+    """A timed operation within a trace"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, trace_id: str, name: str, parent_id: Optional[str] = None, attributes: Optional[Dict] = None):
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "ok"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> Dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration_ms, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Returned when no trace is active, so callers never need to check"""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Spans of one request, kept in memory until the request finishes"""
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(trace: Trace, service_name: str = SERVICE_NAME) -> Dict:
+    """Convert a trace to OTLP/JSON (ExportTraceServiceRequest)"""
+    spans = []
+    for span in trace.spans:
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+            "status": {"code": 2 if span.status == "error" else 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        spans.append(otlp_span)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "api.utils.tracing"}, "spans": spans}],
+    }]}
+
+
+class FileSpanExporter:
+    """Append finished traces to a file, one JSON line per trace"""
+
+    def __init__(self, path: str = TRACE_FILE, trace_format: str = TRACE_FORMAT):
+        if trace_format not in ("jsonl", "otlp"):
+            raise ValueError(f"Unknown trace format: {trace_format}")
+        self.path = path
+        self.trace_format = trace_format
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        if self.trace_format == "otlp":
+            record = to_otlp(trace)
+        else:
+            record = {"trace_id": trace.trace_id, "spans": [span.to_dict() for span in trace.spans]}
+        line = json.dumps(record, default=str) + "\n"
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+        except OSError as e:
+            print(f"Error exporting trace {trace.trace_id}: {str(e)}")
+
+
+class Tracer:
+    """
+    Creates traces and spans, propagated through contextvars.
+
+    Spans are recorded for every request so slow ones can be kept after the fact,
+    only sampled or slow traces are exported.
+    """
+
+    def __init__(self, exporter=None, sample_rate: float = TRACE_SAMPLE_RATE, slow_ms: float = TRACE_SLOW_MS):
+        self.exporter = exporter or FileSpanExporter()
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+        self._span: ContextVar[Optional[Span]] = ContextVar("span", default=None)
+
+    @contextmanager
+    def trace(self, name: str, trace_id: Optional[str] = None, **attributes):
+        """Start a trace with a root span, exporting it on exit if sampled or slow"""
+        trace = Trace(trace_id or new_trace_id(), sampled=random.random() < self.sample_rate)
+        trace_token = self._trace.set(trace)
+        try:
+            with self.span(name, **attributes) as root:
+                yield root
+        finally:
+            self._trace.reset(trace_token)
+            if trace.sampled or root.status == "error" or root.duration_ms >= self.slow_ms:
+                self.exporter.export(trace)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time a block as a child of the current span, a no-op outside a trace"""
+        trace = self._trace.get()
+        if trace is None:
+            yield NOOP_SPAN
+            return
+        parent = self._span.get()
+        span = Span(trace.trace_id, name, parent.span_id if parent else None, attributes)
+        token = self._span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.attributes["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            self._span.reset(token)
+            trace.add(span)
+
+    def current_span(self):
+        return self._span.get() or NOOP_SPAN
+
+    def current_trace_id(self) -> Optional[str]:
+        trace = self._trace.get()
+        return trace.trace_id if trace else None
+
+
+tracer = Tracer()
+span = tracer.span
+current_span = tracer.current_span
+
+
+def traced(name: str):
+    """Decorator wrapping each call in a span"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
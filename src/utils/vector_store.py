@@ -0,0 +1,244 @@
+"""
+Shared Chroma DB connections.
+
+One VectorStore per process holds a single HTTP client, so every CLI stage and
+API request reuses pooled keep-alive connections instead of paying TCP (and TLS)
+setup per query. Collection handles are cached. When a call fails because the
+connection was lost, e.g. Chroma restarted, the client is rebuilt and the call
+retried with backoff. Concurrent single-embedding queries can be coalesced into
+one multi-embedding query with a QueryCoalescer.
+"""
+import os
+import json
+import time
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from .retry import with_retries, CONNECT_ATTEMPTS
+from .batching import MicroBatcher
+
+# Connection tuning, the chromadb client otherwise waits forever on a stuck server
+CHROMA_TIMEOUT = float(os.environ.get("CHROMA_TIMEOUT", 30))  # Seconds for a whole request
+CHROMA_CONNECT_TIMEOUT = float(os.environ.get("CHROMA_CONNECT_TIMEOUT", 5))
+CHROMA_KEEPALIVE_SECS = float(os.environ.get("CHROMA_KEEPALIVE_SECS", 120))  # Idle pooled connections are kept this long
+CHROMA_MAX_CONNECTIONS = int(os.environ.get("CHROMA_MAX_CONNECTIONS", 32))
+# Concurrent queries wait up to VECTOR_QUERY_BATCH_WAIT_MS to be sent together, 0 sends each on its own
+VECTOR_QUERY_BATCH_WAIT_MS = float(os.environ.get("VECTOR_QUERY_BATCH_WAIT_MS", 2))
+VECTOR_QUERY_BATCH_SIZE = int(os.environ.get("VECTOR_QUERY_BATCH_SIZE", 64))
+VECTOR_QUERY_BATCH_CONCURRENCY = int(os.environ.get("VECTOR_QUERY_BATCH_CONCURRENCY", 4))
+# Per-query fields of Chroma query results, other fields apply to the whole call
+QUERY_RESULT_FIELDS = ("ids", "documents", "metadatas", "distances", "embeddings", "uris", "data")
+
+
+def is_connection_error(error: Exception) -> bool:
+    """Whether an error means the connection to Chroma was lost, rather than a bad request"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    import httpx
+    return isinstance(error, httpx.TransportError)
+
+
+class ManagedCollection:
+    """
+    A collection handle that survives reconnects.
+
+    Method calls are forwarded to the current chromadb collection through the
+    VectorStore, so they are retried on a fresh connection if the old one died.
+    """
+
+    def __init__(self, store: "VectorStore", name: str):
+        self._store = store
+        self.name = name
+
+    def __getattr__(self, attribute: str):
+        value = self._store.run(lambda: getattr(self._store.get_handle(self.name), attribute), f"Getting collection {self.name}")
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            return self._store.run(lambda: getattr(self._store.get_handle(self.name), attribute)(*args, **kwargs), f"{self.name}.{attribute}")
+        return call
+
+    def __repr__(self) -> str:
+        return f"ManagedCollection(name={self.name!r})"
+
+
+class VectorStore:
+    """
+    A lazily created, shared Chroma client with cached collection handles.
+
+    Args:
+        host: Chroma server host
+        port: Chroma server port
+        client: Use this client instead of connecting, e.g. an in-memory stand-in
+        attempts: Calls made before a connection error is raised
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 8000, client=None, attempts: int = CONNECT_ATTEMPTS,
+                 timeout: float = CHROMA_TIMEOUT, connect_timeout: float = CHROMA_CONNECT_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.attempts = attempts
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.reconnects = 0
+        self._client = client
+        self._injected = client is not None
+        self._handles: Dict[str, Any] = {}
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        import httpx
+        import chromadb
+        from chromadb.config import Settings
+        settings = Settings(
+            anonymized_telemetry=False,
+            chroma_http_keepalive_secs=CHROMA_KEEPALIVE_SECS,
+            chroma_http_max_connections=CHROMA_MAX_CONNECTIONS,
+            chroma_http_max_keepalive_connections=CHROMA_MAX_CONNECTIONS,
+        )
+        try:
+            client = chromadb.HttpClient(host=self.host, port=self.port, settings=settings)
+        except ValueError as e:
+            # chromadb reports an unreachable server as a ValueError
+            raise ConnectionError(str(e)) from e
+        # The client has no timeout setting, so set it on its pooled HTTP session
+        session = getattr(getattr(client, "_server", None), "_session", None)
+        if session is not None:
+            session.timeout = httpx.Timeout(self.timeout, connect=self.connect_timeout)
+        return client
+
+    @property
+    def client(self):
+        """The shared client, connecting on first use"""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return self._client
+
+    def reset(self) -> None:
+        """Drop the client and cached handles, the next call reconnects"""
+        with self._lock:
+            self._handles.clear()
+            if not self._injected:
+                self._client = None
+            self.reconnects += 1
+
+    def run(self, function: Callable, description: str):
+        """Call function, reconnecting and retrying if the connection was lost"""
+        def attempt():
+            try:
+                return function()
+            except Exception as e:
+                if is_connection_error(e):
+                    self.reset()
+                raise
+        return with_retries(attempt, description, attempts=self.attempts, retry_on=is_connection_error)
+
+    def get_handle(self, name: str):
+        """The chromadb collection, fetched once and cached"""
+        handle = self._handles.get(name)
+        if handle is None:
+            with self._lock:
+                handle = self._handles.get(name)
+                if handle is None:
+                    handle = self.client.get_collection(name=name)
+                    self._handles[name] = handle
+        return handle
+
+    def collection(self, name: str) -> ManagedCollection:
+        """An existing collection, its handle is resolved on first use"""
+        return ManagedCollection(self, name)
+
+    def create_collection(self, name: str, metadata: Optional[Dict] = None) -> ManagedCollection:
+        """Create a new collection and cache its handle"""
+        handle = self.run(lambda: self.client.create_collection(name=name, metadata=metadata), f"Creating collection {name}")
+        with self._lock:
+            self._handles[name] = handle
+        return ManagedCollection(self, name)
+
+    def delete_collection(self, name: str) -> None:
+        with self._lock:
+            self._handles.pop(name, None)
+        self.run(lambda: self.client.delete_collection(name=name), f"Deleting collection {name}")
+
+    def health_check(self) -> Dict:
+        """
+        Heartbeat the server, reconnecting first if the connection was lost.
+
+        Returns:
+            Dict: "ok", and "latency_ms" or "error"
+        """
+        start = time.perf_counter()
+        try:
+            self.run(lambda: self.client.heartbeat(), "Chroma DB heartbeat")
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+class QueryCoalescer:
+    """
+    Send concurrent queries against a collection as one multi-embedding query.
+
+    Queries that differ only in their embedding (same where, where_document,
+    n_results and include) are grouped into one collection.query call, and each
+    caller gets the results for its own embeddings. Other attributes are passed
+    through to the collection, so it can stand in for one, e.g. in hybrid_query.
+
+    Args:
+        get_collection: Returns the collection to query, called for every batch
+        max_wait: Seconds the first query waits for others
+        max_batch_size: Most query embeddings per call
+        max_concurrency: Calls in flight, queries collect into the next batch while they run
+    """
+
+    def __init__(self, get_collection: Callable[[], Any], max_wait: float = VECTOR_QUERY_BATCH_WAIT_MS / 1000,
+                 max_batch_size: int = VECTOR_QUERY_BATCH_SIZE, max_concurrency: int = VECTOR_QUERY_BATCH_CONCURRENCY):
+        self.get_collection = get_collection
+        self.batcher = MicroBatcher(self._query_groups, max_batch_size=max_batch_size, max_wait=max_wait,
+                                    max_concurrency=max_concurrency, name="vector_query")
+
+    def _query_groups(self, items: List) -> List[Dict]:
+        """Query each group of items with the same parameters in one call, items are (key, kwargs, embedding)"""
+        groups: Dict[str, List[int]] = {}
+        for i, (key, _, _) in enumerate(items):
+            groups.setdefault(key, []).append(i)
+        collection = self.get_collection()
+        results: List[Optional[Dict]] = [None] * len(items)
+        for positions in groups.values():
+            kwargs = items[positions[0]][1]
+            group_results = collection.query(query_embeddings=[items[i][2] for i in positions], **kwargs)
+            for n, i in enumerate(positions):
+                results[i] = {
+                    field: ([value[n]] if field in QUERY_RESULT_FIELDS and value is not None else value)
+                    for field, value in group_results.items()
+                }
+        return results
+
+    def query(self, query_embeddings: List, n_results: int = 10, where: Optional[Dict] = None,
+              where_document: Optional[Dict] = None, include: Optional[List[str]] = None) -> Dict:
+        """Like collection.query, sent together with concurrent queries with the same parameters"""
+        kwargs = {"n_results": n_results}
+        if where:
+            kwargs["where"] = where
+        if where_document:
+            kwargs["where_document"] = where_document
+        if include is not None:
+            kwargs["include"] = list(include)
+        if not query_embeddings:
+            return self.get_collection().query(query_embeddings=query_embeddings, **kwargs)
+        key = json.dumps(kwargs, sort_keys=True, default=str)
+        futures = [self.batcher.submit_async((key, kwargs, embedding)) for embedding in query_embeddings]
+        results = [future.result() for future in futures]
+        if len(results) == 1:
+            return results[0]
+        # Several embeddings from one caller, put their results back together
+        return {
+            field: ([result[field][0] for result in results] if field in QUERY_RESULT_FIELDS and value is not None else value)
+            for field, value in results[0].items()
+        }
+
+    def __getattr__(self, attribute: str):
+        return getattr(self.get_collection(), attribute)
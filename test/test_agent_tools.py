@@ -0,0 +1,152 @@
+import time
+from types import SimpleNamespace
+import pandas as pd
+import pytest
+import agent_tools
+from cli import load_text_embeddings
+from agent_tools import ToolResultCache, tool_cache_key, execute_function_calls
+from stand_ins import InMemoryCollection, deterministic_vector
+
+DIMENSION = 8
+
+
+def embed(text):
+    return deterministic_vector(text, DIMENSION)
+
+
+def make_collection(name="char-split-collection"):
+    collection = InMemoryCollection(name)
+    documents = [f"{author} on ascites, chunk {i}" for author in ("J. Twamley", "T. D. Curtis") for i in range(3)]
+    collection.add(
+        ids=[f"chunk-{i}" for i in range(len(documents))],
+        documents=documents,
+        metadatas=[{"author": document.split(" on ")[0]} for document in documents],
+        embeddings=[embed(document) for document in documents],
+    )
+    return collection
+
+
+def search_call(search_content):
+    return SimpleNamespace(name="get_book_by_search_content", args={"search_content": search_content})
+
+
+@pytest.fixture(autouse=True)
+def tool_cache(monkeypatch):
+    cache = ToolResultCache()
+    monkeypatch.setattr(agent_tools, "tool_cache", cache)
+    return cache
+
+
+def test_cache_entries_expire():
+    cache = ToolResultCache(ttl=0.01)
+    cache.set("key", "chunks")
+    assert cache.get("key") == "chunks"
+    time.sleep(0.02)
+    assert cache.get("key") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ToolResultCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_cache_invalidate():
+    cache = ToolResultCache()
+    cache.set("a", 1)
+    cache.invalidate()
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 0, "misses": 1, "hit_rate": 0.0, "size": 0}
+
+
+def test_key_changes_with_collection(tool_cache):
+    """Test the key tells apart rebuilt collections and results from before a load"""
+    collection = make_collection()
+    key = tool_cache_key("get_book_by_search_content", "Ascites  Management", None, collection)
+    assert key == tool_cache_key("get_book_by_search_content", "ascites management", None, collection)
+    assert key != tool_cache_key("get_book_by_search_content", "ascites management", None, make_collection())
+
+    tool_cache.invalidate()
+    assert key != tool_cache_key("get_book_by_search_content", "ascites management", None, collection)
+
+
+def test_repeated_calls_served_from_cache(tool_cache):
+    collection = make_collection()
+    first = execute_function_calls([search_call("ascites")], collection, embed)
+    queries = collection.counters.snapshot()["calls"]
+
+    # Cache hits make no request at all
+    def no_requests(*args, **kwargs):
+        raise AssertionError("cache hit made a vector db request")
+
+    collection.count = collection.query = no_requests
+    assert execute_function_calls([search_call("Ascites")], collection, embed)[0].function_response.response == first[0].function_response.response
+    assert collection.counters.snapshot()["calls"] == queries
+    assert tool_cache.stats()["hits"] == 1
+
+    # Loading rows invalidates the cache, so the result is retrieved again
+    del collection.count, collection.query
+    load_text_embeddings(pd.DataFrame({"book": ["Bob Brown"], "chunk": ["Paracentesis"], "embedding": [embed("Paracentesis")]}), collection)
+    queries = collection.counters.snapshot()["calls"]
+    execute_function_calls([search_call("ascites")], collection, embed)
+    assert collection.counters.snapshot()["calls"] == queries + 1
+
+
+def author_call(author, search_content):
+    return SimpleNamespace(name="get_book_by_author", args={"author": author, "search_content": search_content})
+
+
+def test_responses_in_call_order():
+    """Test mixed tools and filters are answered in call order, with duplicates retrieved once"""
+    collection = make_collection()
+    calls = [
+        author_call("T. D. Curtis", "ascites"),
+        search_call("paracentesis"),
+        SimpleNamespace(name="unknown_tool", args={}),
+        author_call("J. Twamley", "ascites"),
+        author_call("T. D. Curtis", "Ascites"),
+    ]
+    batches = []
+
+    def batch_embed(texts):
+        batches.append(list(texts))
+        return [embed(text) for text in texts]
+
+    parts = execute_function_calls(calls, collection, embed, batch_embed_func=batch_embed)
+
+    assert [part.function_response.name for part in parts] == [
+        "get_book_by_author", "get_book_by_search_content", "get_book_by_author", "get_book_by_author"]
+    contents = [part.function_response.response["content"] for part in parts]
+    assert all(line.startswith("T. D. Curtis") for line in contents[0].splitlines())
+    assert all(line.startswith("J. Twamley") for line in contents[2].splitlines())
+    assert contents[3] == contents[0]
+    assert contents[1] == execute_function_calls([search_call("paracentesis")], make_collection(), embed)[0].function_response.response["content"]
+    assert batches == [["ascites", "paracentesis", "ascites"]]
+
+
+def test_failing_call_keeps_the_others():
+    """Test a query that fails only turns its own calls into errors"""
+    collection = make_collection()
+    query = collection.query
+
+    def flaky_query(query_embeddings, n_results=10, where=None, **kwargs):
+        if where == {"author": "J. Twamley"}:
+            raise ValueError("filter rejected")
+        return query(query_embeddings, n_results=n_results, where=where, **kwargs)
+
+    collection.query = flaky_query
+    parts = execute_function_calls(
+        [author_call("J. Twamley", "ascites"), search_call("ascites"), author_call("T. D. Curtis", "ascites")],
+        collection, embed)
+
+    responses = [dict(part.function_response.response) for part in parts]
+    assert responses[0] == {"error": "filter rejected"}
+    assert responses[1]["content"] and responses[2]["content"].startswith("T. D. Curtis")
+    # Errors are not cached
+    collection.query = query
+    assert "content" in execute_function_calls([author_call("J. Twamley", "ascites")], collection, embed)[0].function_response.response
@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from utils.batching import MicroBatcher
+
+
+class SlowBackend:
+    def __init__(self, latency=0.02):
+        self.latency = latency
+        self.batches = []
+
+    def __call__(self, items):
+        self.batches.append(list(items))
+        time.sleep(self.latency)
+        return [item * 2 for item in items]
+
+
+def test_concurrent_items_share_calls():
+    backend = SlowBackend()
+    batcher = MicroBatcher(backend, max_batch_size=16, max_wait=0.005, max_concurrency=1)
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        results = list(executor.map(batcher.submit, range(200)))
+
+    assert results == [item * 2 for item in range(200)]
+    assert max(len(batch) for batch in backend.batches) <= 16
+    # Items arriving while a call is in flight wait for the next one, instead of each making their own
+    assert batcher.calls < 200 / 4
+    assert batcher.items == 200
+
+
+def test_lone_item_waits_at_most_the_window():
+    batcher = MicroBatcher(SlowBackend(latency=0), max_wait=0.005)
+    start = time.perf_counter()
+    assert batcher.submit(21) == 42
+    assert time.perf_counter() - start < 0.1
+
+
+def test_errors_reach_every_caller():
+    def fail(items):
+        time.sleep(0.01)
+        raise ConnectionError("embedding service unavailable")
+
+    batcher = MicroBatcher(fail, max_wait=0.01)
+    futures = [batcher.submit_async(item) for item in range(3)]
+    for future in futures:
+        with pytest.raises(ConnectionError):
+            future.result(timeout=1)
+
+    wrong = MicroBatcher(lambda items: items[:-1], max_wait=0)
+    with pytest.raises(RuntimeError):
+        wrong.submit(1, timeout=1)
+
+
+def test_collector_survives_failed_submits():
+    """Test a batch that cannot be dispatched fails its callers, and later items are still processed"""
+    batcher = MicroBatcher(SlowBackend(latency=0), max_wait=0, max_concurrency=1)
+    assert batcher.submit(1, timeout=1) == 2
+    executor = batcher._executor
+    batcher._executor = None
+    with pytest.raises(AttributeError):
+        batcher.submit(2, timeout=1)
+    batcher._executor = executor
+    assert batcher.submit(3, timeout=1) == 6
+    # The failed batch gave back its slot
+    assert batcher._slots.acquire(timeout=1)
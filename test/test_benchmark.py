@@ -0,0 +1,72 @@
+import os
+import pytest
+from benchmark import compare_results, generate_corpus, parse_size
+from stand_ins import FakeEmbeddingModel, InMemoryChromaClient, Latency
+
+
+def make_run(wall_s, embedding_calls=10):
+    return {"results": {"1MB": {"embed": {"wall_s": wall_s, "peak_rss_mb": 100.0, "embedding_calls": embedding_calls}}}}
+
+
+def test_parse_size():
+    assert parse_size("1MB") == 1024 ** 2
+    assert parse_size("1gb") == 1024 ** 3
+    assert parse_size("512") == 512
+
+
+def test_generate_corpus(tmp_path):
+    """Test corpora are split into books totalling the requested size"""
+    books = generate_corpus(str(tmp_path), 100 * 1024)
+
+    assert books == 1
+    assert os.path.getsize(tmp_path / "0.txt") == 100 * 1024
+
+
+def test_compare_flags_regressions():
+    """Test slower stages and extra calls are flagged"""
+    regressions = compare_results(make_run(1.0), make_run(1.5, embedding_calls=12), threshold=0.1)
+
+    assert ("1MB", "embed", "wall_s", 1.0, 1.5) in regressions
+    assert ("1MB", "embed", "embedding_calls", 10, 12) in regressions
+
+
+def test_compare_ignores_noise():
+    """Test small absolute changes are not regressions"""
+    assert compare_results(make_run(0.01), make_run(0.03)) == []
+    assert compare_results(make_run(1.0), make_run(0.5)) == []
+
+
+def test_fake_embedding_model_is_deterministic():
+    """Test the fake embeddings depend only on the text"""
+    model = FakeEmbeddingModel(dimension=8)
+    first = model.get_embeddings(["a", "b"])
+    second = model.get_embeddings(["a"])
+
+    assert first[0].values == second[0].values
+    assert first[0].values != first[1].values
+    assert len(first[0].values) == 8
+    assert model.counters.snapshot()["calls"] == 2
+
+
+def test_in_memory_collection():
+    """Test add, filtered query and get on the vector store stand-in"""
+    client = InMemoryChromaClient()
+    collection = client.create_collection("test")
+    collection.add(
+        ids=["a", "b", "c"],
+        documents=["one", "two", "three"],
+        metadatas=[{"book": "0"}, {"book": "1"}, {"book": "1"}],
+        embeddings=[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0]],
+    )
+
+    results = collection.query(query_embeddings=[[0.9, 0.1]], n_results=2)
+    assert results["ids"] == [["b", "a"]]
+    results = collection.query(query_embeddings=[[0.9, 0.1]], n_results=2, where={"book": "1"})
+    assert results["ids"] == [["b", "c"]]
+    assert collection.get(ids=["c"])["documents"] == ["three"]
+    assert client.counters()["calls"] == 4
+
+
+@pytest.mark.parametrize("spec,low,high", [("none", 0, 0), ("fixed:20", 0.02, 0.02), ("uniform:10,30", 0.01, 0.03)])
+def test_latency(spec, low, high):
+    assert low <= Latency(spec).sample() <= high
@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+from cli import (
+    load_text_embeddings,
+    next_batch_size,
+    LOAD_MIN_BATCH_SIZE,
+    LOAD_MAX_BATCH_SIZE,
+    LOAD_MAX_BATCH_BYTES,
+    LOAD_TARGET_BATCH_SECONDS,
+)
+from stand_ins import InMemoryCollection, deterministic_vector
+
+
+def make_df(rows, book="The Complete Book of Cheese"):
+    chunks = [f"Chunk {i} of the cheese book" for i in range(rows)]
+    return pd.DataFrame({
+        "book": book,
+        "chunk": chunks,
+        "chunk_index": range(rows),
+        "embedding": [deterministic_vector(chunk, 8) for chunk in chunks],
+    })
+
+
+def test_next_batch_size_grows_and_shrinks_within_bounds():
+    # Fast batches grow, by at most 2x
+    assert next_batch_size(500, 500, 500 * 100, LOAD_TARGET_BATCH_SECONDS / 10) == 1000
+    # Slow batches shrink, by at most half
+    assert next_batch_size(500, 500, 500 * 100, LOAD_TARGET_BATCH_SECONDS * 10) == 250
+    assert next_batch_size(500, 500, 500 * 100, LOAD_TARGET_BATCH_SECONDS) == 500
+    # Clamped to the configured limits
+    assert next_batch_size(LOAD_MAX_BATCH_SIZE, 10, 1000, 0.001) == LOAD_MAX_BATCH_SIZE
+    assert next_batch_size(LOAD_MIN_BATCH_SIZE, 10, 1000, 100) == LOAD_MIN_BATCH_SIZE
+    # Never more bytes per request than the limit
+    bytes_per_row = LOAD_MAX_BATCH_BYTES // 200
+    assert next_batch_size(1000, 1000, 1000 * bytes_per_row, LOAD_TARGET_BATCH_SECONDS) == 200
+
+
+class RejectLargeBatches(InMemoryCollection):
+    """Collection whose add fails above a batch size, like a server request size limit"""
+    def __init__(self, limit):
+        super().__init__("char-split-collection")
+        self.limit = limit
+        self.batch_sizes = []
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        if len(ids) > self.limit:
+            raise ValueError("Payload too large")
+        self.batch_sizes.append(len(ids))
+        super().add(ids, documents, metadatas, embeddings)
+
+
+def test_failed_add_is_retried_and_batches_shrink():
+    collection = RejectLargeBatches(limit=100)
+    load_text_embeddings(make_df(1000), collection, batch_size=400, max_workers=1)
+
+    assert collection.count() == 1000
+    assert collection.counters.snapshot()["items"] == 1000
+    # The failing batch went through as 4 x 100, later batches start at the size that worked
+    assert collection.batch_sizes[:4] == [100] * 4
+    assert collection.batch_sizes[4] == 100
+
+
+def test_failures_below_the_minimum_batch_are_raised():
+    collection = RejectLargeBatches(limit=0)
+    with pytest.raises(ValueError):
+        load_text_embeddings(make_df(200), collection, batch_size=200, max_workers=1)
+
+
+def test_every_chunk_inserted_once_under_the_thread_pool():
+    collection = InMemoryCollection("char-split-collection", latency="fixed:2")
+    df = make_df(3000)
+    load_text_embeddings(df, collection, batch_size=LOAD_MIN_BATCH_SIZE, max_workers=8)
+
+    snapshot = collection.counters.snapshot()
+    assert snapshot["items"] == 3000
+    assert snapshot["calls"] > 1
+    assert collection.count() == 3000
+    assert sorted(collection._rows) == sorted(df["id"])
@@ -0,0 +1,112 @@
+from stand_ins import FakeGenerativeModel, _estimate_tokens
+from utils.chat_session import CompactingChatSession, SessionCache, SUMMARY_HEADER, refers_back
+from load_test import import_service
+
+
+class RecordingModel(FakeGenerativeModel):
+    def __init__(self):
+        super().__init__(response_text="Comté is a hard cheese from the Jura. " * 5)
+        self.prompts = []
+
+    def generate_content(self, contents, generation_config=None, **kwargs):
+        self.prompts.append(contents)
+        return super().generate_content(contents, generation_config=generation_config)
+
+
+def chat(session, turns):
+    for i in range(turns):
+        session.send_message([f"Question {i} about cheese\n" + "retrieved context " * 100], summary_text=f"Question {i} about cheese")
+
+
+def test_prompt_size_stays_flat():
+    model = RecordingModel()
+    session = CompactingChatSession(model, max_turns=4, max_prompt_tokens=100000)
+    chat(session, 30)
+
+    sizes = [_estimate_tokens(prompt) for prompt in model.prompts]
+    assert len(model.prompts[-1]) == 2 * 4 + 1
+    # Turn 30 costs what turn 5 did plus the capped summary, not six times as much
+    assert sizes[-1] <= sizes[4] + session.summary_tokens
+    assert sizes[-1] == sizes[-5]
+    assert session.compacted_turns == 26
+    summary = model.prompts[-1][0].parts[0].text
+    assert summary.startswith(SUMMARY_HEADER)
+    assert "Question 24 about cheese" in summary
+    assert "retrieved context" not in summary
+
+
+def test_token_budget_compacts_early():
+    model = RecordingModel()
+    session = CompactingChatSession(model, max_turns=10, max_prompt_tokens=1000)
+    chat(session, 8)
+    assert all(_estimate_tokens(prompt) <= 1100 for prompt in model.prompts)
+    assert len(session.turns) < 8
+
+
+def test_summary_is_capped():
+    session = CompactingChatSession(RecordingModel(), max_turns=1, summary_tokens=200)
+    chat(session, 20)
+    assert len(session.summary) <= 200 * 4 + 400
+    assert "Question 18" in session.summary
+    assert "Question 0 " not in session.summary
+
+
+def test_context_is_sent_once():
+    model = RecordingModel()
+    session = CompactingChatSession(model)
+    session.send_message(["What is Comté?"], context="Comté is made from raw cow's milk.", context_ids=["a-1", "a-2"])
+    session.send_message(["How long is it aged?"])
+
+    first, second = model.prompts
+    assert [part.text for part in first[-1].parts] == ["What is Comté?", "Comté is made from raw cow's milk."]
+    assert [part.text for part in second[0].parts] == ["What is Comté?"]
+    assert session.recent_context_ids() == ["a-1", "a-2"]
+
+
+def test_refers_back():
+    assert refers_back("Can you quote the passage you mentioned?")
+    assert refers_back("What did that study say about dosing?")
+    assert refers_back("Expand on the earlier point")
+    assert not refers_back("How is ascites managed before surgery?")
+
+
+def test_session_cache_evicts_least_recently_used():
+    cache = SessionCache(maxsize=2)
+    sessions = {chat_id: CompactingChatSession(FakeGenerativeModel()) for chat_id in "abc"}
+    cache["a"], cache["b"] = sessions["a"], sessions["b"]
+    assert cache.get("a") is sessions["a"]
+    cache["c"] = sessions["c"]
+    assert cache.get("b") is None
+    assert len(cache) == 2 and cache.get("a") is sessions["a"]
+
+
+def test_rebuild_makes_no_model_calls(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    _, backends = import_service()
+    from api.utils.llm_rag_utils import rebuild_chat_session
+    history = []
+    for i in range(10):
+        history.append({"role": "user", "content": f"Question {i}", "context_ids": [f"chunk-{i}"]})
+        history.append({"role": "assistant", "content": f"Answer {i}"})
+
+    calls_before = backends["llm"].counters.snapshot()["calls"]
+    session = rebuild_chat_session(history)
+    assert backends["llm"].counters.snapshot()["calls"] == calls_before
+    assert [turn["response"] for turn in session.turns] == [f"Answer {i}" for i in range(10 - session.max_turns, 10)]
+    assert "Question 0" in session.summary
+    assert session.recent_context_ids() == ["chunk-9"]
+
+
+def test_back_reference_recalls_earlier_chunks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import_service()
+    from api.utils.llm_rag_utils import create_chat_session, generate_chat_response
+    session = create_chat_session()
+    first = {"content": "How should malignant ascites be managed?"}
+    generate_chat_response(session, first)
+    assert first["context_ids"]
+    assert session.turns[0]["parts"] == [first["content"]]
+
+    follow_up = {"content": "Which source did you cite for that?"}
+    generate_chat_response(session, follow_up)
+    assert follow_up["context_ids"][:len(first["context_ids"])] == first["context_ids"]
@@ -0,0 +1,30 @@
+import os
+import sys
+import subprocess
+import cli
+
+SRC_FOLDER = os.path.dirname(os.path.abspath(cli.__file__))
+HEAVY_MODULES = ["pandas", "chromadb", "vertexai", "langchain", "langchain_community", "langchain_core"]
+
+
+def run_python(*args, cwd=None):
+    env = {**os.environ, "PYTHONPATH": SRC_FOLDER}
+    return subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True, timeout=60)
+
+
+def test_import_does_not_load_heavy_modules():
+    """Test importing cli.py leaves clients and heavy dependencies for first use"""
+    completed = run_python("-c", f"import sys, cli; print([m for m in {HEAVY_MODULES!r} if m in sys.modules])")
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.strip() == "[]"
+
+
+def test_clients_are_not_created_at_import():
+    assert cli.generative_model is None or not type(cli.generative_model).__module__.startswith("vertexai")
+    assert cli.vector_store is None or cli.vector_store._client is None
+
+
+def test_help_runs_without_credentials(tmp_path):
+    completed = run_python(os.path.join(SRC_FOLDER, "cli.py"), "--help", cwd=str(tmp_path))
+    assert completed.returncode == 0, completed.stderr
+    assert "--chunk_type" in completed.stdout
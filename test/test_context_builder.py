@@ -0,0 +1,78 @@
+from utils.context_builder import build_context, chunk_position, join_chunks, merge_passages, estimate_tokens, add_recalled
+
+
+def results(rows):
+    """Chroma-style results from (id, document, distance, metadata) rows"""
+    return {
+        "ids": [[row[0] for row in rows]],
+        "documents": [[row[1] for row in rows]],
+        "distances": [[row[2] for row in rows]],
+        "metadatas": [[row[3] if len(row) > 3 else None for row in rows]],
+    }
+
+
+def test_join_chunks_removes_overlap():
+    assert join_chunks("Aged cheddar is sharp and crumbly", "sharp and crumbly in texture") == "Aged cheddar is sharp and crumbly in texture"
+    assert join_chunks("First sentence.", "Second sentence.") == "First sentence. Second sentence."
+    assert join_chunks("First sentence.\n", "Second") == "First sentence.\nSecond"
+
+
+def test_chunk_position():
+    assert chunk_position("abc123-7", None) == ("abc123", 7)
+    assert chunk_position("abc123-7", {"book": "Cheese", "chunk_index": 3}) == ("abc123", 3)
+    # Row numbers of deduplicated chunks are not positions
+    assert chunk_position("abc123-7", {"books": "Cheese"}) == ("abc123", None)
+
+
+def test_neighbours_are_merged_in_rank_order():
+    passages = merge_passages([
+        {"id": "b-4", "document": "other book", "book": "b", "index": 4, "rank": 0},
+        {"id": "a-2", "document": "the rind is washed in brine", "book": "a", "index": 2, "rank": 1},
+        {"id": "a-1", "document": "Soft cheeses where the rind is washed", "book": "a", "index": 1, "rank": 2},
+        {"id": "a-5", "document": "far away", "book": "a", "index": 5, "rank": 3},
+    ])
+    assert [passage["ids"] for passage in passages] == [["b-4"], ["a-1", "a-2"], ["a-5"]]
+    assert passages[1]["text"] == "Soft cheeses where the rind is washed in brine"
+
+
+def test_distant_candidates_are_dropped():
+    context = build_context(results([
+        ("a-1", "close match", 0.50),
+        ("b-1", "also close", 0.60),
+        ("c-1", "much worse", 0.90),
+    ]), relative_gap=0.3)
+    assert context["ids"] == ["a-1", "b-1"]
+    assert context["dropped"] == 1
+
+    context = build_context(results([("a-1", "best but far", 1.5), ("b-1", "far", 1.6)]), max_distance=1.0, relative_gap=None)
+    # The best candidate is always kept
+    assert context["ids"] == ["a-1"]
+
+
+def test_token_budget_is_respected():
+    rows = [(f"book{i}-0", "x" * 400, 0.5) for i in range(5)]
+    context = build_context(results(rows), token_budget=250)
+    assert context["ids"] == ["book0-0", "book1-0"]
+    assert context["tokens"] <= 250
+    assert context["over_budget"] == 3
+
+    # A chunk bigger than the whole budget is cut down instead of dropped
+    context = build_context(results(rows[:1]), token_budget=50)
+    assert context["ids"] == ["book0-0"]
+    assert estimate_tokens(context["text"]) == 50
+
+
+def test_lexical_hits_without_distance_are_kept():
+    context = build_context({"ids": [["a-1", "a-2"]], "documents": [["dense hit", "lexical hit"]], "metadatas": [[None, None]], "distances": [[0.4, None]]})
+    assert context["ids"] == ["a-1", "a-2"]
+    assert context["text"] == "dense hit lexical hit"
+
+
+def test_recalled_chunks_come_first():
+    query = results([("a-1", "new match", 0.2), ("b-3", "earlier chunk", 0.3)])
+    recalled = {"ids": ["c-1", "b-3"], "documents": ["other earlier chunk", "earlier chunk"], "metadatas": [None, None]}
+    combined = add_recalled(query, recalled, order=["b-3", "c-1"])
+    assert combined["ids"] == [["b-3", "c-1", "a-1"]]
+    assert combined["distances"] == [[None, None, 0.2]]
+    # No distance, so the relative gap keeps them
+    assert build_context(combined, relative_gap=0.1)["ids"] == ["b-3", "c-1", "a-1"]
@@ -0,0 +1,103 @@
+import pytest
+from dedup import deduplicate, jaccard, lsh_params, normalize_text, shingles, MinHasher
+
+boilerplate = "Discharge instructions: take all medications as prescribed and follow up with your primary care physician within two weeks of discharge."
+near_boilerplate = "Discharge instructions: take all medications as prescribed and follow up with your primary care physician within two weeks of discharge!"
+unique = "Gemcitabine and capecitabine are used together in the adjuvant treatment of resected pancreatic adenocarcinoma."
+
+
+def test_exact_duplicates_merged():
+    """Test exact copies (up to case and whitespace) keep one chunk with both books"""
+    records = [
+        {"chunk": boilerplate, "book": "0"},
+        {"chunk": "  " + boilerplate.upper() + "\n", "book": "1"},
+        {"chunk": unique, "book": "1"},
+    ]
+    kept, stats = deduplicate(records)
+
+    assert [record["chunk"] for record in kept] == [boilerplate, unique]
+    assert kept[0]["books"] == ["0", "1"]
+    assert kept[1]["books"] == ["1"]
+    assert stats == {"input": 3, "exact_duplicates": 1, "near_duplicates": 0, "kept": 2, "removed": 1}
+
+
+def test_near_duplicates_merged():
+    """Test chunks above the Jaccard threshold are merged"""
+    records = [
+        {"chunk": boilerplate, "book": "0"},
+        {"chunk": near_boilerplate, "book": "2"},
+    ]
+    kept, stats = deduplicate(records, threshold=0.8)
+
+    assert len(kept) == 1
+    assert kept[0]["books"] == ["0", "2"]
+    assert stats["near_duplicates"] == 1
+
+
+def test_threshold_respected():
+    """Test chunks below the threshold are kept"""
+    half = " ".join(boilerplate.split(" ")[:10]) + " " + unique
+    records = [
+        {"chunk": boilerplate, "book": "0"},
+        {"chunk": half, "book": "0"},
+    ]
+    kept, _ = deduplicate(records, threshold=0.9)
+
+    assert len(kept) == 2
+
+
+def test_same_book_duplicate_not_repeated():
+    """Test a chunk repeated within one book lists the book once"""
+    kept, _ = deduplicate([{"chunk": unique, "book": "3"}, {"chunk": unique, "book": "3"}])
+
+    assert kept[0]["books"] == ["3"]
+
+
+def test_signature_estimates_jaccard():
+    """Test MinHash agreement approximates the exact Jaccard similarity"""
+    a = shingles(normalize_text(boilerplate))
+    b = shingles(normalize_text(near_boilerplate))
+    hasher = MinHasher(num_perm=256)
+
+    estimate = (hasher.signature(a) == hasher.signature(b)).mean()
+    assert estimate == pytest.approx(jaccard(a, b), abs=0.1)
+
+
+@pytest.mark.parametrize("threshold", [0.5, 0.8, 0.9])
+def test_lsh_params(threshold):
+    """Test bands and rows cover all permutations"""
+    bands, rows = lsh_params(threshold, 128)
+    assert bands * rows == 128
+
+
+def test_rerun_keeps_books():
+    """Test deduplicating already deduplicated records keeps the books of removed copies"""
+    records = [
+        {"chunk": boilerplate, "book": "0"},
+        {"chunk": unique, "book": "0"},
+        {"chunk": boilerplate.upper(), "book": "1"},
+    ]
+    kept, _ = deduplicate(records)
+    rerun, stats = deduplicate([dict(record) for record in kept])
+    assert rerun == kept
+    assert rerun[0]["books"] == ["0", "1"]
+    assert stats["removed"] == 0
+
+
+def test_cli_dedup_is_idempotent(tmp_path, monkeypatch):
+    """Test running dedup twice keeps books and the file of a book whose chunks were all removed"""
+    import json
+    import cli
+    monkeypatch.setattr(cli, "OUTPUT_FOLDER", str(tmp_path))
+    for book, chunks in [("a", [boilerplate, unique]), ("b", ["  " + boilerplate])]:
+        with open(tmp_path / f"chunks-char-split-{book}.jsonl", "w") as f:
+            f.writelines(json.dumps({"chunk": chunk, "book": book}) + "\n" for chunk in chunks)
+
+    cli.dedup()
+    first = (tmp_path / "chunks-char-split-a.jsonl").read_text()
+    cli.dedup()
+
+    assert (tmp_path / "chunks-char-split-a.jsonl").read_text() == first
+    assert json.loads(first.splitlines()[0])["books"] == ["a", "b"]
+    assert (tmp_path / "chunks-char-split-b.jsonl").read_text() == ""
+    assert json.loads((tmp_path / "dedup-char-split.json").read_text())["empty_books"] == ["b"]
@@ -0,0 +1,121 @@
+import threading
+import time
+import numpy as np
+import pytest
+from utils.embedding_providers import EmbeddingProvider, HashingEmbeddingProvider, VertexEmbeddingProvider, get_embedding_provider, estimate_tokens
+from stand_ins import FakeEmbeddingModel
+
+
+class RecordingProvider(EmbeddingProvider):
+    """Provider that returns each text's index and records batch sizes"""
+    max_batch_size = 3
+    max_concurrency = 4
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def _embed_batch(self, texts, task_type):
+        # Finish later batches first to check results keep input order
+        time.sleep(0.01 * (10 - int(texts[0])) / 10)
+        with self.lock:
+            self.batches.append(len(texts))
+        return [[float(text)] for text in texts]
+
+
+def test_hashing_is_deterministic_and_normalized():
+    provider = HashingEmbeddingProvider(dimension=64)
+    first = provider.embed_documents(["Ascites in pancreatic cancer", "Bowel obstruction"])
+    second = HashingEmbeddingProvider(dimension=64).embed_documents(["Ascites in pancreatic cancer", "Bowel obstruction"])
+
+    assert first == second
+    assert len(first[0]) == 64
+    assert np.linalg.norm(first[0]) == pytest.approx(1.0, abs=1e-5)
+
+
+def test_hashing_similar_texts_are_closer():
+    """Test texts sharing vocabulary embed closer than unrelated ones"""
+    provider = HashingEmbeddingProvider()
+    query = np.array(provider.embed_query("management of malignant ascites in pancreatic cancer"))
+    related = np.array(provider.embed_query("malignant ascites is common in pancreatic cancer"))
+    unrelated = np.array(provider.embed_query("capecitabine dosing in renal impairment"))
+
+    assert query @ related > query @ unrelated
+
+
+def test_hashing_empty_text():
+    assert HashingEmbeddingProvider(dimension=8).embed_query("") == [0.0] * 8
+
+
+def test_batches_keep_input_order():
+    """Test concurrent batches are capped at max_batch_size and reassembled in order"""
+    provider = RecordingProvider()
+    texts = [str(i) for i in range(10)]
+    vectors = provider.embed_documents(texts, batch_size=50)
+
+    assert vectors == [[float(i)] for i in range(10)]
+    assert sorted(provider.batches) == [1, 3, 3, 3]
+
+
+def test_vertex_provider_with_model():
+    """Test the Vertex provider batches requests to the underlying model"""
+    model = FakeEmbeddingModel(dimension=16)
+    provider = VertexEmbeddingProvider(dimension=16, model=model)
+    vectors = provider.embed_documents([f"chunk {i}" for i in range(600)])
+
+    assert len(vectors) == 600
+    assert len(vectors[0]) == 16
+    assert model.counters.snapshot()["calls"] == 3
+
+
+def test_batches_are_packed_by_tokens():
+    """Test short chunks fill requests to 250 texts and long ones stop at the token limit"""
+    model = FakeEmbeddingModel(dimension=8, max_request_tokens=20000)
+    provider = VertexEmbeddingProvider(dimension=8, model=model)
+    short = [f"chunk {i}" for i in range(500)]
+    long = [f"{i} " + "ascites " * 750 for i in range(40)]
+
+    assert [len(batch) for batch in provider.pack_batches(short)] == [250, 250]
+    batches = provider.pack_batches(long)
+    assert all(sum(estimate_tokens(text) for text in batch) <= provider.max_batch_tokens for batch in batches)
+    assert len(provider.embed_documents(long)) == 40
+    assert model.counters.snapshot()["calls"] == len(batches)
+
+
+@pytest.mark.parametrize("policy", ["truncate", "split"])
+def test_oversized_texts(policy):
+    model = FakeEmbeddingModel(dimension=8)
+    provider = VertexEmbeddingProvider(dimension=8, model=model)
+    provider.oversize_policy = policy
+    oversized = "malignant ascites " * 1000
+    vectors = provider.embed_documents(["short chunk", oversized, "another chunk"])
+
+    assert len(vectors) == 3
+    assert vectors[0] == provider.embed_query("short chunk")
+    assert model.counters.snapshot()["items"] == (4 if policy == "truncate" else 6)
+    assert np.linalg.norm(vectors[1]) == pytest.approx(np.linalg.norm(vectors[0]), rel=0.01)
+
+
+def test_token_limit_errors_split_the_batch():
+    """Test a batch the service rejects for its token count is retried in halves"""
+    model = FakeEmbeddingModel(dimension=8, max_request_tokens=1000)
+    provider = VertexEmbeddingProvider(dimension=8, model=model)
+    vectors = provider.embed_documents(["ascites " * 100] * 20)
+
+    assert len(vectors) == 20
+    with pytest.raises(ValueError):
+        VertexEmbeddingProvider(dimension=8, model=model).embed_documents(["ascites " * 1000])
+
+
+def test_get_embedding_provider():
+    assert get_embedding_provider("hashing") is get_embedding_provider("hashing")
+    with pytest.raises(ValueError):
+        get_embedding_provider("missing")
+
+
+def test_providers_must_implement_embed_batch():
+    class Incomplete(EmbeddingProvider):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
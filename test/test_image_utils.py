@@ -0,0 +1,160 @@
+import io
+import os
+import pytest
+from PIL import Image
+from fastapi.testclient import TestClient
+from load_test import import_service
+from utils.image_utils import preprocess_image, image_hash, file_etag, etag_matches, parse_range, thumbnail_path
+
+
+def make_image(size=(3000, 2000), mode="RGB", image_format="PNG"):
+    image = Image.new(mode, size, (120, 30, 200) if mode == "RGB" else (120, 30, 200, 128))
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+class TestPreprocessImage:
+    def test_downscales_to_max_edge(self, tmp_path):
+        """Test the longest edge is capped and the output is JPEG"""
+        processed, mime_type = preprocess_image(make_image(), max_edge=512, image_format="JPEG", quality=80, cache_dir=str(tmp_path))
+
+        assert mime_type == "image/jpeg"
+        with Image.open(io.BytesIO(processed)) as image:
+            assert max(image.size) == 512
+            assert image.size == (512, 341)
+
+    def test_webp_output(self, tmp_path):
+        """Test recompression to WebP"""
+        processed, mime_type = preprocess_image(make_image(), max_edge=256, image_format="WEBP", quality=70, cache_dir=str(tmp_path))
+
+        assert mime_type == "image/webp"
+        with Image.open(io.BytesIO(processed)) as image:
+            assert image.format == "WEBP"
+
+    def test_alpha_flattened_for_jpeg(self, tmp_path):
+        """Test images with transparency can be encoded as JPEG"""
+        processed, _ = preprocess_image(make_image(mode="RGBA"), max_edge=256, image_format="JPEG", cache_dir=str(tmp_path))
+
+        with Image.open(io.BytesIO(processed)) as image:
+            assert image.mode == "RGB"
+
+    def test_cached_by_original_hash(self, tmp_path):
+        """Test the processed variant is cached on disk and reused"""
+        original = make_image()
+        first, _ = preprocess_image(original, max_edge=512, cache_dir=str(tmp_path))
+
+        cached_files = [f for _, _, files in os.walk(tmp_path) for f in files]
+        assert len(cached_files) == 1
+        assert cached_files[0].startswith(image_hash(original))
+
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr("utils.image_utils.resize_image", lambda *args: pytest.fail("cache was not used"))
+            second, _ = preprocess_image(original, max_edge=512, cache_dir=str(tmp_path))
+        assert first == second
+
+    def test_invalid_image_returns_original(self, tmp_path):
+        """Test undecodable data is passed through unchanged"""
+        processed, mime_type = preprocess_image(b"not an image", mime_type="image/png", cache_dir=str(tmp_path))
+
+        assert processed == b"not an image"
+        assert mime_type == "image/png"
+
+    def test_unsupported_format(self, tmp_path):
+        """Test an unknown output format is rejected"""
+        with pytest.raises(ValueError):
+            preprocess_image(make_image(), image_format="TIFF", cache_dir=str(tmp_path))
+
+
+class TestImageServingHelpers:
+    def test_file_etag_is_content_hash(self, tmp_path):
+        """Test the ETag is strong and derived from file content"""
+        path = tmp_path / "image.png"
+        path.write_bytes(make_image(size=(10, 10)))
+
+        etag = file_etag(str(path))
+        assert etag == f'"{image_hash(path.read_bytes())}"'
+
+    def test_etag_matches(self):
+        """Test If-None-Match comparison"""
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('"x", W/"abc"', '"abc"')
+        assert etag_matches("*", '"abc"')
+        assert not etag_matches('"other"', '"abc"')
+        assert not etag_matches(None, '"abc"')
+
+    @pytest.mark.parametrize("header,expected", [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=1000-", None),
+    ])
+    def test_parse_range(self, header, expected):
+        """Test single byte range parsing against a 1000 byte file"""
+        assert parse_range(header, 1000) == expected
+
+    def test_parse_range_rejects_multiple_ranges(self):
+        """Test multi-range requests are not supported"""
+        with pytest.raises(ValueError):
+            parse_range("bytes=0-1,5-6", 1000)
+
+    def test_thumbnail_path(self, tmp_path):
+        """Test thumbnails are created once and keyed by the source ETag"""
+        path = tmp_path / "image.png"
+        path.write_bytes(make_image())
+        etag = file_etag(str(path))
+
+        thumb = thumbnail_path(str(path), etag, max_edge=128, cache_dir=str(tmp_path / "cache"))
+        with Image.open(thumb) as image:
+            assert max(image.size) == 128
+        assert thumbnail_path(str(path), etag, max_edge=128, cache_dir=str(tmp_path / "cache")) == thumb
+
+
+class TestImageRoute:
+    @pytest.fixture
+    def client(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        app, _ = import_service()
+        from api.routers.llm_rag_chat import chat_manager
+        os.makedirs(os.path.join(chat_manager.images_dir, "chat-1"))
+        self.image = make_image(size=(10, 10))
+        with open(os.path.join(chat_manager.images_dir, "chat-1", "image.png"), "wb") as f:
+            f.write(self.image)
+        open(os.path.join(chat_manager.images_dir, "chat-1", "empty.png"), "wb").close()
+        with TestClient(app) as client:
+            yield client
+
+    def test_not_modified(self, client):
+        """Test a matching If-None-Match returns 304 with the validators"""
+        etag = client.get("/llm-rag/images/chat-1/image.png").headers["etag"]
+        response = client.get("/llm-rag/images/chat-1/image.png", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert response.content == b""
+
+    def test_partial_content(self, client):
+        """Test a single byte range returns 206 with Content-Range"""
+        response = client.get("/llm-rag/images/chat-1/image.png", headers={"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert response.headers["content-range"] == f"bytes 0-9/{len(self.image)}"
+        assert response.content == self.image[:10]
+
+    def test_unsatisfiable_range(self, client):
+        """Test ranges past the end, including any range of an empty file, return 416"""
+        response = client.get("/llm-rag/images/chat-1/image.png", headers={"Range": f"bytes={len(self.image)}-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == f"bytes */{len(self.image)}"
+        response = client.get("/llm-rag/images/chat-1/empty.png", headers={"Range": "bytes=0-"})
+        assert response.status_code == 416
+        assert response.headers["content-range"] == "bytes */0"
+
+    @pytest.mark.parametrize("header", ["bytes=0-1,5-6", "bytes=abc", "items=0-9"])
+    def test_malformed_range_sends_whole_file(self, client, header):
+        """Test malformed or multi-range headers are ignored"""
+        response = client.get("/llm-rag/images/chat-1/image.png", headers={"Range": header})
+        assert response.status_code == 200
+        assert response.content == self.image
+        response = client.get("/llm-rag/images/chat-1/empty.png", headers={"Range": header})
+        assert response.status_code == 200
+        assert response.content == b""
@@ -0,0 +1,126 @@
+import pytest
+from unittest.mock import MagicMock
+from stand_ins import InMemoryCollection
+from utils.lexical_index import BM25Index, tokenize, reciprocal_rank_fusion, hybrid_query, filtered_query
+
+documents = {
+    "b0-0": "Gemcitabine is the standard chemotherapy for pancreatic cancer.",
+    "b0-1": "Ascites in pancreatic cancer is managed with paracentesis.",
+    "b1-0": "Italian guidelines recommend capecitabine with gemcitabine.",
+    "b1-1": "Bowel obstruction presents with vomiting and abdominal distension.",
+}
+
+
+@pytest.fixture
+def index():
+    index = BM25Index()
+    index.add(list(documents.keys()), list(documents.values()))
+    return index
+
+
+def test_tokenize():
+    assert tokenize("Gemcitabine, 5-FU & CA19-9!") == ["gemcitabine", "5", "fu", "ca19", "9"]
+
+
+def test_lookup_intersects_postings(index):
+    """Test term lookups return chunks containing every term"""
+    assert index.lookup("pancreatic cancer") == ["b0-0", "b0-1"]
+    assert index.lookup("gemcitabine capecitabine") == ["b1-0"]
+    assert index.lookup("missing term") == []
+
+
+def test_contains_matches_substring(index):
+    """Test contains behaves like Chroma's $contains"""
+    assert index.contains("Italian") == ["b1-0"]
+    assert index.contains("italian") == []
+    assert index.contains("with paracentesis") == ["b0-1"]
+
+
+def test_contains_matches_partial_words(index):
+    """Test substrings that start or end inside a word match like $contains"""
+    assert index.contains("Ital") == ["b1-0"]
+    assert index.contains("talian") == ["b1-0"]
+    assert index.contains("ith paracent") == ["b0-1"]
+    assert index.contains("citabine") == ["b0-0", "b1-0"]
+    assert index.contains("Ascites in pan") == ["b0-1"]
+
+
+def test_contains_uses_posting_lists(index):
+    """Test edge words are looked up in the vocabulary instead of scanning every chunk"""
+    index.documents = [Unscannable(document) for document in index.documents]
+    assert index.contains("Italian") == ["b1-0"]
+    assert index.contains("Ital") == ["b1-0"]
+    assert [index.documents[index._positions[doc_id]].checked for doc_id in documents] == [0, 0, 2, 0]
+
+
+class Unscannable(str):
+    """Chunk text that counts substring checks"""
+    checked = 0
+
+    def __contains__(self, text):
+        self.checked += 1
+        return super().__contains__(text)
+
+
+def test_search_ranks_by_bm25(index):
+    """Test the most relevant chunk ranks first"""
+    results = index.search("ascites paracentesis", k=2)
+    assert results[0][0] == "b0-1"
+    assert len(results) == 1
+
+
+def test_save_and_load(index, tmp_path):
+    """Test the persisted index answers queries identically"""
+    path = str(tmp_path / "bm25.json.gz")
+    index.save(path)
+    loaded = BM25Index.load(path)
+
+    assert loaded.search("gemcitabine") == index.search("gemcitabine")
+    assert loaded.document("b1-1") == documents["b1-1"]
+
+
+def test_reciprocal_rank_fusion():
+    """Test ids ranked well in several lists come first"""
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]])
+    assert [doc_id for doc_id, _ in fused] == ["b", "a", "d", "c"]
+
+
+def test_hybrid_query(index):
+    """Test dense and lexical candidates are fused"""
+    collection = MagicMock()
+    collection.query.return_value = {
+        "ids": [["b1-1", "b0-1"]],
+        "documents": [[documents["b1-1"], documents["b0-1"]]],
+        "metadatas": [[{"book": "1"}, {"book": "0"}]],
+        "distances": [[0.1, 0.2]],
+    }
+    results = hybrid_query(collection, index, "ascites paracentesis", [0.0], n_results=2)
+
+    assert results["ids"][0] == ["b0-1", "b1-1"]
+    assert results["metadatas"][0] == [{"book": "0"}, {"book": "1"}]
+
+
+def test_filtered_query(index):
+    """Test the vector db ranks only the lexical candidates"""
+    collection = InMemoryCollection("char-split-collection")
+    embeddings = {"b0-0": [0.0, 1.0], "b0-1": [1.0, 0.0], "b1-0": [0.0, 0.9], "b1-1": [0.0, 0.9]}
+    collection.add(ids=list(documents), documents=list(documents.values()),
+                   metadatas=[{"book": doc_id[1]} for doc_id in documents], embeddings=[embeddings[doc_id] for doc_id in documents])
+    results = filtered_query(collection, index, "pancreatic cancer", [0.0, 0.9], n_results=1)
+
+    assert results["ids"][0] == ["b0-0"]
+    assert results["distances"][0] == [pytest.approx(0.01)]
+    assert filtered_query(collection, index, "no such words", [0.0, 0.9])["ids"] == [[]]
+
+
+def test_cli_loads_index_once(index, tmp_path):
+    """Test the CLI reuses a loaded index until the file changes"""
+    import os
+    import cli
+    path = str(tmp_path / "bm25-char-split.json.gz")
+    assert cli.get_lexical_index(path) is None
+    index.save(path)
+    loaded = cli.get_lexical_index(path)
+    assert cli.get_lexical_index(path) is loaded
+    os.utime(path, ns=(0, 0))
+    assert cli.get_lexical_index(path) is not loaded
@@ -61,13 +61,14 @@ def test_embed(mock_http_client):
 
 
 @patch("chromadb.HttpClient")
-def test_load(mock_http_client):
+def test_load(mock_http_client, tmp_path):
     mock_client = MagicMock()
     mock_http_client.return_value = mock_client
     mock_client.create_collection.return_value = MagicMock(name="TestCollection")
 
     try:
-        load(method=dummy_method)
+        # Writes the lexical index to output_folder, keep it out of the repo's outputs/
+        load(method=dummy_method, output_folder=str(tmp_path))
     except Exception as e:
         pytest.fail(f"Function raised an exception: {e}")
 
@@ -0,0 +1,54 @@
+import asyncio
+import uuid
+import httpx
+from fastapi import FastAPI
+from load_test import histogram, run_load, summarize
+
+
+def make_app():
+    """Minimal app with the same chat routes as the service"""
+    app = FastAPI()
+
+    @app.post("/llm-rag/chats")
+    async def start_chat(message: dict):
+        return {"chat_id": str(uuid.uuid4()), "messages": [message]}
+
+    @app.post("/llm-rag/chats/{chat_id}")
+    async def continue_chat(chat_id: str, message: dict):
+        return {"chat_id": chat_id, "messages": [message]}
+
+    @app.get("/llm-rag/chats")
+    async def list_chats(limit: int = 20):
+        return []
+
+    return app
+
+
+def test_histogram_buckets():
+    counts = histogram([0.0005, 0.003, 0.003, 45.0])
+    assert counts["<=1ms"] == 1
+    assert counts["<=5ms"] == 2
+    assert counts[">30000ms"] == 1
+
+
+def test_summarize():
+    stats = summarize([0.1] * 99 + [1.0], elapsed=10)
+    assert stats["requests"] == 100
+    assert stats["throughput_rps"] == 10
+    assert stats["p50_ms"] == 100
+    assert stats["max_ms"] == 1000
+    assert summarize([], elapsed=1)["requests"] == 0
+
+
+def test_run_load():
+    """Test simulated users exercise every endpoint without errors"""
+    async def run():
+        transport = httpx.ASGITransport(app=make_app())
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await run_load(client, concurrency=4, duration=0.3, think_time="fixed:5", image_ratio=0.5, list_ratio=0.5, image="data:image/png;base64,")
+
+    result = asyncio.run(run())
+    assert result["total"]["requests"] > 0
+    assert result["total"]["errors"] == 0
+    assert result["endpoints"]["start_chat"]["requests"] >= 4
+    assert result["endpoints"]["continue_chat"]["requests"] > 0
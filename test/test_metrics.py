@@ -0,0 +1,79 @@
+import pytest
+from utils.metrics import Counter, Gauge, Histogram, Registry, timed
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def test_counter_with_labels(registry):
+    counter = Counter("cache_requests_total", "Cache lookups", ["cache", "result"], registry=registry)
+    counter.labels("image", "hit").inc()
+    counter.labels("image", "hit").inc(2)
+    counter.labels("image", "miss").inc()
+
+    text = registry.render()
+    assert "# TYPE cache_requests_total counter" in text
+    assert 'cache_requests_total{cache="image",result="hit"} 3' in text
+    assert 'cache_requests_total{cache="image",result="miss"} 1' in text
+    with pytest.raises(ValueError):
+        counter.labels("image")
+
+
+def test_gauge_function(registry):
+    sessions = {}
+    gauge = Gauge("active_sessions", "Sessions", registry=registry)
+    gauge.set_function(lambda: len(sessions))
+    sessions["a"] = 1
+
+    assert "active_sessions 1" in registry.render()
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    histogram = Histogram("stage_seconds", "Stage latency", ["stage"], buckets=(0.1, 1.0), registry=registry)
+    child = histogram.labels("embed")
+    for value in (0.05, 0.5, 0.5, 5.0):
+        child.observe(value)
+
+    text = registry.render()
+    assert 'stage_seconds_bucket{stage="embed",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="embed",le="1"} 3' in text
+    assert 'stage_seconds_bucket{stage="embed",le="+Inf"} 4' in text
+    assert 'stage_seconds_count{stage="embed"} 4' in text
+    assert 'stage_seconds_sum{stage="embed"} 6.05' in text
+
+
+def test_timed_records_failures(registry):
+    histogram = Histogram("operation_seconds", "Operation latency", registry=registry)
+
+    @timed(histogram)
+    def fail():
+        raise RuntimeError
+
+    with pytest.raises(RuntimeError):
+        fail()
+    with histogram.time():
+        pass
+    assert "operation_seconds_count 2" in registry.render()
+
+
+def test_duplicate_names_rejected(registry):
+    Counter("errors_total", "Errors", registry=registry)
+    with pytest.raises(ValueError):
+        Counter("errors_total", "Errors", registry=registry)
+
+
+def test_label_values_are_escaped(registry):
+    Counter("requests_total", "Requests", ["route"], registry=registry).labels('/a"b').inc()
+    assert 'requests_total{route="/a\\"b"} 1' in registry.render()
+
+
+def test_metric_types_implement_children_and_samples(registry):
+    from utils.metrics import _Metric
+
+    class Incomplete(_Metric):
+        type = "counter"
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete_total", "Incomplete", registry=registry)
@@ -0,0 +1,52 @@
+import os
+import json
+import time
+from profiling import StageProfiler, classify_stack
+
+
+class FakeCode:
+    def __init__(self, name):
+        self.co_name = name
+
+
+class FakeFrame:
+    def __init__(self, module, function):
+        self.f_globals = {"__name__": module}
+        self.f_code = FakeCode(function)
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += sum(range(100))
+    return total
+
+
+def test_classify_stack():
+    assert classify_stack([FakeFrame("cli", "embed"), FakeFrame("ssl", "recv_into")]) == "network"
+    assert classify_stack([FakeFrame("cli", "embed"), FakeFrame("threading", "wait")]) == "idle"
+    assert classify_stack([FakeFrame("cli", "embed"), FakeFrame("dedup", "signature")]) == "cpu"
+
+
+def test_stage_profiles_are_written(tmp_path):
+    profiler = StageProfiler(cpu=True, memory=True, output_folder=str(tmp_path), sample_interval=0.005)
+    with profiler.stage("chunk"):
+        busy(0.1)
+        data = [bytearray(1024) for _ in range(1000)]
+    with profiler.stage("embed"):
+        time.sleep(0.1)
+
+    chunk, embed = profiler.stages["chunk"], profiler.stages["embed"]
+    assert chunk["cpu_s"] > 0.05
+    assert embed["wait_s"] > 0.03
+    assert chunk["memory_peak_mb"] >= 1
+    assert chunk["top_functions"]
+    for path in chunk["files"].values():
+        assert os.path.exists(path)
+    with open(chunk["files"]["collapsed"]) as f:
+        assert any("busy (test_profiling.py" in line for line in f)
+
+    profiler.report()
+    with open(os.path.join(str(tmp_path), f"{profiler.run_id}-summary.json")) as f:
+        assert set(json.load(f)) == {"chunk", "embed"}
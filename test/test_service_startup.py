@@ -0,0 +1,76 @@
+import time
+import pytest
+from fastapi.testclient import TestClient
+from load_test import import_service
+
+
+@pytest.fixture
+def service_app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    app, backends = import_service()
+    return app, backends
+
+
+def test_ready_after_warm_up(service_app):
+    app, backends = service_app
+    with TestClient(app) as client:
+        assert client.get("/healthz").json() == {"status": "ok"}
+        deadline = time.monotonic() + 10
+        response = client.get("/readyz")
+        while response.status_code == 503 and time.monotonic() < deadline:
+            time.sleep(0.01)
+            response = client.get("/readyz")
+
+    assert response.status_code == 200
+    readiness = response.json()
+    assert readiness["ready"]
+    assert {"embedding", "vector_store", "generative_model"} <= set(readiness["steps"])
+    assert backends["embedding"].counters.snapshot()["calls"] >= 1
+
+
+def test_with_retries_backs_off_until_success(service_app):
+    from api.utils.retry import with_retries
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("chroma DB not up yet")
+        return "connected"
+
+    assert with_retries(flaky, "Connecting", attempts=None, backoff=0.001) == "connected"
+    calls.clear()
+    with pytest.raises(ConnectionError):
+        with_retries(flaky, "Connecting", attempts=2, backoff=0.001)
+    assert len(calls) == 2
+
+
+def test_routes_labelled_by_template(service_app):
+    app, _ = service_app
+    with TestClient(app) as client:
+        # "a" also appears in "llm-rag", a path value must not be substituted into earlier segments
+        response = client.get("/llm-rag/chats/a", headers={"X-Session-ID": "session-a"})
+        assert response.status_code == 404
+        assert response.headers["X-Trace-ID"]
+        client.get("/llm-rag/images/a/g.png")
+        metrics = client.get("/metrics").text
+
+    assert 'route="/llm-rag/chats/{chat_id}",status="404"' in metrics
+    assert 'route="/llm-rag/images/{chat_id}/{message_id}.png"' in metrics
+    assert "/chats/a" not in metrics
+
+
+def test_path_parameter_routes_labelled_by_template(service_app):
+    from fastapi import APIRouter, Request
+    from api import service
+    app, _ = service_app
+    router = APIRouter()
+
+    @router.get("/files/{name:path}")
+    async def get_file(name: str, request: Request):
+        return {"route": service.route_template(request)}
+
+    service.include_router(router, prefix="/test-files")
+    with TestClient(app) as client:
+        response = client.get("/test-files/files/chats/a/b.png")
+    assert response.json() == {"route": "/test-files/files/{name:path}"}
@@ -0,0 +1,108 @@
+import threading
+import pytest
+from utils.session_store import get_session_store, SessionStore, SQLiteSessionStore, LockTimeout, STORES
+from load_test import import_service
+
+
+def make_chat(chat_id, dts, content="How should malignant ascites be managed?"):
+    return {"chat_id": chat_id, "title": content[:50], "dts": dts, "messages": [
+        {"message_id": f"{chat_id}-1", "role": "user", "content": content},
+        {"message_id": f"{chat_id}-2", "role": "assistant", "content": "Paracentesis."},
+    ]}
+
+
+@pytest.fixture(params=sorted(STORES))
+def store(request, tmp_path):
+    return get_session_store("llm-rag", kind=request.param, history_dir=str(tmp_path))
+
+
+def test_chats_and_state(store):
+    for i in range(3):
+        store.save_chat(make_chat(f"chat-{i}", dts=i), "session-a")
+    store.save_chat(make_chat("other", dts=9), "session-b")
+
+    assert store.get_chat("chat-1", "session-a")["messages"][0]["content"].startswith("How should")
+    assert not store.get_chat("chat-1", "session-b")
+    assert [chat["chat_id"] for chat in store.get_recent_chats("session-a", limit=2)] == ["chat-2", "chat-1"]
+
+    assert store.state_version("chat-1") is None
+    assert store.save_state("chat-1", b"first") == 1
+    assert store.save_state("chat-1", b"second") == 2
+    assert store.get_state("chat-1") == (2, b"second")
+
+
+def test_backends_must_implement_state_and_locks(tmp_path):
+    class ChatsOnly(SessionStore):
+        pass
+
+    with pytest.raises(TypeError):
+        ChatsOnly("llm-rag", history_dir=str(tmp_path))
+
+
+def test_lock_excludes_other_turns(store):
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with store.lock("chat-1"):
+            acquired.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    acquired.wait()
+    with pytest.raises(LockTimeout):
+        with store.lock("chat-1", timeout=0.05):
+            pass
+    with store.lock("chat-2", timeout=0.05):
+        pass
+    release.set()
+    thread.join()
+    with store.lock("chat-1", timeout=0.05):
+        pass
+
+
+def test_sqlite_workers_share_locks_and_state(tmp_path):
+    """Two stores on the same database act like two uvicorn workers"""
+    first = SQLiteSessionStore("llm-rag", history_dir=str(tmp_path))
+    second = SQLiteSessionStore("llm-rag", history_dir=str(tmp_path))
+    first.save_state("chat-1", b"state")
+    assert second.get_state("chat-1") == (1, b"state")
+    with first.lock("chat-1"):
+        with pytest.raises(LockTimeout):
+            with second.lock("chat-1", timeout=0.05):
+                pass
+
+
+def test_other_worker_restores_session(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    import_service()
+    from api.utils import llm_rag_utils
+    store = get_session_store("llm-rag", kind="sqlite")
+
+    # Worker A answers the first turns of a chat
+    session = llm_rag_utils.create_chat_session()
+    session.max_turns = 2
+    chat = {"chat_id": "chat-1", "dts": 0, "messages": []}
+    for i in range(4):
+        message = {"message_id": str(i), "role": "user", "content": f"Question {i} about ascites"}
+        answer = llm_rag_utils.generate_chat_response(session, message)
+        chat["messages"] += [message, {"message_id": f"{i}-answer", "role": "assistant", "content": answer}]
+    store.save_chat(chat, "session-a")
+    llm_rag_utils.save_chat_session("chat-1", session, store)
+    worker_a = session
+
+    # Worker B has no copy in memory, so it restores the saved state instead of rebuilding
+    llm_rag_utils.chat_sessions.clear()
+    restored, source = llm_rag_utils.load_chat_session("chat-1", store.get_chat("chat-1", "session-a"), store)
+    assert source == "restored"
+    assert restored.summary_lines == worker_a.summary_lines
+    assert [turn["parts"] for turn in restored.turns] == [turn["parts"] for turn in worker_a.turns]
+    assert restored.turns[-1]["context_ids"] == worker_a.turns[-1]["context_ids"]
+
+    # Worker B answers the next turn, so worker A's copy is out of date
+    llm_rag_utils.save_chat_session("chat-1", restored, store)
+    llm_rag_utils.chat_sessions["chat-1"] = worker_a
+    session, source = llm_rag_utils.load_chat_session("chat-1", chat, store)
+    assert source == "restored" and session is not worker_a
+    assert llm_rag_utils.load_chat_session("chat-1", chat, store) == (session, "memory")
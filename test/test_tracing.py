@@ -0,0 +1,101 @@
+import pytest
+from utils.tracing import Tracer, FileSpanExporter, parse_trace_header
+from trace_report import read_traces, critical_path, children_by_parent, summarize
+
+
+class ListExporter:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+def make_span(span_id, parent_id, name, start_ms, end_ms):
+    return {"span_id": span_id, "parent_id": parent_id, "name": name, "start_ns": int(start_ms * 1e6), "end_ns": int(end_ms * 1e6), "attributes": {}}
+
+
+def test_spans_nest_under_the_current_span():
+    exporter = ListExporter()
+    tracer = Tracer(exporter=exporter, sample_rate=1.0)
+    with tracer.trace("request", trace_id="abc") as root:
+        with tracer.span("embed_query", query_chars=10):
+            with tracer.span("inner") as inner:
+                inner.set_attribute("results", 5)
+        with tracer.span("send_message"):
+            pass
+
+    spans = {span.name: span for span in exporter.traces[0].spans}
+    assert spans["embed_query"].parent_id == root.span_id
+    assert spans["inner"].parent_id == spans["embed_query"].span_id
+    assert spans["inner"].attributes == {"results": 5}
+    assert spans["send_message"].trace_id == "abc"
+
+
+def test_span_outside_trace_is_noop():
+    tracer = Tracer(exporter=ListExporter())
+    with tracer.span("orphan") as span:
+        span.set_attribute("ignored", True)
+    assert tracer.current_trace_id() is None
+
+
+def test_sampling_keeps_slow_and_failed_traces():
+    exporter = ListExporter()
+    tracer = Tracer(exporter=exporter, sample_rate=0.0, slow_ms=1e9)
+    with tracer.trace("fast"):
+        pass
+    with pytest.raises(RuntimeError):
+        with tracer.trace("failed"):
+            raise RuntimeError("boom")
+    tracer.slow_ms = 0
+    with tracer.trace("slow"):
+        pass
+
+    assert [trace.spans[-1].name for trace in exporter.traces] == ["failed", "slow"]
+    assert exporter.traces[0].spans[-1].status == "error"
+
+
+@pytest.mark.parametrize("trace_format", ["jsonl", "otlp"])
+def test_file_export_round_trip(tmp_path, trace_format):
+    path = str(tmp_path / "traces.jsonl")
+    tracer = Tracer(exporter=FileSpanExporter(path, trace_format), sample_rate=1.0)
+    with tracer.trace("POST /llm-rag/chats", route="/llm-rag/chats"):
+        with tracer.span("send_message", prompt_tokens=120):
+            pass
+
+    traces = read_traces(path)
+    assert len(traces) == 1
+    assert traces[0]["root"]["attributes"]["route"] == "/llm-rag/chats"
+    child = [span for span in traces[0]["spans"] if span["name"] == "send_message"][0]
+    assert child["attributes"]["prompt_tokens"] == 120
+
+
+def test_parse_trace_header():
+    assert parse_trace_header({"X-Trace-ID": "ABC123"}) == "abc123"
+    assert parse_trace_header({"traceparent": "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"}) == "4bf92f3577b34da6a3ce929d0e0e4736"
+    assert parse_trace_header({"X-Trace-ID": "<script>"}) is None
+    assert parse_trace_header({}) is None
+
+
+def test_critical_path():
+    """Test overlapping children only count where they determine the end time"""
+    spans = [
+        make_span("r", None, "request", 0, 100),
+        make_span("a", "r", "embed_query", 10, 40),
+        make_span("b", "r", "cache_lookup", 12, 20),
+        make_span("c", "r", "send_message", 40, 90),
+    ]
+    path = critical_path(spans[0], children_by_parent(spans))
+
+    assert [name for name, _ in path] == ["embed_query (self)", "send_message (self)", "request (self)"]
+    assert dict(path)["request (self)"] == pytest.approx(20)
+
+
+def test_summarize_orders_by_duration():
+    traces = [
+        {"trace_id": str(i), "spans": [span], "root": span}
+        for i, span in enumerate([make_span("r1", None, "fast", 0, 10), make_span("r2", None, "slow", 0, 50)])
+    ]
+    summary = summarize(traces, top=1)
+    assert summary["matched"] == 2
+    assert summary["slowest"][0]["trace_id"] == "1"
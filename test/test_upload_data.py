@@ -1,10 +1,11 @@
 import pytest
 from unittest.mock import Mock, patch, mock_open
 import os
+import threading
 from google.cloud import storage
 from google.api_core import exceptions
 import glob
-from upload_data import upload_to_gcp
+from upload_data import upload_to_gcp, download_from_gcp, file_checksums, blob_is_current, upload_file, SOURCE_CHECKSUM_KEY
 
 class TestUploadData:
     @pytest.fixture(autouse=True)
@@ -30,6 +31,9 @@ class TestUploadData:
             mock_blob = Mock()
             mock_blob.exists.return_value = False
             mock_bucket.blob.return_value = mock_blob
+
+            # Empty bucket listing
+            mock_bucket.list_blobs.return_value = []
             
             yield mock_client, mock_bucket, mock_blob
 
@@ -47,7 +51,16 @@ class TestUploadData:
                     '/app/data/chunks-recursive-split-2.jsonl'
                 ]
             }[pattern]
-            yield mock_glob
+            # The globbed files do not exist locally, fake their checksums
+            with patch('upload_data.file_checksums', return_value={"size": 10, "crc32c": "local-crc", "md5": "local-md5"}):
+                yield mock_glob
+
+    def remote_blob(self, name, crc32c):
+        """Create a mock listed blob"""
+        blob = Mock()
+        blob.name = name
+        blob.metadata = {SOURCE_CHECKSUM_KEY: crc32c}
+        return blob
 
     def test_successful_upload(self, mock_storage_client, mock_glob):
         """Test successful upload of files to GCP"""
@@ -68,6 +81,26 @@ class TestUploadData:
         # Verify upload_from_filename was called for each file
         assert mock_blob.upload_from_filename.call_count == 4
 
+    def test_parallel_uploads_share_part_workers(self, mock_storage_client, mock_glob):
+        """Test uploads in flight split max_workers for their parts"""
+        started = threading.Barrier(4, timeout=5)
+        part_workers = []
+
+        def upload(bucket, file_path, blob_name, checksums, gzip_jsonl=False, max_workers=8):
+            part_workers.append(max_workers)
+            started.wait()
+
+        with patch('upload_data.upload_file', side_effect=upload):
+            upload_to_gcp(max_workers=4)
+            assert sorted(part_workers) == [1, 1, 2, 4]
+
+            # A file uploading alone gets every worker
+            part_workers.clear()
+            started = threading.Barrier(1)
+            mock_glob.side_effect = lambda pattern: ['/app/data/embeddings-recursive-split-1.jsonl'] if pattern.startswith('/app/data/embeddings') else []
+            upload_to_gcp(max_workers=4)
+            assert part_workers == [4]
+
     def test_bucket_not_found(self, mock_storage_client, mock_glob):
         """Test handling of non-existent bucket"""
         mock_client, _, _ = mock_storage_client
@@ -96,18 +129,38 @@ class TestUploadData:
         mock_client.return_value.create_bucket.assert_called_once()
 
     def test_skip_existing_files(self, mock_storage_client, mock_glob):
-        """Test skipping of existing files"""
+        """Test skipping of files whose remote content is unchanged"""
         mock_client, mock_bucket, mock_blob = mock_storage_client
-        # Set blob to exist
-        mock_blob.exists.return_value = True
+        mock_bucket.list_blobs.side_effect = lambda prefix: [
+            self.remote_blob(f"{prefix}{kind}-recursive-split-{i}.jsonl", "local-crc")
+            for kind in [prefix.rstrip("/")] for i in (1, 2)
+        ]
         
         # Run the upload function
         upload_to_gcp()
         
-        # Verify exists() was called but upload_from_filename wasn't
-        assert mock_blob.exists.call_count == 4
+        # Verify the bucket was listed once per prefix and nothing was uploaded
+        assert mock_bucket.list_blobs.call_count == 2
+        assert mock_blob.exists.call_count == 0
         assert mock_blob.upload_from_filename.call_count == 0
 
+    def test_update_changed_files(self, mock_storage_client, mock_glob):
+        """Test stale remote blobs are re-uploaded"""
+        mock_client, mock_bucket, mock_blob = mock_storage_client
+        mock_bucket.list_blobs.side_effect = lambda prefix: [
+            self.remote_blob("embeddings/embeddings-recursive-split-1.jsonl", "local-crc"),
+            self.remote_blob("embeddings/embeddings-recursive-split-2.jsonl", "stale-crc"),
+        ] if prefix == "embeddings/" else []
+
+        # Run the upload function
+        upload_to_gcp()
+
+        # Only the unchanged embedding file is skipped
+        assert mock_blob.upload_from_filename.call_count == 3
+        uploaded = sorted(call.args[0] for call in mock_bucket.blob.call_args_list)
+        assert "embeddings/embeddings-recursive-split-1.jsonl" not in uploaded
+        assert "embeddings/embeddings-recursive-split-2.jsonl" in uploaded
+
     def test_upload_error_handling(self, mock_storage_client, mock_glob):
         """Test handling of upload errors"""
         mock_client, mock_bucket, mock_blob = mock_storage_client
@@ -140,3 +193,165 @@ class TestUploadData:
             mock_client, mock_bucket, mock_blob = mock_storage_client
             # Verify no uploads were attempted
             assert mock_blob.upload_from_filename.call_count == 0
+
+
+class TestChecksums:
+    def test_file_checksums(self, tmp_path):
+        """Test checksums are base64 encoded like GCS blob metadata"""
+        path = tmp_path / "chunks.jsonl"
+        path.write_bytes(b"hello world")
+
+        checksums = file_checksums(str(path))
+        assert checksums["size"] == 11
+        assert checksums["md5"] == "XrY7u+Ae7tCTyyK7j1rNww=="
+        assert checksums["crc32c"] == "yZRlqg=="
+
+    def test_blob_is_current(self):
+        """Test comparison against source metadata and stored checksums"""
+        checksums = {"size": 11, "crc32c": "yZRlqg==", "md5": "XrY7u+Ae7tCTyyK7j1rNww=="}
+
+        blob = Mock(metadata=None, content_encoding=None, crc32c="yZRlqg==", md5_hash=None)
+        assert blob_is_current(blob, checksums)
+        blob = Mock(metadata=None, content_encoding=None, crc32c="other", md5_hash=None)
+        assert not blob_is_current(blob, checksums)
+        # Gzipped blobs are only trusted through the source checksum metadata
+        blob = Mock(metadata=None, content_encoding="gzip", crc32c="yZRlqg==", md5_hash=None)
+        assert not blob_is_current(blob, checksums)
+        blob = Mock(metadata={SOURCE_CHECKSUM_KEY: "yZRlqg=="}, content_encoding="gzip", crc32c="x", md5_hash=None)
+        assert blob_is_current(blob, checksums)
+
+    def test_gzip_upload(self, tmp_path):
+        """Test JSONL files are gzipped with content encoding set"""
+        path = tmp_path / "chunks.jsonl"
+        path.write_bytes(b'{"chunk": "a"}\n' * 100)
+        bucket = Mock()
+        blob = bucket.blob.return_value
+
+        upload_file(bucket, str(path), "chunks/chunks.jsonl", file_checksums(str(path)), gzip_jsonl=True)
+
+        assert blob.content_encoding == "gzip"
+        assert blob.metadata == {SOURCE_CHECKSUM_KEY: file_checksums(str(path))["crc32c"]}
+        uploaded_path = blob.upload_from_filename.call_args.args[0]
+        assert uploaded_path.endswith(".gz")
+        assert not os.path.exists(uploaded_path)
+
+
+class FakeBlob:
+    """Blob backed by a local file"""
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_encoding = None
+        self.md5_hash = None
+        self.crc32c = None
+        self.download_count = 0
+
+    @property
+    def path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    def upload_from_filename(self, filename, **kwargs):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(filename, "rb") as src, open(self.path, "wb") as dst:
+            dst.write(src.read())
+        checksums = file_checksums(self.path)
+        self.crc32c, self.md5_hash = checksums["crc32c"], checksums["md5"]
+        self.bucket.blobs[self.name] = self
+
+    def download_to_filename(self, filename, **kwargs):
+        self.download_count += 1
+        with open(self.path, "rb") as src, open(filename, "wb") as dst:
+            dst.write(src.read())
+
+
+class FakeBucket:
+    """Bucket stored in a local directory"""
+    def __init__(self, root):
+        self.root = root
+        self.blobs = {}
+
+    def blob(self, name):
+        return self.blobs.get(name) or FakeBlob(self, name)
+
+    def list_blobs(self, prefix=""):
+        return [blob for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)]
+
+
+class FakeStorageClient:
+    def __init__(self, root):
+        self.fake_bucket = FakeBucket(root)
+
+    def get_bucket(self, name):
+        return self.fake_bucket
+
+
+class TestDownloadData:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        os.environ['GCP_PROJECT'] = 'test-project'
+        os.environ['GCS_BUCKET_NAME'] = 'test-bucket'
+        yield
+        del os.environ['GCP_PROJECT']
+        del os.environ['GCS_BUCKET_NAME']
+
+    @pytest.fixture
+    def fake_client(self, tmp_path):
+        """Fake storage with two embedding files and one chunk file"""
+        client = FakeStorageClient(str(tmp_path / "bucket"))
+        for name, content in [
+            ("embeddings/embeddings-recursive-split-1.jsonl", b'{"chunk": "a", "embedding": [0.1]}\n'),
+            ("embeddings/embeddings-recursive-split-2.jsonl", b'{"chunk": "b", "embedding": [0.2]}\n'),
+            ("chunks/chunks-recursive-split-1.jsonl", b'{"chunk": "a"}\n'),
+        ]:
+            local = tmp_path / os.path.basename(name)
+            local.write_bytes(content)
+            client.fake_bucket.blob(name).upload_from_filename(str(local))
+            local.unlink()
+        return client
+
+    def test_download_all(self, fake_client, tmp_path):
+        """Test every artifact is pulled into the cache directory"""
+        cache_dir = tmp_path / "cache"
+        counts = download_from_gcp(cache_dir=str(cache_dir), storage_client=fake_client)
+
+        assert counts == {"downloaded": 3, "skipped": 0, "failed": 0}
+        assert sorted(os.listdir(cache_dir)) == [
+            "chunks-recursive-split-1.jsonl",
+            "embeddings-recursive-split-1.jsonl",
+            "embeddings-recursive-split-2.jsonl",
+        ]
+        assert (cache_dir / "chunks-recursive-split-1.jsonl").read_bytes() == b'{"chunk": "a"}\n'
+
+    def test_skip_matching_files(self, fake_client, tmp_path):
+        """Test files whose hashes already match are not downloaded again"""
+        cache_dir = tmp_path / "cache"
+        download_from_gcp(cache_dir=str(cache_dir), storage_client=fake_client)
+        (cache_dir / "chunks-recursive-split-1.jsonl").write_bytes(b"locally modified")
+
+        counts = download_from_gcp(cache_dir=str(cache_dir), storage_client=fake_client)
+
+        assert counts == {"downloaded": 1, "skipped": 2, "failed": 0}
+        assert (cache_dir / "chunks-recursive-split-1.jsonl").read_bytes() == b'{"chunk": "a"}\n'
+
+    def test_checksum_mismatch(self, fake_client, tmp_path):
+        """Test a corrupted download is rejected and not left in the cache"""
+        cache_dir = tmp_path / "cache"
+        fake_client.fake_bucket.blobs["chunks/chunks-recursive-split-1.jsonl"].crc32c = "corrupt"
+
+        counts = download_from_gcp(cache_dir=str(cache_dir), storage_client=fake_client)
+
+        assert counts["failed"] == 1
+        assert sorted(os.listdir(cache_dir)) == [
+            "embeddings-recursive-split-1.jsonl",
+            "embeddings-recursive-split-2.jsonl",
+        ]
+
+    def test_load_after_pull(self, fake_client, tmp_path):
+        """Test pulled embeddings are handed to load()"""
+        cache_dir = tmp_path / "cache"
+        mock_cli = Mock()
+        with patch.dict("sys.modules", {"cli": mock_cli}):
+            download_from_gcp(cache_dir=str(cache_dir), load_method="recursive-split", storage_client=fake_client)
+
+        mock_cli.load.assert_called_once_with(method="recursive-split", output_folder=str(cache_dir))
@@ -0,0 +1,104 @@
+import httpx
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from stand_ins import InMemoryChromaClient, Latency
+from utils.vector_store import VectorStore, QueryCoalescer, is_connection_error
+
+COLLECTION = "recursive-split-collection"
+
+
+class CountingClient(InMemoryChromaClient):
+    """In-memory client that counts collection lookups and can drop its connection"""
+
+    def __init__(self, down=False):
+        super().__init__()
+        self.lookups = 0
+        self.down = down
+        self.create_collection(COLLECTION).add(ids=["a-0"], documents=["cheese"], embeddings=[[1.0, 0.0]])
+
+    def heartbeat(self):
+        if self.down:
+            raise httpx.ConnectError("connection refused")
+        return super().heartbeat()
+
+    def get_collection(self, name, **kwargs):
+        self.lookups += 1
+        collection = super().get_collection(name, **kwargs)
+        if self.down:
+            def query(*args, **kwargs):
+                raise httpx.RemoteProtocolError("server disconnected")
+            collection.query = query
+        return collection
+
+
+def make_store(monkeypatch, clients):
+    store = VectorStore(attempts=3)
+    monkeypatch.setattr(store, "_connect", lambda: clients.pop(0))
+    monkeypatch.setattr("utils.retry.time.sleep", lambda seconds: None)
+    return store
+
+
+def test_collection_handle_is_cached(monkeypatch):
+    client = CountingClient()
+    store = make_store(monkeypatch, [client])
+    collection = store.collection(COLLECTION)
+    for _ in range(3):
+        assert collection.query(query_embeddings=[[1.0, 0.0]], n_results=1)["ids"] == [["a-0"]]
+    assert client.lookups == 1
+    assert collection.name == COLLECTION
+
+
+def test_reconnects_after_connection_loss(monkeypatch):
+    """Test a restarted server is picked up without recreating the store"""
+    store = make_store(monkeypatch, [CountingClient(down=True), CountingClient()])
+    results = store.collection(COLLECTION).query(query_embeddings=[[1.0, 0.0]], n_results=1)
+    assert results["ids"] == [["a-0"]]
+    assert store.reconnects == 1
+
+
+def test_bad_requests_are_not_retried(monkeypatch):
+    client = CountingClient()
+    store = make_store(monkeypatch, [client])
+    with pytest.raises(ValueError):
+        store.collection("missing-collection").count()
+    assert store.reconnects == 0
+    assert store.client is client
+
+
+def test_health_check(monkeypatch):
+    assert make_store(monkeypatch, [CountingClient()]).health_check()["ok"]
+    down = make_store(monkeypatch, [CountingClient(down=True) for _ in range(3)]).health_check()
+    assert not down["ok"]
+    assert "connection refused" in down["error"]
+
+
+def test_is_connection_error():
+    assert is_connection_error(httpx.ConnectTimeout("timed out"))
+    assert is_connection_error(ConnectionResetError())
+    assert not is_connection_error(ValueError("Collection does not exist"))
+
+
+def test_coalescer_groups_concurrent_queries():
+    client = InMemoryChromaClient()
+    collection = client.create_collection("books")
+    collection.add(ids=[f"{book}-{i}" for book in "ab" for i in range(20)], documents=[f"{book} {i}" for book in "ab" for i in range(20)],
+                   metadatas=[{"book": book} for book in "ab" for i in range(20)], embeddings=[[float(i), float(book == "a")] for book in "ab" for i in range(20)])
+    collection.latency = Latency("fixed:20")
+    coalescer = QueryCoalescer(lambda: collection, max_wait=0.005, max_concurrency=1)
+    requests = [([float(i % 20), 0.0], {"book": "ab"[i % 2]}) for i in range(40)]
+
+    def run(request):
+        embedding, where = request
+        return coalescer.query(query_embeddings=[embedding], n_results=3, where=where)
+
+    calls_before = collection.counters.snapshot()["calls"]
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(run, requests))
+
+    assert coalescer.batcher.calls < 40 / 4
+    # One query call per filter in each batch
+    assert collection.counters.snapshot()["calls"] - calls_before <= 2 * coalescer.batcher.calls
+    for (embedding, where), result in zip(requests, results):
+        assert result == collection.query(query_embeddings=[embedding], n_results=3, where=where)
+    several = coalescer.query(query_embeddings=[[1.0, 0.0], [5.0, 0.0]], n_results=2)
+    assert several == collection.query(query_embeddings=[[1.0, 0.0], [5.0, 0.0]], n_results=2)